@@ -0,0 +1,78 @@
+"""
+ABOUT SCRIPT:
+It compares the per-field cropping loop of the Sentinel readers against the vectorized field extraction on a synthetic tile
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import rasterio as rio
+from rasterio import features
+from shapely.geometry import box
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.field_extraction import field_windows, extract_fields
+
+
+def synthetic_tile(num_fields=2000, size=2400, time_stamps=36, bands=4, seed=0):
+    '''
+    THIS FUNCTION GENERATES A SYNTHETIC TILE WITH RECTANGULAR FIELDS.
+    :return: cube in size of [Time Stamp, Image Dimension (Channel), Height, Width], transform, field polygons, field ids
+    '''
+    random = np.random.RandomState(seed)
+    transform = rio.transform.from_bounds(0, 0, size * 10, size * 10, size, size)
+    lefts = random.uniform(0, size * 10 - 500, num_fields)
+    bottoms = random.uniform(0, size * 10 - 500, num_fields)
+    extents = random.uniform(50, 500, (num_fields, 2))
+    polygons = [box(l, b, l + w, b + h) for l, b, (w, h) in zip(lefts, bottoms, extents)]
+    fids = np.arange(1, num_fields + 1)
+    cube = random.randint(0, 10000, (time_stamps, bands, size, size)).astype(np.uint16)
+    return cube, transform, polygons, fids
+
+
+def legacy_loop(cube, transform, polygons, fids):
+    """
+    THIS FUNCTION REPLICATES THE PREVIOUS EXTRACTION LOOP OF S1Reader/S2Reader
+    """
+    shape = cube.shape[2:]
+    fid_mask = features.rasterize(zip(polygons, fids), all_touched=True, transform=transform, out_shape=shape)
+    crop_mask = features.rasterize(zip(polygons, fids % 9), all_touched=True, transform=transform, out_shape=shape)
+    for polygon, fid in zip(polygons, fids):
+        window = rio.windows.from_bounds(*polygon.bounds, transform)
+        row_start, col_start = round(window.row_off), round(window.col_off)
+        row_end, col_end = row_start + round(window.height), col_start + round(window.width)
+        image_stack = cube[:, :, row_start:row_end, col_start:col_end].astype(np.float32)
+        mask = fid_mask[row_start:row_end, col_start:col_end]
+        mask[mask != fid] = 0
+        mask[mask == fid] = 1
+        mask = mask.astype(np.float32)
+
+
+def vectorized(cube, transform, polygons, fids):
+    """
+    THIS FUNCTION RUNS THE VECTORIZED EXTRACTION USED BY S1Reader/S2Reader
+    """
+    fid_mask = features.rasterize(zip(polygons, fids), all_touched=True, transform=transform, out_shape=cube.shape[2:])
+    windows = field_windows([polygon.bounds for polygon in polygons], transform)
+    for position, (image_stack,), mask in extract_fields([cube], fid_mask, fids, windows):
+        image_stack = image_stack.astype(np.float32)
+        mask = mask.astype(np.float32)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of the field cropping in the Sentinel readers")
+    parser.add_argument("--num-fields", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=2400)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    cube, transform, polygons, fids = synthetic_tile(args.num_fields, args.size)
+    for name, function in [("legacy loop", legacy_loop), ("vectorized", vectorized)]:
+        timings = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            function(cube, transform, polygons, fids)
+            timings.append(time.perf_counter() - start)
+        print("INFO: {:<12} best of {}: {:.3f}s ({:.0f} fields/s)".format(name, args.repeats, min(timings), len(fids) / min(timings)))
@@ -0,0 +1,57 @@
+"""
+ABOUT SCRIPT:
+It compares reading all sensors of a field through FusedReader against three independent readers joined by field id
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.planet_reader import PlanetReader
+from utils.sentinel_1_reader import S1Reader
+from utils.sentinel_2_reader import S2Reader
+from utils.fused_reader import FusedReader
+
+
+def independent_readers(readers, fids):
+    """
+    THIS FUNCTION READS EVERY FIELD FROM EACH READER SEPARATELY, JOINED BY FIELD ID IN PYTHON
+    """
+    positions = {modality: {fid: position for position, fid in enumerate(reader.fids)} for modality, reader in readers.items()}
+    for fid in fids:
+        sample = {modality: reader[positions[modality][fid]] for modality, reader in readers.items()}
+
+
+def fused_reader(reader, fids):
+    """
+    THIS FUNCTION READS EVERY FIELD FROM THE FUSED READER
+    """
+    for item in range(len(fids)):
+        sample = reader[item]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of the fused multi-sensor reader")
+    parser.add_argument("--planet-dir", required=True, help="folder of the Planet TIF images of a tile, ending with a path separator")
+    parser.add_argument("--s1-dir", required=True, help="folder of the Sentinel-1 tile")
+    parser.add_argument("--s2-dir", required=True, help="folder of the Sentinel-2 tile")
+    parser.add_argument("--labels", required=True, help="GeoJSON labels of the tile")
+    parser.add_argument("--fused-dir", required=True, help="folder of the fused field store")
+    parser.add_argument("--num-fields", type=int, default=500)
+    args = parser.parse_args()
+
+    readers = dict(planet=PlanetReader(args.planet_dir, args.labels),
+                   s1=S1Reader(args.s1_dir, args.labels),
+                   s2=S2Reader(args.s2_dir, args.labels))
+    start = time.perf_counter()
+    fused = FusedReader(readers, args.fused_dir)
+    print("INFO: fused store ready in {:.1f}s".format(time.perf_counter() - start))
+
+    fids = fused.fids[:args.num_fields]
+    for name, function, reader in [("independent", independent_readers, readers), ("fused", fused_reader, fused)]:
+        start = time.perf_counter()
+        function(reader, fids)
+        print("INFO: {:<12} {:8.1f} samples/s".format(name, len(fids) / (time.perf_counter() - start)))
@@ -0,0 +1,82 @@
+"""
+ABOUT SCRIPT:
+It compares the default and the throughput mode of the DataLoader factory on a synthetic memory-mapped field store
+"""
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+import multiprocessing
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.field_store import FieldStore
+from utils.data_loader import DataLoader
+from utils.data_transform import EOTransformer
+
+
+class SyntheticReader(torch.utils.data.Dataset):
+    """
+    THIS CLASS SERVES SYNTHETIC FIELDS FROM A FIELD STORE LIKE THE MEMORY-MAPPED READERS, AND RECORDS THE BUSY TIME OF EACH WORKER
+    """
+    def __init__(self, folder, num_fields, time_stamps, busy):
+        random = np.random.RandomState(0)
+        shapes = random.randint(8, 64, (num_fields, 2))
+        fields = ({"image_stack": random.randint(0, 10000, (time_stamps, 4, h, w)).astype(np.uint16),
+                   "mask": np.ones((h, w), dtype=np.uint8)} for h, w in shapes)
+        self.store = FieldStore.write(folder, np.arange(num_fields), fields)
+        self.transform = EOTransformer().transform
+        self.busy = busy
+
+    def open_storage(self):
+        self.store.close()
+        self.store.open()
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, item):
+        start = time.perf_counter()
+        image_stack, mask = self.transform(self.store.read(item, "image_stack"), self.store.read(item, "mask"))
+        info = torch.utils.data.get_worker_info()
+        with self.busy.get_lock():
+            self.busy[info.id if info is not None else 0] += time.perf_counter() - start
+        return image_stack, 0, mask, item
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of the DataLoader factory modes")
+    parser.add_argument("--num-fields", type=int, default=2000)
+    parser.add_argument("--time-stamps", type=int, default=73)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--step-time", type=float, default=0.01, help="simulated model step per batch in seconds")
+    args = parser.parse_args()
+
+    busy = multiprocessing.Array("d", max(1, args.num_workers))
+    with tempfile.TemporaryDirectory() as folder:
+        reader = SyntheticReader(os.path.join(folder, "store"), args.num_fields, args.time_stamps, busy)
+        for throughput in [False, True]:
+            loader = DataLoader(test_reader=reader).get_test_loader(args.batch_size, args.num_workers, throughput=throughput)
+            for i in range(len(busy)):
+                busy[i] = 0.0
+            batches, wait, start = 0, 0.0, time.perf_counter()
+            for epoch in range(args.epochs):
+                iterator = iter(loader)
+                while True:
+                    fetch = time.perf_counter()
+                    try:
+                        batch = next(iterator)
+                    except StopIteration:
+                        break
+                    wait += time.perf_counter() - fetch
+                    time.sleep(args.step_time)
+                    batches += 1
+            elapsed = time.perf_counter() - start
+            idle = 1.0 - sum(busy) / (elapsed * len(busy))
+            print("INFO: throughput={!s:<6} {:8.1f} batches/s, main process data wait {:5.1f}%, worker idle {:5.1f}%".format(
+                throughput, batches / elapsed, 100 * wait / elapsed, 100 * idle))
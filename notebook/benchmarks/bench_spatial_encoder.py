@@ -0,0 +1,51 @@
+"""
+ABOUT SCRIPT:
+It measures the memory and throughput of the SpatialEncoder backbones with and without time-chunked encoding
+"""
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.baseline_models import SpatialEncoder, SUPPORTED_SPATIAL_MODELS
+from utils.field_extraction import peak_memory_mb
+
+
+def run(backbone, chunk_size, checkpoint, batch_size, time_stamps, image_size, train):
+    """
+    THIS FUNCTION MEASURES ONE CONFIGURATION. IT RUNS IN A FRESH PROCESS, SO THAT THE PEAK MEMORY BELONGS TO THIS CONFIGURATION ONLY
+    """
+    model = SpatialEncoder(backbone, input_dim=4, pretrained=False, chunk_size=chunk_size, checkpoint=checkpoint)
+    model.train(train)
+    x = torch.rand(batch_size, time_stamps, 4, image_size, image_size)
+    start = time.perf_counter()
+    with torch.set_grad_enabled(train):
+        features = model(x)
+        if train:
+            features.sum().backward()
+    elapsed = time.perf_counter() - start
+    return dict(backbone=backbone, chunk_size=chunk_size, checkpoint=checkpoint, images_per_second=batch_size * time_stamps / elapsed, peak_memory_mb=peak_memory_mb())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of the time-chunked spatial encoding")
+    parser.add_argument("--batch-size", type=int, default=12)
+    parser.add_argument("--time-stamps", type=int, default=365)
+    parser.add_argument("--image-size", type=int, default=32)
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[0, 512, 128])
+    parser.add_argument("--backbones", nargs="+", default=list(dict.fromkeys(SUPPORTED_SPATIAL_MODELS)))
+    parser.add_argument("--train", action="store_true", help="measure forward and backward pass, with activation checkpointing for chunked runs")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    for backbone in args.backbones:
+        for chunk_size in args.chunk_sizes:
+            chunk_size = chunk_size if chunk_size > 0 else None
+            checkpoint = args.train and chunk_size is not None
+            with context.Pool(1) as pool:
+                result = pool.apply(run, (backbone, chunk_size, checkpoint, args.batch_size, args.time_stamps, args.image_size, args.train))
+            print("INFO: {backbone:<20} chunk_size={chunk_size!s:<6} checkpoint={checkpoint!s:<6} {images_per_second:9.1f} images/s  peak {peak_memory_mb:8.0f} MB".format(**result))
@@ -0,0 +1,216 @@
+"""
+ABOUT SCRIPT:
+It runs a reproducible benchmark suite of the readers, transforms, data loaders and models on synthetic tiles and stores the results as JSON,
+so that the results of two commits can be compared
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import tempfile
+import subprocess
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.planet_reader import PlanetReader
+from utils.sentinel_1_reader import S1Reader
+from utils.sentinel_2_reader import S2Reader
+from utils.data_loader import DataLoader
+from utils.data_transform import EOTransformer
+from utils.baseline_models import SpatiotemporalModel, SUPPORTED_SPATIAL_MODELS, SUPPORTED_TEMPORAL_MODELS
+from synthetic_tiles import write_synthetic_tiles
+
+READERS = dict(planet=PlanetReader, s1=S1Reader, s2=S2Reader)
+
+
+def latency(function, repeats):
+    """
+    THIS FUNCTION RETURNS THE MEAN, P50 AND P95 LATENCY OF A FUNCTION IN MILLISECONDS
+    """
+    durations = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function(i)
+        durations.append(time.perf_counter() - start)
+    durations = 1e3 * np.array(durations)
+    return dict(mean_ms=float(durations.mean()), p50_ms=float(np.percentile(durations, 50)), p95_ms=float(np.percentile(durations, 95)))
+
+
+def bench_reader(sensor, paths, num_items):
+    '''
+    THIS FUNCTION MEASURES THE COLD AND WARM SETUP OF A READER, THE PACKING OF ITS FIELD STORE AND THE __getitem__ LATENCY OF BOTH STORAGES.
+    :return: dictionary of results
+    '''
+    reader_class, input_dir = READERS[sensor], paths[sensor]
+    start = time.perf_counter()
+    reader_class(input_dir, paths["labels"])
+    setup_cold = time.perf_counter() - start
+    start = time.perf_counter()
+    reader = reader_class(input_dir, paths["labels"])
+    setup_warm = time.perf_counter() - start
+    start = time.perf_counter()
+    memmap_reader = reader_class(input_dir, paths["labels"], storage="memmap")
+    pack = time.perf_counter() - start
+
+    num_items = min(num_items, len(reader))
+    result = dict(num_fields=len(reader), setup_cold_s=setup_cold, setup_warm_s=setup_warm, pack_memmap_s=pack,
+                  getitem_npz=latency(lambda i: reader[i], num_items),
+                  getitem_memmap=latency(lambda i: np.ascontiguousarray(memmap_reader[i][0]), num_items))
+    print("INFO: {:<7} setup cold {:.2f}s warm {:.2f}s, __getitem__ npz {:.2f}ms memmap {:.2f}ms".format(
+        sensor, setup_cold, setup_warm, result["getitem_npz"]["mean_ms"], result["getitem_memmap"]["mean_ms"]))
+    return result
+
+
+def bench_transform(paths, batch_size, num_items):
+    '''
+    THIS FUNCTION MEASURES THE SAMPLE-WISE TRANSFORM AND THE BATCH-WISE COLLATION OF RAW PLANET FIELDS.
+    :return: dictionary of results
+    '''
+    reader = PlanetReader(paths["planet"], paths["labels"])
+    samples = [reader[i] for i in range(min(num_items, len(reader)))]
+    results = {}
+    for name, transformer in [("spatial", EOTransformer()), ("temporal", EOTransformer(spatial_encoder=False)), ("pixel_set", EOTransformer(pixel_set_size=64))]:
+        start = time.perf_counter()
+        for image_stack, _, mask, _ in samples:
+            transformer.transform(image_stack, mask)
+        transform = len(samples) / (time.perf_counter() - start)
+        start = time.perf_counter()
+        for i in range(0, len(samples), batch_size):
+            transformer.collate(samples[i:i + batch_size])
+        collate = len(samples) / (time.perf_counter() - start)
+        results[name] = dict(transform_samples_per_s=transform, collate_samples_per_s=collate)
+        print("INFO: {:<8} transform {:.1f} samples/s, collate {:.1f} samples/s".format(name, transform, collate))
+    return results
+
+
+def bench_loader(paths, batch_size, num_workers, epochs):
+    '''
+    THIS FUNCTION MEASURES THE BATCHES PER SECOND OF THE DEFAULT AND THE THROUGHPUT MODE OF THE DATA LOADER OVER THE PLANET FIELDS.
+    :return: dictionary of results
+    '''
+    reader = PlanetReader(paths["planet"], paths["labels"], transform=EOTransformer().transform, storage="memmap")
+    results = {}
+    for throughput in [False, True]:
+        loader = DataLoader(test_reader=reader).get_test_loader(batch_size, num_workers, throughput=throughput)
+        batches, start = 0, time.perf_counter()
+        for epoch in range(epochs):
+            for batch in loader:
+                batches += 1
+        name = "throughput" if throughput else "default"
+        results[name] = dict(batches_per_s=batches / (time.perf_counter() - start))
+        print("INFO: {:<10} loader {:.1f} batches/s".format(name, results[name]["batches_per_s"]))
+    return results
+
+
+def bench_models(spatial_backbones, temporal_backbones, batch_size, time_stamps, image_size, steps):
+    '''
+    THIS FUNCTION MEASURES A FORWARD AND BACKWARD STEP OF EACH COMBINATION OF SPATIAL AND TEMPORAL BACKBONES.
+    :return: dictionary of results, keyed by the model name
+    '''
+    results = {}
+    for spatial_backbone in spatial_backbones:
+        for temporal_backbone in temporal_backbones:
+            torch.manual_seed(0)
+            model = SpatiotemporalModel(spatial_backbone, temporal_backbone, input_dim=4, num_classes=9, sequencelength=time_stamps, pretrained_spatial=False)
+            shape = (batch_size, time_stamps, 4, image_size, image_size) if spatial_backbone != "none" else (batch_size, time_stamps, 4)
+            x, y = torch.rand(shape), torch.randint(0, 9, (batch_size,))
+
+            def step(i):
+                model.zero_grad(set_to_none=True)
+                torch.nn.functional.nll_loss(model(x), y).backward()
+
+            step(0)  # warm-up
+            result = latency(step, steps)
+            result["samples_per_s"] = 1e3 * batch_size / result["mean_ms"]
+            results[model.modelname] = result
+            print("INFO: {:<30} forward+backward {:.1f}ms ({:.1f} samples/s)".format(model.modelname, result["mean_ms"], result["samples_per_s"]))
+    return results
+
+
+def flatten(results, prefix=""):
+    """
+    THIS FUNCTION FLATTENS THE NESTED RESULTS INTO "a/b/c" KEYS
+    """
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "/"))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(baseline_file, results):
+    '''
+    THIS FUNCTION PRINTS THE RELATIVE CHANGE OF EACH MEASUREMENT AGAINST A BASELINE RESULT FILE. TIMES (_s, _ms) SHOULD DECREASE, RATES (_per_s) INCREASE
+    :return: None
+    '''
+    with open(baseline_file, "r") as f:
+        baseline = json.load(f)
+    old, new = flatten(baseline["results"]), flatten(results["results"])
+    print("INFO: Comparison with {} (commit {})".format(baseline_file, baseline.get("commit")))
+    for key in sorted(set(old) & set(new)):
+        if isinstance(new[key], float) and old[key]:
+            print("{:<70}{:>14.3f}{:>14.3f}{:>+9.1f}%".format(key, old[key], new[key], 100 * (new[key] - old[key]) / old[key]))
+
+
+def current_commit():
+    """
+    THIS FUNCTION RETURNS THE GIT COMMIT OF THE BENCHMARKED CODE, OR None OUTSIDE OF A GIT REPOSITORY
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark suite on synthetic tiles")
+    parser.add_argument("--num-fields", type=int, default=200)
+    parser.add_argument("--planet-time-stamps", type=int, default=73)
+    parser.add_argument("--s1-time-stamps", type=int, default=61)
+    parser.add_argument("--s2-time-stamps", type=int, default=73)
+    parser.add_argument("--num-items", type=int, default=100, help="number of fields to measure the latencies and transforms")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--num-workers", type=int, default=2)
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--steps", type=int, default=5, help="number of training steps to measure each model")
+    parser.add_argument("--spatial-backbones", nargs="+", default=["none", "mobilenet_v3_small", "resnet18"],
+                        help="subset of {} or none".format(list(dict.fromkeys(SUPPORTED_SPATIAL_MODELS))))
+    parser.add_argument("--temporal-backbones", nargs="+", default=SUPPORTED_TEMPORAL_MODELS)
+    parser.add_argument("--stages", nargs="+", default=["readers", "transform", "loader", "models"])
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", default=None, help="result file of a previous run to compare with")
+    parser.add_argument("--workdir", default=None, help="folder of the synthetic tiles, by default a temporary folder which is removed afterwards")
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    torch.manual_seed(0)
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp()
+    results = {}
+    try:
+        paths = write_synthetic_tiles(workdir, args.num_fields, planet_time_stamps=args.planet_time_stamps,
+                                      s1_time_stamps=args.s1_time_stamps, s2_time_stamps=args.s2_time_stamps)
+        if "readers" in args.stages:
+            results["readers"] = {sensor: bench_reader(sensor, paths, args.num_items) for sensor in READERS.keys()}
+        if "transform" in args.stages:
+            results["transform"] = bench_transform(paths, args.batch_size, args.num_items)
+        if "loader" in args.stages:
+            results["loader"] = bench_loader(paths, args.batch_size, args.num_workers, args.epochs)
+        if "models" in args.stages:
+            results["models"] = bench_models(args.spatial_backbones, args.temporal_backbones, args.batch_size, args.planet_time_stamps, 32, args.steps)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = dict(commit=current_commit(), created=datetime.datetime.now().isoformat(), torch=torch.__version__, config=vars(args), results=results)
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print("INFO: Benchmark results are written into {}".format(args.output))
+    if args.compare is not None:
+        compare(args.compare, output)
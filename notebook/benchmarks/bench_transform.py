@@ -0,0 +1,77 @@
+"""
+ABOUT SCRIPT:
+It compares the per-sample EOTransformer.transform path against the batched EOTransformer.collate path
+"""
+
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+from torch.utils.data.dataloader import default_collate
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.data_transform import EOTransformer
+
+
+def synthetic_samples(num_samples=256, time_stamps=73, bands=4, seed=0):
+    '''
+    THIS FUNCTION GENERATES RAW READER SAMPLES OF RANDOM FIELD SIZES.
+    :return: list of (image_stack, label, mask, field_id)
+    '''
+    random = np.random.RandomState(seed)
+    samples = []
+    for fid in range(num_samples):
+        H, W = random.randint(8, 64, 2)
+        image_stack = random.randint(0, 10000, (time_stamps, bands, H, W)).astype(np.uint16)
+        mask = (random.rand(H, W) > 0.2).astype(np.uint8)
+        samples.append((image_stack, random.randint(0, 9), mask, fid))
+    return samples
+
+
+def per_sample(transformer, samples):
+    """
+    THIS FUNCTION TRANSFORMS EVERY SAMPLE SEPARATELY AND COLLATES THEM, AS THE READERS DO WITH A TRANSFORM
+    """
+    batch = []
+    for image_stack, label, mask, fid in samples:
+        image_stack, mask = transformer.transform(image_stack, mask)
+        batch.append((image_stack, label, mask, fid))
+    return default_collate(batch)
+
+
+def batched(transformer, samples):
+    """
+    THIS FUNCTION COLLATES THE RAW SAMPLES AND TRANSFORMS THEM AS A BATCH
+    """
+    return transformer.collate(samples)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of the per-sample and batched data transforms")
+    parser.add_argument("--num-samples", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--time-stamps", type=int, default=73)
+    parser.add_argument("--image-size", type=int, default=32)
+    args = parser.parse_args()
+
+    samples = synthetic_samples(args.num_samples, args.time_stamps)
+    batches = [samples[i:i + args.batch_size] for i in range(0, len(samples), args.batch_size)]
+    transformer = EOTransformer(image_size=args.image_size)
+    T, D = samples[0][0].shape[:2]
+    output_bytes = T * D * args.image_size * args.image_size * 4
+
+    for name, function in [("per-sample", per_sample), ("batched", batched)]:
+        # peak of the numpy allocations while transforming one batch, in units of transformed float32 samples
+        tracemalloc.start()
+        function(transformer, batches[0])
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        for batch in batches:
+            function(transformer, batch)
+        elapsed = time.perf_counter() - start
+        print("INFO: {:<10} {:8.1f} samples/s, peak numpy memory {:.1f} sample copies per sample".format(
+            name, len(samples) / elapsed, peak / output_bytes / len(batches[0])))
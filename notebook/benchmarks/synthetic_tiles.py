@@ -0,0 +1,132 @@
+"""
+ABOUT SCRIPT:
+It generates synthetic Planet, Sentinel-1 and Sentinel-2 tiles with matching GeoJSON labels in the folder layout of the challenge data
+"""
+
+import os
+import pickle
+import datetime
+import numpy as np
+import geopandas as gpd
+import rasterio as rio
+from shapely.geometry import box
+
+CRS = "EPSG:32633"
+ORIGIN = (500000.0, 5800000.0)  # upper left corner of the synthetic tiles in UTM 33N
+CROP_NAMES = ["Wheat", "Rye", "Barley", "Oats", "Corn", "Oil Seeds", "Root Crops", "Meadows", "Forage Crops"]
+
+
+class SyntheticBBox():
+    """
+    THIS CLASS MIMICS THE ATTRIBUTES OF THE sentinelhub BBox STORED IN bbox.pkl, SO THAT NO sentinelhub INSTALLATION IS REQUIRED
+    """
+    def __init__(self, min_x, min_y, max_x, max_y, crs=CRS):
+        self.min_x, self.min_y, self.max_x, self.max_y = min_x, min_y, max_x, max_y
+        self.crs = crs
+
+
+def write_labels(label_file, num_fields, extent, min_field_size=40.0, max_field_size=150.0, seed=0):
+    '''
+    THIS FUNCTION WRITES RECTANGULAR FIELDS ON A REGULAR GRID OF THE TILE AS GEOJSON LABELS.
+    :param label_file: path of the GeoJSON file
+    :param num_fields: number of fields
+    :param extent: side length of the square tile in meters
+    :param min_field_size: minimum side length of a field in meters
+    :param max_field_size: maximum side length of a field in meters, it has to fit into a grid cell
+    :param seed: random seed of the field sizes and crop types
+    :return: labels as GeoDataFrame
+    '''
+    random = np.random.RandomState(seed)
+    cells = int(np.ceil(np.sqrt(num_fields)))
+    cell_size = extent / cells
+    assert max_field_size < cell_size, "WARNING: {} fields of up to {}m do not fit into a tile of {}m".format(num_fields, max_field_size, extent)
+
+    rows, cols = np.divmod(np.arange(num_fields), cells)
+    sizes = random.uniform(min_field_size, max_field_size, (num_fields, 2))
+    left = ORIGIN[0] + cols * cell_size + random.uniform(0, 1, num_fields) * (cell_size - sizes[:, 0])
+    top = ORIGIN[1] - rows * cell_size - random.uniform(0, 1, num_fields) * (cell_size - sizes[:, 1])
+    crop_ids = random.randint(1, len(CROP_NAMES) + 1, num_fields)
+
+    labels = gpd.GeoDataFrame(dict(fid=np.arange(1, num_fields + 1), crop_id=crop_ids, crop_name=[CROP_NAMES[crop_id - 1] for crop_id in crop_ids]),
+                              geometry=[box(l, t - h, l + w, t) for l, t, (w, h) in zip(left, top, sizes)], crs=CRS)
+    labels.to_file(label_file, driver="GeoJSON")
+    return labels
+
+
+def acquisition_dates(time_stamps, step_days, start=datetime.date(2018, 3, 1)):
+    """
+    THIS FUNCTION RETURNS time_stamps DATES EVERY step_days DAYS
+    """
+    return [start + datetime.timedelta(days=step_days * t) for t in range(time_stamps)]
+
+
+def write_planet_tile(input_dir, extent, time_stamps=73, resolution=3.0, seed=0):
+    '''
+    THIS FUNCTION WRITES A PLANET FUSION TILE AS ONE 4-BAND uint16 TIF PER 5-DAY TIME STAMP, IN A FOLDER NAMED BY ITS DATE.
+    :param input_dir: folder of the tile
+    :param extent: side length of the square tile in meters
+    :param time_stamps: number of time stamps
+    :param resolution: pixel size in meters
+    :param seed: random seed of the reflectances
+    :return: None
+    '''
+    random = np.random.RandomState(seed)
+    size = int(extent / resolution)
+    transform = rio.transform.from_origin(ORIGIN[0], ORIGIN[1], resolution, resolution)
+    for date in acquisition_dates(time_stamps, 5):
+        folder = os.path.join(input_dir, date.isoformat())
+        os.makedirs(folder, exist_ok=True)
+        with rio.open(os.path.join(folder, "tile.tif"), "w", driver="GTiff", width=size, height=size, count=4, dtype="uint16",
+                      crs=CRS, transform=transform) as image:
+            image.write(random.randint(0, 10000, (4, size, size)).astype(np.uint16))
+
+
+def write_sentinel_tile(input_dir, extent, sensor, time_stamps, resolution=10.0, seed=0):
+    '''
+    THIS FUNCTION WRITES A SENTINEL-1 (vv.npy, vh.npy) OR SENTINEL-2 (bands.npy, clp.npy) TILE WITH ITS bbox.pkl AND timestamp.pkl.
+    :param input_dir: folder of the tile
+    :param extent: side length of the square tile in meters
+    :param sensor: "s1" or "s2"
+    :param time_stamps: number of time stamps
+    :param resolution: pixel size in meters
+    :param seed: random seed of the observations
+    :return: None
+    '''
+    random = np.random.RandomState(seed)
+    size = int(extent / resolution)
+    os.makedirs(input_dir, exist_ok=True)
+    with open(os.path.join(input_dir, "bbox.pkl"), "wb") as f:
+        pickle.dump(SyntheticBBox(ORIGIN[0], ORIGIN[1] - size * resolution, ORIGIN[0] + size * resolution, ORIGIN[1]), f)
+    step_days = 6 if sensor == "s1" else 5
+    with open(os.path.join(input_dir, "timestamp.pkl"), "wb") as f:
+        pickle.dump([datetime.datetime.combine(date, datetime.time(10)) for date in acquisition_dates(time_stamps, step_days)], f)
+
+    if sensor == "s1":
+        for band in ["vv", "vh"]:
+            np.save(os.path.join(input_dir, "{}.npy".format(band)), random.rand(time_stamps, size, size, 1).astype(np.float32))
+    else:
+        np.save(os.path.join(input_dir, "bands.npy"), random.randint(0, 10000, (time_stamps, size, size, 12)).astype(np.uint16))
+        np.save(os.path.join(input_dir, "clp.npy"), random.randint(0, 256, (time_stamps, size, size, 1)).astype(np.uint8))
+
+
+def write_synthetic_tiles(root, num_fields=200, extent=None, planet_time_stamps=73, s1_time_stamps=61, s2_time_stamps=73, seed=0):
+    '''
+    THIS FUNCTION WRITES A COMPLETE SET OF SYNTHETIC TILES COVERING THE SAME FIELDS.
+    :param root: output folder
+    :param num_fields: number of fields
+    :param extent: side length of the square tiles in meters. By default, it leaves 160m x 160m per field
+    :param planet_time_stamps: number of Planet time stamps
+    :param s1_time_stamps: number of Sentinel-1 time stamps
+    :param s2_time_stamps: number of Sentinel-2 time stamps
+    :param seed: random seed
+    :return: dictionary with the input folders of planet, s1, s2 and the label file
+    '''
+    if extent is None:
+        extent = 160.0 * np.ceil(np.sqrt(num_fields))
+    paths = dict(planet=os.path.join(root, "planet") + "/", s1=os.path.join(root, "s1"), s2=os.path.join(root, "s2"), labels=os.path.join(root, "labels.geojson"))
+    write_labels(paths["labels"], num_fields, extent, seed=seed)
+    write_planet_tile(paths["planet"], extent, planet_time_stamps, seed=seed)
+    write_sentinel_tile(paths["s1"], extent, "s1", s1_time_stamps, seed=seed)
+    write_sentinel_tile(paths["s2"], extent, "s2", s2_time_stamps, seed=seed)
+    print("INFO: Synthetic tiles with {} fields of {:.0f}m x {:.0f}m are written into {}".format(num_fields, extent, extent, root))
+    return paths
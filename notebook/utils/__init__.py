@@ -1,8 +1,14 @@
+from .field_store import FieldStore
+from .field_reader import FieldReader
+from .setup_manifest import load_manifest, write_manifest
 from .planet_reader import *
 from .sentinel_1_reader import *
 from .sentinel_2_reader import *
+from .multi_tile_reader import MultiTileReader, TileShardBatchSampler
+from .fused_reader import FusedReader
 from .data_transform import PlanetTransform
 from .data_loader import *
 from .baseline_models import *
 from .train_valid_eval_utils import  *
 from .unzipper import *
+from .profiler import enable_profiling, disable_profiling, profile_summary, export_chrome_trace
@@ -8,6 +8,7 @@ import breizhcrops as bzh
 from torchvision import models
 import torch
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 
 SUPPORTED_TEMPORAL_MODELS = ["inceptiontime", "lstm", "msresnet", "starrnn", "tempcnn", "transformermodel"]
 SUPPORTED_SPATIAL_MODELS = ['resnet18', 'resnet34', 'resnet50', 'resnet101','resnext50_32x4d','resnext50_32x4d',
@@ -20,12 +21,13 @@ class SpatiotemporalModel(nn.Module):
     A wrapper around torchvision (spatial) and breizhcrops models (temporal)
     """
     def __init__(self, spatial_backbone="mobilenet_v3_small", temporal_backbone="LSTM", input_dim=4,
-                 num_classes=9, sequencelength=365, pretrained_spatial=True, device="cpu"):
+                 num_classes=9, sequencelength=365, pretrained_spatial=True, device="cpu", spatial_chunk_size=None, spatial_checkpoint=False):
         super(SpatiotemporalModel, self).__init__()
 
 
         if spatial_backbone != "none":
-            self.spatial_encoder = SpatialEncoder(backbone=spatial_backbone , input_dim=input_dim, pretrained=pretrained_spatial)
+            self.spatial_encoder = SpatialEncoder(backbone=spatial_backbone , input_dim=input_dim, pretrained=pretrained_spatial,
+                                                  chunk_size=spatial_chunk_size, checkpoint=spatial_checkpoint)
             output_dim = self.spatial_encoder.output_dim
         else:
             output_dim = input_dim
@@ -44,11 +46,19 @@ class SpatiotemporalModel(nn.Module):
         return x
 
 class SpatialEncoder(torch.nn.Module):
-    def __init__(self, backbone, input_dim=4, pretrained=False):
+    def __init__(self, backbone, input_dim=4, pretrained=False, chunk_size=None, checkpoint=False):
         super(SpatialEncoder, self).__init__()
         """
-        A wrapper around torchvision models with some minor modifications for >3 input dimensions and features
+        A wrapper around torchvision models with some minor modifications for >3 input dimensions and features.
+        If chunk_size is given, the N*T images are encoded in micro-batches of at most chunk_size images to bound the memory,
+        and with checkpoint=True the activations of each micro-batch are recomputed in the backward pass instead of being stored.
+        Note that batch normalization layers then see micro-batch statistics during training. The recomputation in the backward pass
+        does not update their running statistics again, so they match an unchunked run over the same micro-batches.
+        Gradients still flow to modules feeding the encoder; an input without gradients is detached and marked to require them,
+        as the checkpoint otherwise computes no gradients of the backbone parameters.
         """
+        self.chunk_size = chunk_size
+        self.checkpoint = checkpoint
         assert backbone in SUPPORTED_SPATIAL_MODELS, f"spatial backbone model must be a supported torchvision model {SUPPORTED_SPATIAL_MODELS}"
         if "resnet" in backbone or "resnext" in backbone:
             self.model = models.__dict__[backbone](pretrained=pretrained)
@@ -87,9 +97,37 @@ class SpatialEncoder(torch.nn.Module):
 
     def forward(self, x):
         N, T, D, H, W = x.shape
-        x = self.model(x.view(N * T, D, H, W))
+        x = x.reshape(N * T, D, H, W)
+        if self.chunk_size is None or self.chunk_size >= N * T:
+            x = self.encode(x)
+        else:
+            x = torch.cat([self.encode(chunk) for chunk in x.split(self.chunk_size)])
         return x.view(N, T, x.shape[1])
 
+    def encode(self, x):
+        if self.checkpoint and self.training and torch.is_grad_enabled():
+            # the checkpointed input has to require gradients, otherwise no gradients reach the backbone parameters
+            return checkpoint(self.recompute, x if x.requires_grad else x.detach().requires_grad_(True))
+        return self.model(x)
+
+    def recompute(self, x):
+        """
+        THIS FUNCTION RUNS THE BACKBONE FOR THE CHECKPOINT. THE FIRST PASS RUNS WITHOUT GRADIENTS AND UPDATES THE BATCH NORMALIZATION STATISTICS,
+        THE RECOMPUTATION IN THE BACKWARD PASS RUNS WITH GRADIENTS AND LEAVES THE STATISTICS UNCHANGED
+        """
+        if not torch.is_grad_enabled():
+            return self.model(x)
+        norms = [module for module in self.model.modules() if isinstance(module, nn.modules.batchnorm._BatchNorm) and module.track_running_stats]
+        saved = [(module.momentum, module.num_batches_tracked.clone()) for module in norms]
+        for module in norms:
+            module.momentum = 0.0  # a zero momentum keeps running_mean and running_var
+        try:
+            return self.model(x)
+        finally:
+            for module, (momentum, num_batches_tracked) in zip(norms, saved):
+                module.momentum = momentum
+                module.num_batches_tracked.copy_(num_batches_tracked)
+
 class TemporalEncoder(nn.Module):
     def __init__(self, backbone, input_dim, num_classes, sequencelength, device):
         super(TemporalEncoder, self).__init__()
@@ -0,0 +1,65 @@
+"""
+ABOUT SCRIPT:
+It defines a compact per-field, per-date index of the cloud fractions of the Sentinel-2 fields
+"""
+
+import os
+import json
+import numpy as np
+from tqdm import tqdm
+from .setup_manifest import manifest_signature
+
+CLOUD_INDEX_FILE = "cloud_fractions.npy"
+CLOUD_INDEX_INFO_FILE = "cloud_fractions.json"
+CLP_SCALE = 255.0  # the CLP band of s2cloudless stores the cloud probability as uint8 in [0, 255]
+SUPPORTED_CLOUD_MODES = ["drop", "mask"]
+
+
+def cloud_fraction(cloud_stack, mask, cloud_probability=0.5):
+    '''
+    THIS FUNCTION DETERMINES WHICH FRACTION OF THE FIELD PIXELS IS CLOUDY AT EACH TIME STAMP.
+    :param cloud_stack: cloud probabilities of the field in size [Time Stamp, 1, Height, Width]
+    :param mask: spatial mask of the field in size [Height, Width]
+    :param cloud_probability: probability (between 0.0-1.0) above which a pixel is cloudy
+    :return: array in size [Time Stamp]
+    '''
+    pixels = cloud_stack[:, 0, mask > 0]
+    if pixels.shape[1] == 0:
+        return np.zeros(len(cloud_stack), dtype=np.float32)
+    return (pixels > cloud_probability * CLP_SCALE).mean(1).astype(np.float32)
+
+
+def open_or_build_cloud_index(npyfolder, fids, load_cloud, cloud_probability=0.5):
+    '''
+    THIS FUNCTION OPENS THE CLOUD INDEX OF A TILE AS A MEMORY-MAPPED ARRAY, OR BUILDS IT ONCE FROM THE STORED cloud_stack OF EACH FIELD.
+    :param npyfolder: folder of the extracted field data
+    :param fids: field ids in the order of the reader labels
+    :param load_cloud: function returning cloud_stack, mask for a given (position, fid)
+    :param cloud_probability: probability (between 0.0-1.0) above which a pixel is cloudy
+    :return: read-only array in size [Number of Fields, Time Stamp] holding the cloud fraction of each field and date
+    '''
+    fids = [int(fid) for fid in fids]
+    assert len(fids) > 0, "WARNING: no fields to index in {}".format(npyfolder)
+    array_file = os.path.join(npyfolder, CLOUD_INDEX_FILE)
+    info_file = os.path.join(npyfolder, CLOUD_INDEX_INFO_FILE)
+    setup = manifest_signature(npyfolder)  # fields re-extracted since the last build are detected by their setup manifest
+    if os.path.exists(array_file) and os.path.exists(info_file):
+        with open(info_file, "r") as f:
+            info = json.load(f)
+        if info["cloud_probability"] == cloud_probability and info["fids"] == fids and info.get("setup") == setup:
+            return np.load(array_file, mmap_mode="r")
+        print("INFO: Cloud index {} does not match the reader, it is rebuilt".format(array_file))
+
+    array = None
+    for position, fid in enumerate(tqdm(fids, position=0, leave=True, desc="INFO: Indexing cloud fractions into the file: {}".format(array_file))):
+        fractions = cloud_fraction(*load_cloud(position, fid), cloud_probability)
+        if array is None:
+            array = np.lib.format.open_memmap(array_file + ".tmp", mode="w+", dtype=np.float32, shape=(len(fids), len(fractions)))
+        array[position] = fractions
+    array.flush()
+    del array
+    os.replace(array_file + ".tmp", array_file)
+
+    with open(info_file, "w") as f:
+        json.dump(dict(cloud_probability=cloud_probability, fids=fids, setup=setup), f)
+    return np.load(array_file, mmap_mode="r")
@@ -7,26 +7,43 @@ It defines Data Loader for training, validation and test partitions using torch
 
 import numpy as np
 import torch
+from functools import partial
+from torch.utils.data.dataloader import default_collate
+from .profiler import profiled, profiling_enabled
+from .multi_tile_reader import TileShardBatchSampler
+
+SUPPORTED_SPLITS = ["random", "stratified", "grouped"]
 
 
 class DataLoader():
     """
     THIS CLASS INITIALIZES THE TRAINING, VALIDATION, AND TEST DATA LOADERS
     """
-    def __init__(self, train_val_reader=None, test_reader=None, validation_split=0.2):
+    def __init__(self, train_val_reader=None, test_reader=None, validation_split=0.2, split="random", block_size=1000, seed=0):
         '''
         THIS FUNCTION INITIALIZES THE DATA LOADER.
         :param train_val_reader: data reader inherited from torch.utils.data.Dataset for train/validation partitions
         :param test_reader: data reader inherited from torch.utils.data.Dataset for test partition
         :param validation_split: the rate of validation data (between 0.0-1.0) to split data into 2 partitions for training and validation
+        :param split: strategy of the train/validation split from SUPPORTED_SPLITS:
+                      "random" splits the fields randomly,
+                      "stratified" splits the fields of each crop type with the same rate, so that rare crops are also in the validation partition,
+                      "grouped" splits square spatial blocks of fields, so that neighbouring fields are not in both partitions
+        :param block_size: side length of the spatial blocks in the units of the coordinate reference system of the tiles (meters), used by the grouped split
+        :param seed: random seed of the split
         :return: None
         '''
 
         if train_val_reader is not None:
-            indices = list(range(len(train_val_reader)))
-            np.random.RandomState(0).shuffle(indices)
-            split = int(np.floor(validation_split * len(train_val_reader)))
-            train_indices, val_indices = indices[split:], indices[:split]
+            assert split in SUPPORTED_SPLITS, f"split must be one of {SUPPORTED_SPLITS}"
+            if split == "stratified":
+                train_indices, val_indices = stratified_split(train_val_reader.targets, validation_split, seed)
+            elif split == "grouped":
+                assert getattr(train_val_reader, "field_centroids", None) is not None, "WARNING: field centroids of the reader are unknown"
+                groups = spatial_blocks(train_val_reader.field_centroids, block_size, getattr(train_val_reader, "tile_ids", None))
+                train_indices, val_indices = grouped_split(groups, validation_split, seed)
+            else:
+                train_indices, val_indices = random_split(len(train_val_reader), validation_split, seed)
             # Splitting the data into training and validation partitions
             self.train_dataset = torch.utils.data.Subset(train_val_reader, train_indices)
             self.val_dataset = torch.utils.data.Subset(train_val_reader, val_indices)
@@ -37,34 +54,321 @@ class DataLoader():
         if test_reader is None and train_val_reader is None:
             raise
 
-    def get_train_loader(self, batch_size=4, num_workers=2):
+    def get_train_loader(self, batch_size=4, num_workers=2, size_bucketing=False, image_size=32, min_size=1, shuffle=None, sampler=None,
+                         throughput=False, prefetch_factor=4, collate_fn=None, tile_sharding=False):
         '''
         THIS FUNCTION RETURNS THE TRAINING DATA LOADER.
         :param batch_size: number of batches while loading the training data
         :param num_workers: number of workers to operating in parallel
+        :param size_bucketing: If TRUE, fields of similar size are batched together and padded only to the largest field of the batch.
+                               It requires a reader transform which does not pad to a fixed size, e.g. EOTransformer(pad_to_size=False)
+        :param image_size: maximum field size after the transform, used to group the fields while size_bucketing
+        :param min_size: minimum batch height and width while size_bucketing, e.g. 32 for the VGG backbones
+        :param shuffle: If TRUE, the fields (or the size buckets while size_bucketing) are shuffled in each epoch. It is ignored if a sampler is given
+        :param sampler: torch.utils.data.Sampler over the partition, e.g. a weighted sampler
+        :param throughput: If TRUE, the loader keeps its workers alive between epochs, prefetches prefetch_factor batches per worker,
+                           pins the batches in memory for faster host-to-device copies and opens the memory maps of the readers once per worker
+        :param prefetch_factor: number of batches loaded in advance by each worker in throughput mode
+        :param collate_fn: function merging the samples into a batch, e.g. EOTransformer.collate. By default, samples are stacked
+        :param tile_sharding: If TRUE, each batch is built from the fields of a single tile of a MultiTileReader and the batches of each tile
+                              are given to the same worker, see TileShardBatchSampler
         :return: torch.utils.data.DataLoader
         '''
         print('INFO: Training data loader initialized.')
-        return  torch.utils.data.DataLoader(self.train_dataset, batch_size=batch_size, num_workers=num_workers)
+        if shuffle is None:  # size buckets are always shuffled for training, plain batches keep their order unless requested
+            shuffle = size_bucketing
+        return build_loader(self.train_dataset, batch_size, num_workers, size_bucketing, image_size, min_size, shuffle, sampler, throughput, prefetch_factor, collate_fn, tile_sharding)
 
 
-    def get_validation_loader(self, batch_size, num_workers):
+    def get_validation_loader(self, batch_size, num_workers, size_bucketing=False, image_size=32, min_size=1, shuffle=False, sampler=None,
+                              throughput=False, prefetch_factor=4, collate_fn=None, tile_sharding=False):
         '''
         THIS FUNCTION RETURNS THE VALIDATION DATA LOADER.
         :param batch_size: number of batches while loading the validation data
         :param num_workers: number of workers to operating in parallel
+        :param size_bucketing: If TRUE, fields of similar size are batched together and padded only to the largest field of the batch.
+                               It requires a reader transform which does not pad to a fixed size, e.g. EOTransformer(pad_to_size=False)
+        :param image_size: maximum field size after the transform, used to group the fields while size_bucketing
+        :param min_size: minimum batch height and width while size_bucketing, e.g. 32 for the VGG backbones
+        :param shuffle: If TRUE, the fields (or the size buckets while size_bucketing) are shuffled in each epoch. It is ignored if a sampler is given
+        :param sampler: torch.utils.data.Sampler over the partition, e.g. a weighted sampler
+        :param throughput: If TRUE, the loader keeps its workers alive between epochs, prefetches prefetch_factor batches per worker,
+                           pins the batches in memory for faster host-to-device copies and opens the memory maps of the readers once per worker
+        :param prefetch_factor: number of batches loaded in advance by each worker in throughput mode
+        :param collate_fn: function merging the samples into a batch, e.g. EOTransformer.collate. By default, samples are stacked
+        :param tile_sharding: If TRUE, each batch is built from the fields of a single tile of a MultiTileReader and the batches of each tile
+                              are given to the same worker, see TileShardBatchSampler
         :return: torch.utils.data.DataLoader
         '''
         print('INFO: Validation data loader initialized.')
-        return  torch.utils.data.DataLoader(self.val_dataset, batch_size=batch_size, num_workers=num_workers)
+        return build_loader(self.val_dataset, batch_size, num_workers, size_bucketing, image_size, min_size, shuffle, sampler, throughput, prefetch_factor, collate_fn, tile_sharding)
 
-    def get_test_loader(self, batch_size, num_workers):
+    def get_test_loader(self, batch_size, num_workers, size_bucketing=False, image_size=32, min_size=1, shuffle=False, sampler=None,
+                        throughput=False, prefetch_factor=4, collate_fn=None, tile_sharding=False):
         '''
         THIS FUNCTION RETURNS THE TEST DATA LOADER.
         :param batch_size: number of batches while loading the test data
         :param num_workers: number of workers to operating in parallel
+        :param size_bucketing: If TRUE, fields of similar size are batched together and padded only to the largest field of the batch.
+                               It requires a reader transform which does not pad to a fixed size, e.g. EOTransformer(pad_to_size=False)
+        :param image_size: maximum field size after the transform, used to group the fields while size_bucketing
+        :param min_size: minimum batch height and width while size_bucketing, e.g. 32 for the VGG backbones
+        :param shuffle: If TRUE, the fields (or the size buckets while size_bucketing) are shuffled in each epoch. It is ignored if a sampler is given
+        :param sampler: torch.utils.data.Sampler over the partition, e.g. a weighted sampler
+        :param throughput: If TRUE, the loader keeps its workers alive between epochs, prefetches prefetch_factor batches per worker,
+                           pins the batches in memory for faster host-to-device copies and opens the memory maps of the readers once per worker
+        :param prefetch_factor: number of batches loaded in advance by each worker in throughput mode
+        :param collate_fn: function merging the samples into a batch, e.g. EOTransformer.collate. By default, samples are stacked
+        :param tile_sharding: If TRUE, each batch is built from the fields of a single tile of a MultiTileReader and the batches of each tile
+                              are given to the same worker, see TileShardBatchSampler
         :return: torch.utils.data.DataLoader
         '''
         print('INFO: Test data loader initialized.')
-        return  torch.utils.data.DataLoader(self.test_dataset, batch_size=batch_size, num_workers=num_workers)
+        return build_loader(self.test_dataset, batch_size, num_workers, size_bucketing, image_size, min_size, shuffle, sampler, throughput, prefetch_factor, collate_fn, tile_sharding)
+
+
+def build_loader(dataset, batch_size, num_workers, size_bucketing=False, image_size=32, min_size=1, shuffle=False, sampler=None,
+                 throughput=False, prefetch_factor=4, collate_fn=None, tile_sharding=False):
+    '''
+    THIS FUNCTION BUILDS A torch.utils.data.DataLoader WITH THE OPTIONS OF THE DataLoader FACTORY METHODS.
+    :return: torch.utils.data.DataLoader
+    '''
+    assert not (size_bucketing and tile_sharding), "WARNING: size_bucketing and tile_sharding cannot be combined"
+    assert not (tile_sharding and sampler is not None), "WARNING: a sampler cannot be combined with tile_sharding"
+    kwargs = dict(num_workers=num_workers, collate_fn=collate_fn)
+    if tile_sharding:
+        kwargs["batch_sampler"] = TileShardBatchSampler(field_tile_ids(dataset), batch_size, num_workers, shuffle=shuffle)
+    elif size_bucketing:
+        kwargs["batch_sampler"] = SizeBucketBatchSampler(field_shapes(dataset), batch_size, image_size=image_size, shuffle=shuffle)
+        kwargs["collate_fn"] = partial(pad_collate, min_size=min_size) if collate_fn is None else collate_fn
+    else:
+        kwargs.update(batch_size=batch_size, sampler=sampler, shuffle=shuffle and sampler is None)
+
+    if profiling_enabled():  # collation runs in the workers, so it is timed there
+        kwargs["collate_fn"] = partial(profiled, "collate", kwargs["collate_fn"] if kwargs["collate_fn"] is not None else default_collate)
+
+    if throughput:
+        kwargs["pin_memory"] = torch.cuda.is_available()
+        if num_workers > 0:
+            kwargs.update(persistent_workers=True, prefetch_factor=prefetch_factor, worker_init_fn=open_worker_storage)
+    return torch.utils.data.DataLoader(dataset, **kwargs)
+
+
+def open_worker_storage(worker_id):
+    '''
+    THIS FUNCTION OPENS THE MEMORY MAPS OF THE READERS IN A DATALOADER WORKER, INSTEAD OF SHARING THE HANDLES INHERITED FROM THE MAIN PROCESS.
+    IT IS USED AS worker_init_fn.
+    :param worker_id: id of the DataLoader worker
+    :return: None
+    '''
+    for reader in _readers(torch.utils.data.get_worker_info().dataset):
+        reader.open_storage()
+
+
+def _readers(dataset):
+    """
+    THIS FUNCTION FINDS THE FIELD READERS WRAPPED BY SUBSETS, MULTI-TILE OR FUSED READERS
+    """
+    if isinstance(dataset, torch.utils.data.Subset):
+        return _readers(dataset.dataset)
+    if hasattr(dataset, "readers"):
+        return [reader for wrapped in dataset.readers for reader in _readers(wrapped)]
+    if hasattr(dataset, "open_storage"):
+        return [dataset]
+    return []
+
+
+class SizeBucketBatchSampler(torch.utils.data.Sampler):
+    """
+    THIS CLASS DEFINES A BATCH SAMPLER WHICH GROUPS FIELDS OF SIMILAR SPATIAL EXTENT INTO THE SAME BATCHES
+    """
+    def __init__(self, field_shapes, batch_size, image_size=None, shuffle=True, drop_last=False, seed=0):
+        '''
+        THIS FUNCTION INITIALIZES THE BATCH SAMPLER.
+        :param field_shapes: array in size [Number of Fields, 2] holding Height, Width of each field, e.g. reader.field_shapes
+        :param batch_size: number of fields in each batch
+        :param image_size: fields larger than image_size are cropped by the transform, so their extent is limited to it while grouping
+        :param shuffle: If TRUE, fields of equal extent and the order of the batches are shuffled in each epoch
+        :param drop_last: If TRUE, the last incomplete batch is dropped
+        :param seed: random seed of the shuffling
+        :return: None
+        '''
+        # rotations swap height and width, so the fields are grouped by their larger side
+        self.extents = np.asarray(field_shapes).max(1)
+        if image_size is not None:
+            self.extents = np.minimum(self.extents, image_size)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        random = np.random.RandomState(self.seed + self.epoch)
+        self.epoch += 1
+        if self.shuffle:
+            order = np.lexsort((random.rand(len(self.extents)), self.extents))
+        else:
+            order = np.argsort(self.extents, kind="stable")
+
+        batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if self.shuffle:
+            random.shuffle(batches)
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.extents) // self.batch_size
+        return (len(self.extents) + self.batch_size - 1) // self.batch_size
+
+
+def pad_collate(batch, min_size=1):
+    '''
+    THIS FUNCTION COLLATES TRANSFORMED SAMPLES OF DIFFERENT SPATIAL SIZES BY CENTER PADDING THEM ONLY TO THE LARGEST SAMPLE OF THE BATCH.
+    :param batch: list of (image_stack, label, mask, field_id) where image_stack is in size [Time Stamp, Image Dimension (Channel), Height, Width]
+    :param min_size: minimum height and width of the padded batch
+    :return: image_stack, label, mask, field_id as batched tensors
+    '''
+    image_stacks, labels, masks, field_ids = zip(*batch)
+    if np.ndim(masks[0]) < 2:  # non-spatial samples have a constant size already
+        return default_collate(batch)
+
+    H = max(max(image_stack.shape[-2] for image_stack in image_stacks), min_size)
+    W = max(max(image_stack.shape[-1] for image_stack in image_stacks), min_size)
+    image_stack = torch.zeros((len(batch),) + tuple(image_stacks[0].shape[:-2]) + (H, W))
+    mask = torch.zeros((len(batch), H, W), dtype=torch.as_tensor(masks[0]).dtype)
+    for i, (sample, sample_mask) in enumerate(zip(image_stacks, masks)):
+        h, w = sample.shape[-2:]
+        top, left = (H - h) // 2, (W - w) // 2
+        image_stack[i, ..., top:top + h, left:left + w] = torch.as_tensor(sample)
+        mask[i, top:top + h, left:left + w] = torch.as_tensor(sample_mask)
+    return image_stack, torch.as_tensor(labels), mask, torch.as_tensor(field_ids)
+
+
+def random_split(num_fields, validation_split=0.2, seed=0):
+    '''
+    THIS FUNCTION SPLITS THE FIELDS RANDOMLY INTO TRAINING AND VALIDATION PARTITIONS.
+    :param num_fields: number of fields in the data reader
+    :param validation_split: the rate of validation data (between 0.0-1.0)
+    :param seed: random seed of the split
+    :return: train_indices, val_indices as integer arrays
+    '''
+    indices = np.arange(num_fields)
+    np.random.RandomState(seed).shuffle(indices)
+    split = int(np.floor(validation_split * num_fields))
+    return indices[split:], indices[:split]
+
+
+def stratified_split(targets, validation_split=0.2, seed=0):
+    '''
+    THIS FUNCTION SPLITS THE FIELDS OF EACH CLASS WITH THE SAME RATE INTO TRAINING AND VALIDATION PARTITIONS.
+    EACH CLASS WITH AT LEAST TWO FIELDS HAS AT LEAST ONE FIELD IN EACH PARTITION.
+    :param targets: label index of each field, e.g. reader.targets
+    :param validation_split: the rate of validation data (between 0.0-1.0)
+    :param seed: random seed of the split
+    :return: train_indices, val_indices as integer arrays
+    '''
+    targets = np.asarray(targets)
+    random = np.random.RandomState(seed)
+    # fields are grouped by class in random order, then ranked within their class
+    order = np.lexsort((random.rand(len(targets)), targets))
+    classes, first, counts = np.unique(targets[order], return_index=True, return_counts=True)
+    ranks = np.arange(len(order)) - np.repeat(first, counts)
+    num_val = np.floor(validation_split * counts).astype(np.int64)
+    if validation_split > 0:
+        num_val = np.where(counts > 1, np.clip(num_val, 1, counts - 1), num_val)
+    is_val = ranks < np.repeat(num_val, counts)
+    train_indices, val_indices = order[~is_val], order[is_val]
+    random.shuffle(train_indices)
+    random.shuffle(val_indices)
+    return train_indices, val_indices
+
+
+def spatial_blocks(centroids, block_size=1000, tile_ids=None):
+    '''
+    THIS FUNCTION ASSIGNS EACH FIELD TO THE SQUARE SPATIAL BLOCK ITS CENTROID FALLS INTO.
+    :param centroids: array in size [Number of Fields, 2] holding the x, y coordinates of each field centroid, e.g. reader.field_centroids
+    :param block_size: side length of the blocks in the units of the coordinate reference system
+    :param tile_ids: tile of each field, e.g. MultiTileReader.tile_ids. Blocks are not shared between tiles, since their coordinate systems may differ
+    :return: block id of each field as integer array
+    '''
+    blocks = np.floor(np.asarray(centroids, dtype=np.float64) / block_size).astype(np.int64)
+    if tile_ids is not None:
+        blocks = np.concatenate([np.asarray(tile_ids, dtype=np.int64)[:, None], blocks], 1)
+    return np.unique(blocks, axis=0, return_inverse=True)[1].reshape(-1)
+
+
+def grouped_split(groups, validation_split=0.2, seed=0):
+    '''
+    THIS FUNCTION SPLITS WHOLE GROUPS OF FIELDS, E.G. SPATIAL BLOCKS, INTO TRAINING AND VALIDATION PARTITIONS.
+    GROUPS ARE ASSIGNED TO THE VALIDATION PARTITION IN RANDOM ORDER UNTIL IT HOLDS THE GIVEN RATE OF THE FIELDS.
+    :param groups: group id of each field, e.g. as returned by spatial_blocks
+    :param validation_split: the rate of validation data (between 0.0-1.0)
+    :param seed: random seed of the split
+    :return: train_indices, val_indices as integer arrays
+    '''
+    groups = np.unique(np.asarray(groups), return_inverse=True)[1].reshape(-1)
+    random = np.random.RandomState(seed)
+    counts = np.bincount(groups)
+    order = random.permutation(len(counts))
+    filled = np.cumsum(counts[order]) - counts[order]  # number of validation fields before each group
+    is_val_group = np.zeros(len(counts), dtype=bool)
+    is_val_group[order[filled < np.floor(validation_split * len(groups))]] = True
+    is_val = is_val_group[groups]
+    indices = random.permutation(len(groups))
+    return indices[~is_val[indices]], indices[is_val[indices]]
+
+
+def class_balanced_sampler(targets, num_samples=None, power=1.0, seed=0):
+    '''
+    THIS FUNCTION RETURNS A SAMPLER DRAWING THE FIELDS WITH REPLACEMENT, WEIGHTED INVERSELY TO THE FREQUENCY OF THEIR CLASS.
+    :param targets: label index of each field of the partition, e.g. field_targets(loader.train_dataset)
+    :param num_samples: number of fields drawn in each epoch. Default is the number of fields
+    :param power: exponent of the inverse class frequency, 1.0 samples each class equally often and 0.0 samples the fields uniformly
+    :param seed: random seed of the sampling
+    :return: torch.utils.data.WeightedRandomSampler, to be given as sampler of the DataLoader factory methods
+    '''
+    targets = np.asarray(targets)
+    inverse, counts = np.unique(targets, return_inverse=True, return_counts=True)[1:]
+    weights = counts.astype(np.float64) ** -power
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    return torch.utils.data.WeightedRandomSampler(torch.as_tensor(weights[inverse.reshape(-1)]), len(targets) if num_samples is None else num_samples,
+                                                  replacement=True, generator=generator)
+
+
+def field_targets(dataset):
+    '''
+    THIS FUNCTION RETURNS THE LABEL INDEX OF EACH FIELD OF A DATA READER OR OF A SUBSET OF IT, WITHOUT LOADING ANY FIELD DATA.
+    :param dataset: data reader with precomputed targets, or torch.utils.data.Subset of it
+    :return: integer array
+    '''
+    if isinstance(dataset, torch.utils.data.Subset):
+        return field_targets(dataset.dataset)[dataset.indices]
+    return np.asarray(dataset.targets)
+
+
+def field_shapes(dataset):
+    '''
+    THIS FUNCTION RETURNS THE FIELD SHAPES OF A DATA READER OR OF A SUBSET OF IT.
+    :param dataset: data reader inheriting FieldReader, or torch.utils.data.Subset of it
+    :return: array in size [Number of Fields, 2]
+    '''
+    if isinstance(dataset, torch.utils.data.Subset):
+        return field_shapes(dataset.dataset)[dataset.indices]
+    return dataset.field_shapes
+
 
+def field_tile_ids(dataset):
+    '''
+    THIS FUNCTION RETURNS THE TILE OF EACH FIELD OF A MULTI-TILE READER OR OF A SUBSET OF IT, IN THE ORDER OF THE SUBSET.
+    :param dataset: MultiTileReader, or torch.utils.data.Subset of it
+    :return: integer array
+    '''
+    if isinstance(dataset, torch.utils.data.Subset):
+        return field_tile_ids(dataset.dataset)[dataset.indices]
+    assert hasattr(dataset, "tile_ids"), "WARNING: tile_sharding requires a MultiTileReader"
+    return np.asarray(dataset.tile_ids)
@@ -14,17 +14,24 @@ class EOTransformer():
     """
     THIS CLASS DEFINE A SAMPLE TRANSFORMER FOR DATA AUGMENTATION IN THE TRAINING, VALIDATION, AND TEST DATA LOADING
     """
-    def __init__(self,spatial_encoder=True, normalize=True, image_size=32):
+    def __init__(self,spatial_encoder=True, normalize=True, image_size=32, pad_to_size=True, pixel_set_size=None):
         '''
         THIS FUNCTION INITIALIZES THE DATA TRANSFORMER.
         :param spatial_encoder: It determine if spatial information will be exploited or not. It should be determined in line with the training model.
         :param normalize: It determine if the data to be normalized or not. Default is TRUE
         :param image_size: It determine how the data is partitioned into the NxN windows. Default is 32x32
+        :param pad_to_size: It determine if smaller fields are padded to image_size. If FALSE, fields are only cropped to at most image_size
+                            and padding is left to the batch collation, e.g. pad_collate with SizeBucketBatchSampler. Default is TRUE
+        :param pixel_set_size: If given, pixel_set_size pixels are sampled at random from inside the field mask instead of cropping or averaging the field,
+                               for pixel-set models. image_stack is then in size [Time Stamp, Image Dimension (Channel), pixel_set_size], zero padded if the field
+                               has fewer pixels, and the number of valid pixels is returned in place of the mask. By default, no pixels are sampled
         :return: None
         '''
         self.spatial_encoder = spatial_encoder
+        self.pixel_set_size = pixel_set_size
         self.image_size=image_size
         self.normalize=normalize
+        self.pad_to_size=pad_to_size
 
     def transform(self,image_stack, mask=None):
         '''
@@ -34,15 +41,22 @@ class EOTransformer():
         :param mask: It is spatial mask of the image, to filter out uninterested areas. It is not required in case of having non-spatial data
         :return: image_stack, mask
                 '''
-        if self.spatial_encoder == False:  # average over field mask: T, D = image_stack.shape
-            image_stack = image_stack[:, :, mask > 0].mean(2)
+        if self.pixel_set_size is not None:  # random pixels inside the field mask: T, D, S = image_stack.shape
+            image_stack, mask = sample_pixels(image_stack, mask, self.pixel_set_size)
+        elif self.spatial_encoder == False:  # average over field mask: T, D = image_stack.shape
+            if image_stack.ndim == 4:  # skipped if the reader returns precomputed field aggregates
+                image_stack = image_stack[:, :, mask > 0].mean(2)
             mask = -1  # mask is meaningless now but needs to be constant size for batching
         else:  # crop/pad image to fixed size + augmentations: T, D, H, W = image_stack.shape
-            if image_stack.shape[2] >= self.image_size and image_stack.shape[3] >= self.image_size:
-                image_stack, mask = random_crop(image_stack, mask, self.image_size)
+            if not self.pad_to_size:
+                source, _ = _crop_or_pad_slices(image_stack.shape[2:], self.image_size)
+                image_stack, mask = image_stack[(slice(None), slice(None)) + source], mask[source]
+            else:
+                if image_stack.shape[2] >= self.image_size and image_stack.shape[3] >= self.image_size:
+                    image_stack, mask = random_crop(image_stack, mask, self.image_size)
 
 
-            image_stack, mask = crop_or_pad_to_size(image_stack, mask, self.image_size)
+                image_stack, mask = crop_or_pad_to_size(image_stack, mask, self.image_size)
 
             # rotations
             rot = np.random.choice([0, 1, 2, 3])
@@ -66,8 +80,113 @@ class EOTransformer():
             image_stack -= 0.1014 + np.random.normal(scale=0.01)
             image_stack /= 0.1171 + np.random.normal(scale=0.01)
 
+        if self.pixel_set_size is not None:  # padded pixels stay zero
+            image_stack[:, :, mask:] = 0
+
         return torch.from_numpy(np.ascontiguousarray(image_stack)).float(), torch.from_numpy(np.ascontiguousarray(mask))
 
+    def collate(self, batch):
+        '''
+        THIS FUNCTION COLLATES RAW SAMPLES OF A DATA READER (INITIALIZED WITH transform=None) AND TRANSFORMS THEM AS A BATCH.
+        IT CAN BE GIVEN AS collate_fn TO torch.utils.data.DataLoader. EACH SAMPLE IS COPIED ONLY ONCE, INTO THE PREALLOCATED BATCH.
+        THE BATCH MATCHES THE SAMPLES OF transform STACKED BY THE DEFAULT COLLATION: SPATIAL SAMPLES ARE RANDOMLY CROPPED AS IN random_crop AND THEN CENTER CROPPED
+        OR PADDED TO image_size, AS WITH pad_to_size=TRUE, AND THE MASK IS IN SIZE [Batch, Height, Width], OR [Batch, 1] WITHOUT SPATIAL ENCODER OR FOR PIXEL SETS
+        :param batch: list of (image_stack, label, mask, field_id) where image_stack is in size [Time Stamp, Image Dimension (Channel), Height, Width]
+        :return: image_stack, label, mask, field_id as batched tensors
+        '''
+        image_stacks, labels, masks, field_ids = zip(*batch)
+        N = len(image_stacks)
+        T, D = image_stacks[0].shape[:2]
+
+        if self.pixel_set_size is not None:
+            # random pixels of every sample, gathered directly into the batch: N, T, D, S
+            image_stack = np.zeros((N, T, D, self.pixel_set_size), dtype=np.float32)
+            mask = torch.zeros((N, 1), dtype=torch.int64)
+            for i, (sample, sample_mask) in enumerate(zip(image_stacks, masks)):
+                mask[i, 0] = sample_pixels(sample, sample_mask, self.pixel_set_size, out=image_stack[i])[1]
+        elif self.spatial_encoder == False:
+            # masked mean of every sample, written directly into the batch: N, T, D
+            image_stack = np.empty((N, T, D), dtype=np.float32)
+            for i, (sample, mask) in enumerate(zip(image_stacks, masks)):
+                image_stack[i] = sample if sample.ndim == 2 else sample[:, :, mask > 0].mean(2)
+            mask = torch.full((N, 1), -1)
+        else:
+            # random crop, then centered crop or zero padding of every sample into the batch, as in transform: N, T, D, image_size, image_size
+            image_stack = np.zeros((N, T, D, self.image_size, self.image_size), dtype=np.float32)
+            mask = np.zeros((N, self.image_size, self.image_size), dtype=np.float32)
+            for i, (sample, sample_mask) in enumerate(zip(image_stacks, masks)):
+                if sample.shape[2] >= self.image_size and sample.shape[3] >= self.image_size:
+                    sample, sample_mask = random_crop(sample, sample_mask, self.image_size)
+                source, target = _crop_or_pad_slices(sample.shape[2:], self.image_size, random=False)
+                image_stack[(i, slice(None), slice(None)) + target] = sample[(slice(None), slice(None)) + source]
+                mask[(i,) + target] = sample_mask[source]
+            mask = torch.from_numpy(mask)
+
+        image_stack, mask = self.transform_batch(torch.from_numpy(image_stack), mask, crop=False)
+        return image_stack, torch.as_tensor(labels), mask, torch.as_tensor(field_ids)
+
+    def transform_batch(self, image_stack, mask=None, crop=True):
+        '''
+        THIS FUNCTION TRANSFORMS A COLLATED BATCH IN PLACE WHERE POSSIBLE. IT RUNS ON THE DEVICE OF THE GIVEN TENSORS, SO IT CAN BE APPLIED AFTER MOVING THE BATCH TO GPU.
+        :param image_stack: If it is spatial data, it is a tensor in size [Batch, Time Stamp, Image Dimension (Channel), Height, Width],
+                            If it is not spatial data, it is in size [Batch, Time Stamp, Image Dimension (Channel)]
+        :param mask: spatial masks of the batch in size [Batch, Height, Width], or the number of valid pixels in size [Batch, 1] for pixel sets
+        :param crop: It determines if the batch is to be cropped or padded to image_size. It can be skipped if the batch already has the size.
+        :return: image_stack, mask
+        '''
+        N = image_stack.shape[0]
+        device = image_stack.device
+        if not image_stack.is_floating_point():
+            image_stack = image_stack.float()
+
+        if self.pixel_set_size is not None:
+            pass  # pixel sets are unordered, so they need no spatial augmentation
+        elif self.spatial_encoder == False:
+            if image_stack.dim() == 5:  # average over field masks: N, T, D
+                weights = (mask > 0).to(image_stack.dtype)
+                image_stack = torch.einsum("ntdhw,nhw->ntd", image_stack, weights) / weights.sum((1, 2)).view(N, 1, 1)
+                mask = torch.full((N, 1), -1, device=device)
+        else:
+            if crop and image_stack.shape[3:] != (self.image_size, self.image_size):
+                source, target = _crop_or_pad_slices(image_stack.shape[3:], self.image_size)
+                cropped = image_stack.new_zeros(image_stack.shape[:3] + (self.image_size, self.image_size))
+                cropped[(slice(None),) * 3 + target] = image_stack[(slice(None),) * 3 + source]
+                cropped_mask = mask.new_zeros((N, self.image_size, self.image_size))
+                cropped_mask[(slice(None),) + target] = mask[(slice(None),) + source]
+                image_stack, mask = cropped, cropped_mask
+
+            # rotations and spatial flips: every sample gets one of the 8 dihedral transforms, applied per group of samples
+            rot = torch.randint(0, 4, (N,))
+            flip = torch.randint(0, 2, (N,))
+            for r in range(4):
+                for f in range(2):
+                    if r == 0 and f == 0:
+                        continue
+                    index = ((rot == r) & (flip == f)).nonzero().flatten().to(device)
+                    if len(index) == 0:
+                        continue
+                    group, group_mask = image_stack.index_select(0, index), mask.index_select(0, index)
+                    if f == 1:
+                        group, group_mask = group.flip(3), group_mask.flip(1)
+                    image_stack[index] = group.rot90(r, [3, 4])
+                    mask[index] = group_mask.rot90(r, [1, 2])
+
+        # scaling and z-normalization fused into a single in-place multiply-add per sample
+        shape = (N,) + (1,) * (image_stack.dim() - 1)
+        scale = torch.full(shape, 1e-4, device=device)
+        offset = torch.zeros(shape, device=device)
+        if self.normalize:
+            mean = 0.1014 + torch.randn(shape, device=device) * 0.01
+            std = 0.1171 + torch.randn(shape, device=device) * 0.01
+            scale, offset = scale / std, mean / std
+        image_stack = image_stack.mul_(scale).sub_(offset)
+
+        if self.pixel_set_size is not None:  # padded pixels stay zero, mask holds the number of valid pixels
+            valid = torch.arange(image_stack.shape[-1], device=device).view(1, -1) < mask.to(device).view(N, 1)
+            image_stack = image_stack.mul_(valid.view(N, 1, 1, -1))
+
+        return image_stack, mask
+
 class PlanetTransform(EOTransformer):
     """
     THIS CLASS INHERITS EOTRANSFORMER FOR DATA AUGMENTATION IN THE PLANET DATA
@@ -86,6 +205,30 @@ class Sentinel2Transform(EOTransformer):
     """
     pass #TODO: some advanced approach special to Planet Data might be implemented
 
+def sample_pixels(image_stack, mask, size, out=None):
+    '''
+    THIS FUNCTION SAMPLES RANDOM PIXELS FROM INSIDE THE FIELD MASK WITH A SINGLE VECTORIZED GATHER, SO THAT ONLY THE SAMPLED PIXELS ARE COPIED.
+    FIELDS WITH FEWER PIXELS THAN size ARE TAKEN COMPLETELY AND ZERO PADDED.
+    :param image_stack: input image in size [Time Stamp, Image Dimension (Channel), Height, Width]
+    :param mask: input mask of the image, to filter out uninterested areas [Height, Width]
+    :param size: number of pixels to sample
+    :param out: optional array in size [Time Stamp, Image Dimension (Channel), size] to gather the pixels into
+    :return: pixels in size [Time Stamp, Image Dimension (Channel), size], number of valid pixels
+    '''
+    assert image_stack.ndim == 4, "WARNING: pixel sets require the whole field, not precomputed field aggregates"
+    rows, cols = np.nonzero(np.asarray(mask) > 0)
+    count = min(len(rows), size)
+    if len(rows) > size:
+        selected = np.random.choice(len(rows), size, replace=False)
+        rows, cols = rows[selected], cols[selected]
+    if out is None:
+        out = np.zeros(image_stack.shape[:2] + (size,), dtype=np.float32)
+    else:
+        out[:, :, count:] = 0
+    out[:, :, :count] = image_stack[:, :, rows, cols]
+    return out, count
+
+
 def random_crop(image_stack, mask, image_size):
     '''
     THIS FUNCTION DEFINES RANDOM IMAGE CROPPING.
@@ -149,3 +292,23 @@ def crop_or_pad_to_size(image_stack,  mask, image_size):
         image_stack = np.pad(image_stack, ((0, 0), (0, 0), (0, 0), padding))
         mask = np.pad(mask, ((0, 0), padding))
     return image_stack, mask
+
+def _crop_or_pad_slices(shape, image_size, random=True):
+    '''
+    THIS FUNCTION DETERMINES THE SOURCE AND TARGET SLICES TO CROP OR CENTER PAD AN IMAGE TO THE GIVEN SIZE.
+    :param shape: (Height, Width) of the input image
+    :param image_size: It determine how the data is cropped or padded into the NxN windows.
+    :param random: If TRUE, larger images are cropped at a random position, otherwise centered as in crop_or_pad_to_size
+    :return: source slices, target slices
+    '''
+    source, target = [], []
+    for size in shape:
+        if size > image_size:
+            start = np.random.randint(0, size - image_size + 1) if random else (size - image_size) // 2
+            source.append(slice(start, start + image_size))
+            target.append(slice(0, image_size))
+        else:
+            start = (image_size - size) // 2
+            source.append(slice(0, size))
+            target.append(slice(start, start + size))
+    return tuple(source), tuple(target)
@@ -0,0 +1,78 @@
+"""
+ABOUT SCRIPT:
+It defines a cache of per-field temporal aggregates (mean, std, percentiles over the field pixels) for non-spatial models
+"""
+
+import os
+import json
+import numpy as np
+from tqdm import tqdm
+from .setup_manifest import manifest_signature
+
+SUPPORTED_AGGREGATES = ["mean", "std", "median", "p10", "p25", "p75", "p90"]
+AGGREGATES_FILE = "field_aggregates.npy"
+AGGREGATES_INFO_FILE = "field_aggregates.json"
+
+
+def aggregate_field(image_stack, mask, aggregates=("mean",)):
+    '''
+    THIS FUNCTION AGGREGATES THE PIXELS INSIDE A FIELD MASK FOR EACH TIME STAMP AND CHANNEL.
+    :param image_stack: field data in size [Time Stamp, Image Dimension (Channel), Height, Width]
+    :param mask: spatial mask of the field in size [Height, Width]
+    :param aggregates: list of aggregates from SUPPORTED_AGGREGATES
+    :return: aggregates concatenated over the channels in size [Time Stamp, Number of Aggregates x Image Dimension (Channel)]
+    '''
+    pixels = image_stack[:, :, mask > 0]
+    features = []
+    for aggregate in aggregates:
+        if aggregate == "mean":
+            features.append(pixels.mean(2))
+        elif aggregate == "std":
+            features.append(pixels.std(2))
+        elif aggregate == "median":
+            features.append(np.median(pixels, 2))
+        else:
+            features.append(np.percentile(pixels, int(aggregate[1:]), 2))
+    return np.concatenate(features, axis=1).astype(np.float32)
+
+
+def open_or_build_aggregates(npyfolder, fids, load_field, aggregates=("mean",)):
+    '''
+    THIS FUNCTION OPENS THE AGGREGATE CACHE OF A TILE AS A MEMORY-MAPPED ARRAY, OR BUILDS IT IF IT IS MISSING OR OUTDATED.
+    :param npyfolder: folder of the extracted field data
+    :param fids: field ids in the order of the reader labels
+    :param load_field: function returning image_stack, mask for a given (position, fid)
+    :param aggregates: list of aggregates from SUPPORTED_AGGREGATES
+    :return: read-only array in size [Number of Fields, Time Stamp, Number of Aggregates x Image Dimension (Channel)]
+    '''
+    aggregates = list(aggregates)
+    for aggregate in aggregates:
+        assert aggregate in SUPPORTED_AGGREGATES, f"aggregate must be one of {SUPPORTED_AGGREGATES}"
+
+    fids = [int(fid) for fid in fids]
+    assert len(fids) > 0, "WARNING: no fields to aggregate in {}".format(npyfolder)
+    array_file = os.path.join(npyfolder, AGGREGATES_FILE)
+    info_file = os.path.join(npyfolder, AGGREGATES_INFO_FILE)
+    setup = manifest_signature(npyfolder)  # fields re-extracted since the last build are detected by their setup manifest
+    if os.path.exists(array_file) and os.path.exists(info_file):
+        with open(info_file, "r") as f:
+            info = json.load(f)
+        if info["aggregates"] == aggregates and info["fids"] == fids and info.get("setup") == setup:
+            return np.load(array_file, mmap_mode="r")
+        print("INFO: Field aggregates {} do not match the reader, they are rebuilt".format(array_file))
+
+    array = None
+    for position, fid in enumerate(tqdm(fids, position=0, leave=True, desc="INFO: Aggregating time series into the file: {}".format(array_file))):
+        image_stack, mask = load_field(position, fid)
+        features = aggregate_field(image_stack, mask, aggregates)
+        if array is None:
+            # written to disk field by field, so the tile never has to fit into memory
+            array = np.lib.format.open_memmap(array_file + ".tmp", mode="w+", dtype=np.float32, shape=(len(fids),) + features.shape)
+        array[position] = features
+    array.flush()
+    del array
+    os.replace(array_file + ".tmp", array_file)
+
+    with open(info_file, "w") as f:
+        json.dump(dict(aggregates=aggregates, fids=fids, setup=setup), f)
+    return np.load(array_file, mmap_mode="r")
@@ -0,0 +1,144 @@
+"""
+ABOUT SCRIPT:
+It defines vectorized helper functions to crop the crop fields out of Sentinel-1 and Sentinel-2 tiles
+"""
+
+import sys
+import numpy as np
+
+SUPPORTED_FIELD_DTYPES = ["float32", "native", "float16"]
+
+
+def field_windows(bounds, transform):
+    '''
+    THIS FUNCTION COMPUTES THE PIXEL WINDOWS OF ALL FIELDS IN ONE VECTORIZED PASS, IN LINE WITH rasterio.windows.from_bounds AND ROUNDING OF THE READERS.
+    WINDOWS OF FIELDS CROSSING THE TILE ORIGIN ARE CLIPPED TO IT.
+    :param bounds: array-like in size of [Number of Fields, 4] holding left, bottom, right, top of each field, e.g. labels.geometry.bounds
+    :param transform: affine transform of the tile
+    :return: row_start, row_end, col_start, col_end as integer arrays
+    '''
+    left, bottom, right, top = np.asarray(bounds, dtype=np.float64).T
+    inverse = ~transform
+
+    # pixel coordinates of the four corners of each field bounding box
+    xs = np.stack([left, right, right, left])
+    ys = np.stack([top, top, bottom, bottom])
+    cols = inverse.a * xs + inverse.b * ys + inverse.c
+    rows = inverse.d * xs + inverse.e * ys + inverse.f
+
+    row_off, col_off = rows.min(0), cols.min(0)
+    height = np.maximum(rows.max(0) - row_off, 0.0)
+    width = np.maximum(cols.max(0) - col_off, 0.0)
+
+    row_start = np.round(row_off).astype(np.int64)
+    col_start = np.round(col_off).astype(np.int64)
+    row_end = row_start + np.round(height).astype(np.int64)
+    col_end = col_start + np.round(width).astype(np.int64)
+    return np.maximum(row_start, 0), np.maximum(row_end, 0), np.maximum(col_start, 0), np.maximum(col_end, 0)
+
+
+def field_dtypes(field_dtype, source_dtype):
+    '''
+    THIS FUNCTION DETERMINES THE ON-DISK DTYPES OF THE EXTRACTED FIELDS.
+    :param field_dtype: "float32" stores the bands and the mask as float32 as the readers always did,
+                        "native" keeps the bands in the dtype of the source arrays (e.g. uint16 reflectances) and the mask as uint8, which is lossless,
+                        "float16" stores the bands as float16 and the mask as uint8, which halves float32 sources at a precision of about 3 significant digits.
+                        It is limited to floating point sources, e.g. Sentinel-1 backscatter, as integer sources such as uint16 Sentinel-2 reflectances
+                        lose precision above 2048 and overflow above 65504. "native" stores those at the same size without any loss
+    :param source_dtype: dtype of the source bands
+    :return: dtype of the bands, dtype of the mask
+    '''
+    assert field_dtype in SUPPORTED_FIELD_DTYPES, f"field_dtype must be one of {SUPPORTED_FIELD_DTYPES}"
+    assert field_dtype != "float16" or np.issubdtype(source_dtype, np.floating), \
+        "WARNING: field_dtype=\"float16\" does not hold {} sources exactly, please use field_dtype=\"native\"".format(np.dtype(source_dtype))
+    if field_dtype == "float32":
+        return np.dtype(np.float32), np.dtype(np.float32)
+    if field_dtype == "native":
+        return np.dtype(source_dtype), np.dtype(np.uint8)
+    return np.dtype(np.float16), np.dtype(np.uint8)
+
+
+def cast_field(array, dtype):
+    '''
+    THIS FUNCTION CASTS AN EXTRACTED FIELD ARRAY TO ITS ON-DISK DTYPE. A float16 CAST IS ONLY DONE IF THE VALUES ARE WITHIN THE float16 RANGE.
+    :param array: field array, e.g. image_stack
+    :param dtype: on-disk dtype as returned by field_dtypes
+    :return: array in the given dtype
+    '''
+    if np.dtype(dtype) == np.float16 and array.size > 0:
+        peak = np.nanmax(np.abs(array))
+        assert not peak > np.finfo(np.float16).max, "WARNING: values up to {} overflow float16, please use field_dtype=\"float32\"".format(peak)
+    return array.astype(dtype)
+
+
+def field_folder(npyfolder, field_dtype):
+    '''
+    THIS FUNCTION RETURNS THE FOLDER OF THE EXTRACTED FIELDS. COMPACT FIELDS ARE KEPT APART FROM THE float32 FIELDS, SO THAT NEITHER IS MIXED UP WITH THE OTHER.
+    :param npyfolder: folder of the float32 fields
+    :param field_dtype: one of SUPPORTED_FIELD_DTYPES
+    :return: folder
+    '''
+    assert field_dtype in SUPPORTED_FIELD_DTYPES, f"field_dtype must be one of {SUPPORTED_FIELD_DTYPES}"
+    if field_dtype == "float32":
+        return npyfolder
+    return npyfolder.rstrip("/") + "_" + field_dtype
+
+
+def extract_fields(cubes, fid_mask, fids, windows, positions=None, row_offset=0):
+    '''
+    THIS FUNCTION CROPS THE GIVEN FIELDS OUT OF THE TILE WITHOUT MODIFYING THE SHARED FIELD ID RASTER.
+    :param cubes: list of tile arrays in size of [Time Stamp, Image Dimension (Channel), Height, Width]
+    :param fid_mask: rasterized field ids of the tile in size of [Height, Width]
+    :param fids: field ids of all fields
+    :param windows: row_start, row_end, col_start, col_end of all fields as returned by field_windows
+    :param positions: positions of the fields to be cropped. By default, all fields are cropped
+    :param row_offset: first tile row covered by the cubes, if the cubes only hold a spatial chunk of the tile. fid_mask always covers the whole tile
+    :return: generator of (position, list of cropped cubes, binary field mask)
+    '''
+    row_start, row_end, col_start, col_end = windows
+    if positions is None:
+        positions = range(len(fids))
+
+    for position in positions:
+        rows = slice(row_start[position], row_end[position])
+        cols = slice(col_start[position], col_end[position])
+        chunk_rows = slice(row_start[position] - row_offset, row_end[position] - row_offset)
+        # comparison creates a new binary mask, so neighbouring fields in the raster are never overwritten
+        mask = fid_mask[rows, cols] == fids[position]
+        yield position, [cube[:, :, chunk_rows, cols] for cube in cubes], mask
+
+
+def spatial_chunks(windows, positions, chunk_rows=None):
+    '''
+    THIS FUNCTION GROUPS THE FIELDS INTO HORIZONTAL BANDS OF THE TILE, SO THAT ONLY ONE BAND HAS TO BE KEPT IN MEMORY AT A TIME.
+    A BAND IS EXTENDED BEYOND chunk_rows ONLY IF A SINGLE FIELD IS TALLER THAN chunk_rows.
+    :param windows: row_start, row_end, col_start, col_end of all fields as returned by field_windows
+    :param positions: positions of the fields to be grouped
+    :param chunk_rows: maximum number of tile rows in a band. If None, all fields are grouped into one band
+    :return: generator of (first row, last row + 1, positions of the fields in the band)
+    '''
+    row_start, row_end = windows[0], windows[1]
+    chunk, first, last = [], 0, 0
+    for position in sorted(positions, key=lambda position: row_start[position]):
+        if len(chunk) > 0 and chunk_rows is not None and max(last, row_end[position]) - first > chunk_rows:
+            yield first, last, chunk
+            chunk = []
+        if len(chunk) == 0:
+            first, last = row_start[position], row_end[position]
+        chunk.append(position)
+        last = max(last, row_end[position])
+    if len(chunk) > 0:
+        yield first, last, chunk
+
+
+def peak_memory_mb():
+    """
+    THIS FUNCTION RETURNS THE PEAK RESIDENT MEMORY OF THE CURRENT PROCESS IN MB, OR None IF IT IS NOT AVAILABLE ON THE PLATFORM
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    scale = 1024 ** 2 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
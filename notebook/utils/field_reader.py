@@ -0,0 +1,237 @@
+"""
+ABOUT SCRIPT:
+It defines the field-wise data access shared by the Planet, Sentinel-1 and Sentinel-2 data readers
+"""
+
+import os
+import zipfile
+import numpy as np
+from torch.utils.data import Dataset
+from .field_store import FieldStore
+from .field_aggregates import open_or_build_aggregates
+from .profiler import timed
+from .time_index import resolve_time_points
+from .shared_cache import SharedFieldCache
+
+SUPPORTED_STORAGES = ["npz", "memmap"]
+
+
+class FieldReader(Dataset):
+    """
+    THIS CLASS DEFINES THE COMMON FIELD-WISE READING LOGIC. THE INHERITING READERS SET data_transform, selected_time_points, crop_ids, npyfolder, labels
+    AND dates (ACQUISITION DATES OF THE TIME STAMPS AS numpy datetime64 ARRAY, OR None IF THEY ARE UNKNOWN)
+    """
+    read_dtype = None  # dtype the stored fields are cast to while reading, e.g. float32 for compact on-disk dtypes
+    cache = None
+
+
+    def _init_label_arrays(self):
+        '''
+        THIS FUNCTION PRECOMPUTES COMPACT ARRAYS OF THE LABELS, SO THAT NEITHER __getitem__ NOR SAMPLERS AND METRICS HAVE TO TOUCH THE PANDAS LABELS:
+        fids: field id of each field
+        field_crop_ids: crop id of each field as given in the GeoJSON data
+        targets: label index of each field, i.e. the position of its crop id in crop_ids if crop_ids is given, otherwise the crop id itself
+        field_centroids: x, y coordinates of the centroid of each field in the coordinate reference system of the tile, or None if they are unknown
+        :return: None
+        '''
+        self.fids = np.asarray(self.labels.fid.values, dtype=np.int64)
+        if "crop_id" in self.labels.columns:
+            self.field_crop_ids = np.asarray(self.labels.crop_id.values, dtype=np.int64)
+        else:  # e.g. test labels without ground-truth
+            self.field_crop_ids = np.full(len(self.fids), -1, dtype=np.int64)
+
+        if "geometry" in self.labels.columns:
+            centroids = self.labels.geometry.centroid
+            self.field_centroids = np.stack([centroids.x.values, centroids.y.values], 1)
+        elif "centroid_x" in self.labels.columns:  # labels loaded from the setup manifest
+            self.field_centroids = np.stack([self.labels.centroid_x.values, self.labels.centroid_y.values], 1).astype(np.float64)
+        else:
+            self.field_centroids = None
+
+        if self.crop_ids is not None:
+            crop_ids = np.asarray(self.crop_ids, dtype=np.int64)
+            sorter = np.argsort(crop_ids)
+            positions = np.clip(np.searchsorted(crop_ids, self.field_crop_ids, sorter=sorter), 0, len(crop_ids) - 1)
+            self.targets = sorter[positions]
+            unknown = (crop_ids[self.targets] != self.field_crop_ids) & (self.field_crop_ids != -1)
+            assert not unknown.any(), "WARNING: crop ids {} are not in label_ids".format(np.unique(self.field_crop_ids[unknown]))
+            self.targets[self.field_crop_ids == -1] = -1
+        else:
+            self.targets = self.field_crop_ids.copy()
+
+    def _init_time_selection(self):
+        '''
+        THIS FUNCTION RESOLVES selected_time_points AGAINST THE ACQUISITION DATES OF THE READER ONCE, SO THAT __getitem__ SELECTS THE TIME STAMPS
+        RIGHT AFTER READING AND ONLY THE SELECTED TIME STAMPS ARE TRANSFORMED. FROM THE FIELD STORE AND THE AGGREGATES, ONLY THEIR PAGES ARE READ.
+        time_index: None, slice or integer array of the selected time stamps, see time_index.resolve_time_points
+        :return: None
+        '''
+        self.time_index = resolve_time_points(self.selected_time_points, self.dates)
+        if self.time_index is not None and self.dates is not None:
+            print("INFO: {}/{} time stamps are selected".format(len(self.dates[self.time_index]), len(self.dates)))
+
+    def _init_storage(self, storage="npz"):
+        '''
+        THIS FUNCTION INITIALIZES THE ON-DISK LAYOUT USED WHILE READING THE FIELDS.
+        :param storage: "npz" reads one fid_<id>.npz file per field,
+                        "memmap" packs all fields of the tile into a contiguous memory-mapped field store and reads zero-copy slices from it
+        :return: None
+        '''
+        assert storage in SUPPORTED_STORAGES, f"storage must be one of {SUPPORTED_STORAGES}"
+        self.storage = storage
+        self.store = None
+        if storage == "memmap":
+            self.store = FieldStore.open_or_build(os.path.join(self.npyfolder, "field_store"), self.npyfolder, self.fids)
+
+    def _init_cache(self, cache_bytes=None):
+        '''
+        THIS FUNCTION INITIALIZES THE SHARED-MEMORY CACHE OF THE DECODED FIELDS.
+        :param cache_bytes: If given, the decoded fields (before the transform) are kept in POSIX shared memory within this byte budget, evicting the least
+                            recently used fields. The cache is shared by all DataLoader workers and kept over the epochs, so after the first epoch reading
+                            a field is a memory copy. By default, the fields are read from the storage every time
+        :return: None
+        '''
+        self.cache = None
+        if cache_bytes is not None:
+            self.cache = SharedFieldCache(len(self.fids), cache_bytes)
+
+    def _init_aggregates(self, aggregates=None):
+        '''
+        THIS FUNCTION INITIALIZES THE PRECOMPUTED FIELD AGGREGATES FOR NON-SPATIAL (TEMPORAL-ONLY) MODELS.
+        :param aggregates: list of aggregates from SUPPORTED_AGGREGATES, e.g. ["mean"] or ["mean", "std"].
+                           If given, __getitem__ returns the cached aggregates in size [Time Stamp, Number of Aggregates x Image Dimension (Channel)]
+                           instead of loading the whole field, and the mask is returned as -1. By default, the fields are loaded as they are.
+        :return: None
+        '''
+        self.aggregates = None
+        if aggregates is not None:
+            self.aggregates = open_or_build_aggregates(self.npyfolder, self.fids, self._load_field, aggregates)
+
+    def open_storage(self):
+        """
+        THIS FUNCTION (RE-)OPENS THE MEMORY MAPS OF THE READER IN THE CURRENT PROCESS, E.G. ONCE IN EACH DATALOADER WORKER
+        """
+        if self.store is not None:
+            self.store.close()
+            self.store.open()
+        if self.aggregates is not None:
+            self.aggregates = np.load(self.aggregates.filename, mmap_mode="r")
+
+    @property
+    def field_shapes(self):
+        '''
+        THIS FUNCTION RETURNS THE SPATIAL EXTENT OF EACH FIELD, E.G. FOR SIZE-BUCKETING BATCH SAMPLERS. IT IS TAKEN FROM THE FIELD STORE INDEX,
+        OR READ ONCE FROM THE MASKS OF THE NPZ FILES AND CACHED IN field_shapes.npz.
+        :return: integer array in size [Number of Fields, 2] holding Height, Width of each field
+        '''
+        if getattr(self, "_field_shapes", None) is None:
+            if self.store is not None:
+                self._field_shapes = self.store.shapes["mask"]
+            else:
+                shapes_file = os.path.join(self.npyfolder, "field_shapes.npz")
+                if os.path.exists(shapes_file):
+                    with np.load(shapes_file) as object:
+                        if np.array_equal(object["fids"], self.fids):
+                            self._field_shapes = object["shapes"]
+                if getattr(self, "_field_shapes", None) is None:
+                    shapes = []
+                    for fid in self.fids:
+                        # only the mask member of the archive is decompressed
+                        with np.load(os.path.join(self.npyfolder, "fid_{}.npz".format(fid))) as object:
+                            shapes.append(object["mask"].shape)
+                    self._field_shapes = np.array(shapes, dtype=np.int64).reshape(-1, 2)
+                    np.savez(shapes_file, fids=self.fids, shapes=self._field_shapes)
+        return self._field_shapes
+
+    def __len__(self):
+        """
+        THIS FUNCTION RETURNS THE LENGTH OF DATASET
+        """
+        return len(self.fids)
+
+    def __getitem__(self, item):
+        """
+        THIS FUNCTION ITERATE OVER THE DATASET BY GIVEN ITEM NO AND RETURNS FOLLOWINGS:
+        :return: image_stack in size of [Time Stamp, Image Dimension (Channel), Height, Width] , crop_label, field_mask in size of [Height, Width], field_id
+        """
+
+        fid = self.fids[item]
+
+        if self.aggregates is not None:
+            with timed("load"):
+                image_stack, mask = self.aggregates[item], -1
+        else:
+            image_stack, mask = self._load_field(item, fid)
+
+        time_index = self._time_index(item)
+        if time_index is not None:
+            with timed("load"):
+                image_stack = image_stack[time_index]
+
+        if self.read_dtype is not None:
+            # compact fields are cast after the time selection, so only the selected time stamps are converted
+            with timed("decode"):
+                image_stack = image_stack.astype(self.read_dtype, copy=False)
+                if self.aggregates is None:
+                    mask = mask.astype(self.read_dtype, copy=False)
+
+        if self.data_transform is not None:
+            with timed("transform"):
+                image_stack, mask = self.data_transform(image_stack, mask)
+
+        return image_stack, self.targets[item], mask, fid
+
+    def _time_index(self, item):
+        """
+        THIS FUNCTION RETURNS THE TIME STAMPS READ FOR A FIELD. READERS CAN OVERRIDE IT TO SELECT THE TIME STAMPS FIELD BY FIELD
+        :param item: position of the field in the labels
+        :return: None, slice or integer array
+        """
+        return self.time_index
+
+    def _load_field(self, item, fid):
+        """
+        THIS FUNCTION LOADS THE IMAGE STACK AND THE MASK OF A FIELD FROM THE SHARED CACHE OR FROM THE STORAGE
+        :param item: position of the field in the labels
+        :param fid: field id
+        :return: image_stack, mask
+        """
+        if self.cache is not None:
+            with timed("cache"):
+                field = self.cache.get(item)
+            if field is not None:
+                return field
+
+        image_stack, mask = self._read_field(item, fid)
+        if self.cache is not None:
+            with timed("cache"):
+                self.cache.put(item, image_stack, mask)
+        return image_stack, mask
+
+    def _read_field(self, item, fid):
+        """
+        THIS FUNCTION READS THE IMAGE STACK AND THE MASK OF A FIELD FROM THE STORAGE
+        :param item: position of the field in the labels
+        :param fid: field id
+        :return: image_stack, mask
+        """
+        if self.store is not None:
+            with timed("load"):
+                return self.store.read(item, "image_stack"), self.store.read(item, "mask")
+
+        npyfile = os.path.join(self.npyfolder, "fid_{}.npz".format(fid))
+        if os.path.exists(npyfile): # use saved numpy array if already created
+            try:
+                with timed("load"):
+                    object = np.load(npyfile)
+                with timed("decode"):
+                    image_stack = object["image_stack"]
+                    mask = object["mask"]
+            except zipfile.BadZipFile:
+                print("ERROR: {} is a bad zipfile...".format(npyfile))
+                raise
+        else:
+            print("ERROR: {} is a missing...".format(npyfile))
+            raise
+
+        return image_stack, mask
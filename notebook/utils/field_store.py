@@ -0,0 +1,154 @@
+"""
+ABOUT SCRIPT:
+It defines a contiguous memory-mapped store for the field-wise time series of a tile
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+from tqdm import tqdm
+from .setup_manifest import manifest_signature
+
+
+class FieldStore():
+    """
+    THIS CLASS PACKS THE RAGGED FIELD ARRAYS OF A TILE INTO ONE CONTIGUOUS FILE PER ARRAY NAME AND SERVES THEM AS ZERO-COPY MEMORY-MAPPED SLICES
+    """
+    INDEX_FILE = "index.npz"
+
+    def __init__(self, folder):
+        '''
+        THIS FUNCTION OPENS AN EXISTING FIELD STORE.
+        :param folder: folder of the field store written by FieldStore.write
+        :return: None
+        '''
+        self.folder = folder
+        index = np.load(os.path.join(folder, FieldStore.INDEX_FILE))
+        self.fids = index["fids"]
+        self.keys = [str(key) for key in index["keys"]]
+        self.offsets = {key: index["{}_offsets".format(key)] for key in self.keys}
+        self.shapes = {key: index["{}_shapes".format(key)] for key in self.keys}
+        self.dtypes = {key: np.dtype(str(index["{}_dtype".format(key)])) for key in self.keys}
+        self.signature = json.loads(str(index["signature"])) if "signature" in index.files else None
+        self._memmaps = {}
+
+    def __len__(self):
+        """
+        THIS FUNCTION RETURNS THE NUMBER OF FIELDS IN THE STORE
+        """
+        return len(self.fids)
+
+    def __getstate__(self):
+        # memory maps are re-opened lazily in every process (e.g. DataLoader workers) instead of being pickled
+        state = self.__dict__.copy()
+        state["_memmaps"] = {}
+        return state
+
+    def read(self, position, key):
+        '''
+        THIS FUNCTION RETURNS THE ARRAY OF A FIELD AS A ZERO-COPY VIEW INTO THE MEMORY-MAPPED FILE.
+        :param position: position of the field in the store, it is identical to the row order of the labels used while writing
+        :param key: name of the array, e.g. image_stack or mask
+        :return: read-only numpy array
+        '''
+        if key not in self._memmaps:
+            self.open()
+        offset = self.offsets[key][position]
+        shape = tuple(self.shapes[key][position])
+        return self._memmaps[key][offset:offset + int(np.prod(shape))].reshape(shape)
+
+    def open(self):
+        """
+        THIS FUNCTION OPENS THE MEMORY MAPS OF ALL ARRAYS IN THE CURRENT PROCESS
+        """
+        for key in self.keys:
+            self._memmaps[key] = np.memmap(os.path.join(self.folder, "{}.bin".format(key)), dtype=self.dtypes[key], mode="r")
+
+    def close(self):
+        """
+        THIS FUNCTION RELEASES THE MEMORY MAPS OF THE CURRENT PROCESS
+        """
+        self._memmaps = {}
+
+    @staticmethod
+    def exists(folder):
+        """
+        THIS FUNCTION CHECKS IF A COMPLETE FIELD STORE EXISTS IN THE GIVEN FOLDER
+        """
+        return os.path.exists(os.path.join(folder, FieldStore.INDEX_FILE))
+
+    @staticmethod
+    def write(folder, fids, fields, signature=None):
+        '''
+        THIS FUNCTION WRITES THE FIELDS INTO A NEW FIELD STORE. THE STORE IS WRITTEN INTO A TEMPORARY FOLDER AND MOVED TO ITS PLACE WHEN COMPLETED.
+        :param folder: folder of the field store
+        :param fids: field ids in the order of the given fields
+        :param fields: iterable of dictionaries mapping the array names to the arrays of each field
+        :param signature: JSON-serializable description of the source of the fields, e.g. the setup manifest signature, stored in the index
+        :return: FieldStore
+        '''
+        tmpfolder = folder + ".tmp"
+        shutil.rmtree(tmpfolder, ignore_errors=True)
+        os.makedirs(tmpfolder)
+
+        files, offsets, shapes, dtypes, sizes = {}, {}, {}, {}, {}
+        try:
+            for field in fields:
+                for key, array in field.items():
+                    if key not in files:
+                        files[key] = open(os.path.join(tmpfolder, "{}.bin".format(key)), "wb")
+                        offsets[key], shapes[key], dtypes[key], sizes[key] = [], [], array.dtype, 0
+                    assert array.dtype == dtypes[key], "WARNING: array {} has the dtype {}, expected {}".format(key, array.dtype, dtypes[key])
+                    offsets[key].append(sizes[key])
+                    shapes[key].append(array.shape)
+                    sizes[key] += array.size
+                    np.ascontiguousarray(array).tofile(files[key])
+        finally:
+            for file in files.values():
+                file.close()
+
+        index = dict(fids=np.asarray(fids), keys=np.array(list(files.keys())), signature=np.array(json.dumps(signature)))
+        for key in files.keys():
+            assert len(offsets[key]) == len(fids), "WARNING: array {} is not available for every field".format(key)
+            index["{}_offsets".format(key)] = np.array(offsets[key], dtype=np.int64)
+            index["{}_shapes".format(key)] = np.array(shapes[key], dtype=np.int64)
+            index["{}_dtype".format(key)] = np.array(dtypes[key].str)
+        np.savez(os.path.join(tmpfolder, FieldStore.INDEX_FILE), **index)
+
+        shutil.rmtree(folder, ignore_errors=True)
+        os.replace(tmpfolder, folder)
+        return FieldStore(folder)
+
+    @staticmethod
+    def from_npz(folder, npyfolder, fids):
+        '''
+        THIS FUNCTION PACKS THE PER-FIELD NPZ FILES CREATED BY THE READERS INTO A FIELD STORE.
+        :param folder: folder of the field store
+        :param npyfolder: folder of the fid_<id>.npz files
+        :param fids: field ids to be packed, in the order of the reader labels
+        :return: FieldStore
+        '''
+        def fields():
+            for fid in tqdm(fids, position=0, leave=True, desc="INFO: Packing time series into the field store: {}".format(folder)):
+                with np.load(os.path.join(npyfolder, "fid_{}.npz".format(fid))) as object:
+                    yield {key: object[key] for key in object.files if key != "feature"}
+
+        return FieldStore.write(folder, fids, fields(), manifest_signature(npyfolder))
+
+    @staticmethod
+    def open_or_build(folder, npyfolder, fids):
+        '''
+        THIS FUNCTION OPENS THE FIELD STORE IF IT MATCHES THE GIVEN FIELDS AND THE SETUP MANIFEST OF THE NPZ FILES, OTHERWISE IT BUILDS THE STORE FROM THE NPZ FILES.
+        :param folder: folder of the field store
+        :param npyfolder: folder of the fid_<id>.npz files
+        :param fids: field ids in the order of the reader labels
+        :return: FieldStore
+        '''
+        fids = np.asarray(fids)
+        if FieldStore.exists(folder):
+            store = FieldStore(folder)
+            if np.array_equal(store.fids, fids) and store.signature == manifest_signature(npyfolder):
+                return store
+            print("INFO: Field store {} does not match the labels or the extracted fields, it is rebuilt".format(folder))
+        return FieldStore.from_npz(folder, npyfolder, fids)
@@ -0,0 +1,145 @@
+"""
+ABOUT SCRIPT:
+It defines a data reader fusing Planet, Sentinel-1 and Sentinel-2 data of the same fields on a shared calendar
+"""
+
+import os
+import json
+import numpy as np
+from torch.utils.data import Dataset
+from .field_store import FieldStore
+from .time_index import calendar_index
+from .setup_manifest import manifest_signature
+from .profiler import timed
+
+
+class FusedReader(Dataset):
+    """
+    THIS CLASS JOINS THE DATA READERS OF SEVERAL SENSORS BY FIELD ID INTO ONE FIELD STORE, WITH ALL TIME SERIES RESAMPLED ONTO A SHARED CALENDAR
+    """
+    def __init__(self, readers, npyfolder, calendar=None, calendar_step=5, transforms=None):
+        '''
+        THIS FUNCTION INITIALIZES THE FUSED DATA READER.
+        :param readers: dictionary of modality name to data reader, e.g. {"planet": PlanetReader(...), "s1": S1Reader(...), "s2": S2Reader(...)}.
+                        The readers should not have a transform, the labels are taken from the first reader
+        :param npyfolder: folder to save the joint field store
+        :param calendar: dates of the shared calendar as numpy datetime64 array. By default, it spans the dates of all readers with calendar_step days
+        :param calendar_step: number of days between the calendar dates, if calendar is not given. Default is 5 days, as in Planet Fusion data
+        :param transforms: dictionary of modality name to data transformer function, applied while reading.
+                           Compact fields are cast to the read_dtype of their reader before the transform
+        :return: None
+        '''
+        self.modalities = list(readers.keys())
+        self.transforms = transforms if transforms is not None else {}
+        self.read_dtypes = {modality: reader.read_dtype for modality, reader in readers.items()}
+        first = readers[self.modalities[0]]
+
+        # fields available in every modality, in the order of the first reader
+        positions = {modality: {fid: position for position, fid in enumerate(reader.fids)} for modality, reader in readers.items()}
+        common = [position for position, fid in enumerate(first.fids) if all(fid in positions[modality] for modality in self.modalities)]
+        self.fids = first.fids[common]
+        self.targets = first.targets[common]
+        self.field_centroids = first.field_centroids[common] if first.field_centroids is not None else None
+        print("INFO: {}/{} fields are available in all modalities {}".format(len(self.fids), len(first.fids), self.modalities))
+
+        if calendar is None:
+            for modality, reader in readers.items():
+                assert reader.dates is not None, f"WARNING: acquisition dates of {modality} are unknown, please give a calendar"
+            start = min(reader.dates.min() for reader in readers.values())
+            end = max(reader.dates.max() for reader in readers.values())
+            calendar = np.arange(start, end + 1, np.timedelta64(calendar_step, "D"))
+        self.calendar = np.asarray(calendar, dtype="datetime64[D]")
+
+        # time index of each modality on the shared calendar, computed once
+        time_indices = {}
+        for modality, reader in readers.items():
+            if reader.dates is not None:
+                time_indices[modality] = calendar_index(reader.dates, self.calendar)
+            else:
+                time_indices[modality] = None
+                print(f"INFO: acquisition dates of {modality} are unknown, its time series is assumed to be on the calendar already")
+
+        folder = os.path.join(npyfolder, "fused_store")
+        calendar_file = os.path.join(folder, "calendar.npy")
+        sources_file = os.path.join(folder, "fused_sources.json")
+        sources = FusedReader._source_description(readers, positions, self.fids)
+        self.store = None
+        if FieldStore.exists(folder) and os.path.exists(calendar_file) and os.path.exists(sources_file):
+            store = FieldStore(folder)
+            with open(sources_file, "r") as f:
+                stored_sources = json.load(f)
+            if np.array_equal(store.fids, self.fids) and np.array_equal(np.load(calendar_file), self.calendar) and stored_sources == sources \
+                    and set(store.keys) == {"{}_{}".format(modality, key) for modality in self.modalities for key in ["image_stack", "mask"]}:
+                self.store = store
+            else:
+                store.close()
+                print("INFO: Fused store {} does not match the readers, it is rebuilt".format(folder))
+        if self.store is None:
+            def fields():
+                for fid in self.fids:
+                    field = {}
+                    for modality, reader in readers.items():
+                        position = positions[modality][fid]
+                        image_stack, mask = reader._load_field(position, fid)
+                        if time_indices[modality] is not None:
+                            image_stack = image_stack[time_indices[modality]]
+                        field["{}_image_stack".format(modality)] = image_stack
+                        field["{}_mask".format(modality)] = mask
+                    yield field
+
+            self.store = FieldStore.write(folder, self.fids, fields())
+            np.save(calendar_file, self.calendar)
+            with open(sources_file, "w") as f:
+                json.dump(sources, f, indent=2)
+
+    @staticmethod
+    def _source_description(readers, positions, fids):
+        '''
+        THIS FUNCTION DESCRIBES THE FIELD DATA OF EACH READER, SO THAT A FUSED STORE BUILT FROM OTHER FIELD DATA IS DETECTED.
+        :param readers: dictionary of modality name to data reader
+        :param positions: dictionary of modality name to the position of each field id in the reader
+        :param fids: field ids of the fused store
+        :return: dictionary of modality name to its npyfolder, setup manifest, and the dtype, shape and channel count of the first field
+        '''
+        description = {}
+        for modality, reader in readers.items():
+            entry = dict(npyfolder=os.path.abspath(reader.npyfolder), setup=manifest_signature(reader.npyfolder))
+            if len(fids) > 0:
+                image_stack, _ = reader._load_field(positions[modality][fids[0]], fids[0])
+                entry.update(image_dtype=str(image_stack.dtype), image_shape=[int(size) for size in image_stack.shape],
+                             channels=int(image_stack.shape[1]) if image_stack.ndim > 1 else 1)
+            description[modality] = entry
+        return description
+
+    def open_storage(self):
+        """
+        THIS FUNCTION (RE-)OPENS THE MEMORY MAPS OF THE JOINT FIELD STORE IN THE CURRENT PROCESS, E.G. ONCE IN EACH DATALOADER WORKER
+        """
+        self.store.close()
+        self.store.open()
+
+    def __len__(self):
+        """
+        THIS FUNCTION RETURNS THE LENGTH OF DATASET
+        """
+        return len(self.fids)
+
+    def __getitem__(self, item):
+        """
+        THIS FUNCTION RETURNS ALL MODALITIES OF A FIELD FROM A SINGLE STORE:
+        :return: dictionary of image_stack in size of [Calendar Time Stamp, Image Dimension (Channel), Height, Width], crop_label, dictionary of field_mask, field_id
+        """
+        image_stacks, masks = {}, {}
+        for modality in self.modalities:
+            with timed("load"):
+                image_stack = self.store.read(item, "{}_image_stack".format(modality))
+                mask = self.store.read(item, "{}_mask".format(modality))
+            if self.read_dtypes[modality] is not None:
+                with timed("decode"):
+                    image_stack = image_stack.astype(self.read_dtypes[modality], copy=False)
+                    mask = mask.astype(self.read_dtypes[modality], copy=False)
+            if modality in self.transforms:
+                with timed("transform"):
+                    image_stack, mask = self.transforms[modality](image_stack, mask)
+            image_stacks[modality], masks[modality] = image_stack, mask
+        return image_stacks, self.targets[item], masks, self.fids[item]
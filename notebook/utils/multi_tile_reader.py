@@ -0,0 +1,129 @@
+"""
+ABOUT SCRIPT:
+It defines a data reader over many tiles of the same sensor with a single global field index
+"""
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from concurrent.futures import ProcessPoolExecutor
+
+
+class MultiTileReader(Dataset):
+    """
+    THIS CLASS COMBINES THE DATA READERS (PlanetReader, S1Reader OR S2Reader) OF SEVERAL TILES INTO A SINGLE DATASET
+    """
+    def __init__(self, reader_class, tiles, tile_workers=1, **reader_kwargs):
+        '''
+        THIS FUNCTION INITIALIZES THE MULTI-TILE DATA READER.
+        :param reader_class: data reader of the sensor, e.g. PlanetReader, S1Reader or S2Reader
+        :param tiles: list of (input_dir, label_dir) pairs, one per tile
+        :param tile_workers: number of tiles to be set up in parallel processes. The workers only build the field data and setup manifests of the tiles,
+                             the readers are then constructed from the warm caches in this process
+        :param reader_kwargs: further arguments of the data reader, e.g. label_ids, transform, storage="memmap" or num_workers of PlanetReader.
+                              cache_bytes is the budget of all tiles together, each tile reader gets an equal share of it
+        :return: None
+        '''
+        if reader_kwargs.get("cache_bytes") is not None:
+            reader_kwargs["cache_bytes"] = reader_kwargs["cache_bytes"] // max(1, len(tiles))
+
+        if tile_workers > 1 and len(tiles) > 1:
+            build_kwargs = {key: value for key, value in reader_kwargs.items() if key not in ["transform", "cache_bytes"]}
+            with ProcessPoolExecutor(max_workers=min(tile_workers, len(tiles))) as executor:
+                futures = [executor.submit(_build_tile, reader_class, input_dir, label_dir, build_kwargs) for input_dir, label_dir in tiles]
+                for future in futures:
+                    future.result()
+
+        self.readers = [reader_class(input_dir, label_dir, **reader_kwargs) for input_dir, label_dir in tiles]
+
+        # global field index: tile of each field, start of each tile, and the label arrays of all tiles
+        sizes = [len(reader) for reader in self.readers]
+        self.tile_offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        self.tile_ids = np.repeat(np.arange(len(self.readers), dtype=np.int32), sizes)
+        self.fids = np.concatenate([reader.fids for reader in self.readers])
+        self.field_crop_ids = np.concatenate([reader.field_crop_ids for reader in self.readers])
+        self.targets = np.concatenate([reader.targets for reader in self.readers])
+        self.field_centroids = None
+        if all(reader.field_centroids is not None for reader in self.readers):
+            self.field_centroids = np.concatenate([reader.field_centroids for reader in self.readers])
+        print("INFO: {} fields are indexed over {} tiles".format(len(self.fids), len(self.readers)))
+
+    def __len__(self):
+        """
+        THIS FUNCTION RETURNS THE LENGTH OF DATASET
+        """
+        return len(self.tile_ids)
+
+    def __getitem__(self, item):
+        """
+        THIS FUNCTION RETURNS THE ITEM OF THE TILE READER THE GIVEN GLOBAL ITEM NO BELONGS TO
+        :return: image_stack, crop_label, field_mask, field_id
+        """
+        tile = self.tile_ids[item]
+        return self.readers[tile][item - self.tile_offsets[tile]]
+
+    @property
+    def field_shapes(self):
+        """
+        THIS FUNCTION RETURNS THE SPATIAL EXTENT OF EACH FIELD OF ALL TILES
+        """
+        return np.concatenate([reader.field_shapes for reader in self.readers])
+
+
+class TileShardBatchSampler(torch.utils.data.Sampler):
+    """
+    THIS CLASS DEFINES A BATCH SAMPLER WHICH BUILDS EACH BATCH FROM A SINGLE TILE AND ORDERS THE BATCHES, SO THAT EACH DATALOADER WORKER MOSTLY READS FROM THE SAME TILES.
+    IT IS USED BY THE DataLoader FACTORY METHODS WITH tile_sharding=TRUE
+    """
+    def __init__(self, tile_ids, batch_size, num_workers=1, shuffle=True, seed=0):
+        '''
+        THIS FUNCTION INITIALIZES THE BATCH SAMPLER.
+        :param tile_ids: tile of each field, e.g. MultiTileReader.tile_ids
+        :param batch_size: number of fields in each batch
+        :param num_workers: number of DataLoader workers. DataLoader hands the batches to its workers in round robin order
+        :param shuffle: If TRUE, the fields within the tiles, the batches and the tile assignment are shuffled in each epoch
+        :param seed: random seed of the shuffling
+        :return: None
+        '''
+        self.tile_ids = np.asarray(tile_ids)
+        self.batch_size = batch_size
+        self.num_workers = max(1, num_workers)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        random = np.random.RandomState(self.seed + self.epoch)
+        self.epoch += 1
+
+        tiles = np.unique(self.tile_ids)
+        if self.shuffle:
+            random.shuffle(tiles)
+
+        # batches of each tile, tile after tile, are split into contiguous runs of (nearly) equal length, one run per worker.
+        # Runs differ by at most one batch and the longer runs come first, so the round robin below stays aligned with the DataLoader workers until the end
+        batches = []
+        for tile in tiles:
+            indices = np.flatnonzero(self.tile_ids == tile)
+            if self.shuffle:
+                random.shuffle(indices)
+            batches.extend(indices[i:i + self.batch_size].tolist() for i in range(0, len(indices), self.batch_size))
+        run_length, longer_runs = divmod(len(batches), self.num_workers)
+        run_bounds = np.cumsum([0] + [run_length + (worker < longer_runs) for worker in range(self.num_workers)])
+        runs = [batches[start:end] for start, end in zip(run_bounds[:-1], run_bounds[1:])]
+
+        # round robin over the workers, in line with the order DataLoader assigns batches to its workers
+        for step in range(len(runs[0])):
+            for run in runs:
+                if step < len(run):
+                    yield run[step]
+
+    def __len__(self):
+        return int(sum((np.bincount(self.tile_ids)[np.unique(self.tile_ids)] + self.batch_size - 1) // self.batch_size))
+
+
+def _build_tile(reader_class, input_dir, label_dir, reader_kwargs):
+    """
+    THIS FUNCTION BUILDS THE FIELD DATA OF A TILE IN A WORKER PROCESS
+    """
+    return len(reader_class(input_dir, label_dir, **reader_kwargs))
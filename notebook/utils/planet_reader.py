@@ -4,21 +4,24 @@ LAST EDITED:  14.09.2021
 ABOUT SCRIPT:
 It defines a data reader for Planet Fusion eath observation data
 """
-import torch
 import geopandas as gpd
 import rasterio as rio
 from rasterio import features
 import numpy as np
 import os
-import zipfile
 import glob
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
+from .field_reader import FieldReader
+from .time_index import dates_from_paths
+from .setup_manifest import source_signature, load_manifest, write_manifest
 
-class PlanetReader(torch.utils.data.Dataset):
+class PlanetReader(FieldReader):
     """
     THIS CLASS INITIALIZES THE DATA READER FOR PLANET DATA
     """
-    def __init__(self, input_dir, label_dir, label_ids=None, transform=None, min_area_to_ignore = 1000,  selected_time_points=None):
+    def __init__(self, input_dir, label_dir, label_ids=None, transform=None, min_area_to_ignore = 1000,  selected_time_points=None, num_workers=1, storage="npz", aggregates=None, cache_bytes=None):
         '''
         THIS FUNCTION INITIALIZES DATA READER.
         :param input_dir: directory of input images in TIF format
@@ -26,7 +29,13 @@ class PlanetReader(torch.utils.data.Dataset):
         :param label_ids: an array of crop IDs in order. if the crop labels in GeoJSON data is not started from index 0 it can be used. Otherwise it is not required.
         :param transform: data transformer function for the augmentation or data processing
         :param min_area_to_ignore: threshold m2 to eliminate small agricultural fields less than a certain threshold. By default, threshold is 1000 m2
-        :param selected_time_points: If a sub set of the time series will be exploited, it can determine the index of those times in a given time series dataset
+        :param selected_time_points: If a sub set of the time series will be exploited, it can determine the index of those times in a given time series dataset.
+                                     It can also be a slice, a list of dates or a date range as dict(start=, end=, stride=), see time_index.resolve_time_points.
+                                     The time stamps are selected right after reading, before the transform
+        :param num_workers: number of processes to extract the field time series in parallel during the setup. By default, extraction runs in a single process
+        :param storage: on-disk layout of the fields, "npz" for one file per field or "memmap" for a contiguous memory-mapped field store per tile
+        :param aggregates: If given, e.g. ["mean"], per-field aggregates over the field pixels are precomputed once and returned instead of the whole field, for non-spatial models
+        :param cache_bytes: If given, decoded fields are shared by the DataLoader workers in a shared-memory cache of this many bytes with LRU eviction
 
         :return: None
         '''
@@ -38,63 +47,37 @@ class PlanetReader(torch.utils.data.Dataset):
             self.crop_ids=label_ids.tolist()
 
         self.npyfolder = os.path.abspath(input_dir + "time_series")
-        self.labels = PlanetReader._setup(input_dir, label_dir, self.npyfolder, min_area_to_ignore)
-
-
-    def __len__(self):
-        """
-         THIS FUNCTION RETURNS THE LENGTH OF DATASET
-         """
-        return len(self.labels)
-
-    def __getitem__(self, item):
-        """
-        THIS FUNCTION ITERATE OVER THE DATASET BY GIVEN ITEM NO AND RETURNS FOLLOWINGS:
-        :return: image_stack in size of [Time Stamp, Image Dimension (Channel), Height, Width] , crop_label, field_mask in size of [Height, Width], field_id
-        """
-
-        feature = self.labels.iloc[item]
-
-        npyfile = os.path.join(self.npyfolder, "fid_{}.npz".format(feature.fid))
-        if os.path.exists(npyfile): # use saved numpy array if already created
-            try:
-                object = np.load(npyfile)
-                image_stack = object["image_stack"]
-                mask = object["mask"]
-            except zipfile.BadZipFile:
-                print("ERROR: {} is a bad zipfile...".format(npyfile))
-                raise
-        else:
-            print("ERROR: {} is a missing...".format(npyfile))
-            raise
-
-        if self.data_transform is not None:
-            image_stack, mask = self.data_transform(image_stack, mask)
-
-        if self.selected_time_points is not None:
-            image_stack = image_stack[self.selected_time_points]
-
-        if self.crop_ids is not None:
-            label = self.crop_ids.index(feature.crop_id)
-        else:
-            label = feature.crop_id
-
-        return image_stack, label, mask, feature.fid
+        self.labels = PlanetReader._setup(input_dir, label_dir, self.npyfolder, min_area_to_ignore, num_workers)
+        self.dates = dates_from_paths(sorted(glob.glob(input_dir + '/*/*.tif', recursive=True)))
+        self._init_label_arrays()
+        self._init_time_selection()
+        self._init_storage(storage)
+        self._init_aggregates(aggregates)
+        self._init_cache(cache_bytes)
 
 
     @staticmethod
-    def _setup(input_dir, label_dir, npyfolder, min_area_to_ignore=1000):
+    def _setup(input_dir, label_dir, npyfolder, min_area_to_ignore=1000, num_workers=1):
         """
         THIS FUNCTION PREPARES THE PLANET READER BY SPLITTING AND RASTERIZING EACH CROP FIELD AND SAVING INTO SEPERATE FILES FOR SPEED UP THE FURTHER USE OF DATA.
         :param input_dir: directory of input images in TIF format
         :param label_dir: directory of ground-truth polygons in GeoJSON format
         :param npyfolder: folder to save the field data for each field polygon
         :param min_area_to_ignore: threshold m2 to eliminate small agricultural fields less than a certain threshold. By default, threshold is 1000 m2
-        :return: labels of the saved fields
+        :param num_workers: number of processes to extract the field time series in parallel
+        :return: labels of the saved fields, loaded from the setup manifest without geometries if the fields are up to date
         """
 
         inputs = glob.glob(input_dir + '/*/*.tif', recursive=True)
         tifs = sorted(inputs)
+
+        # skip all raster work if the fields were already extracted from the same sources with the same parameters
+        signature = source_signature(tifs + [label_dir], hashed=[label_dir])
+        params = dict(min_area_to_ignore=min_area_to_ignore)
+        labels = load_manifest(npyfolder, signature, params)
+        if labels is not None:
+            return labels
+
         labels = gpd.read_file(label_dir)
 
         # read coordinate system of tifs and project labels to the same coordinate reference system (crs)
@@ -109,33 +92,60 @@ class PlanetReader(torch.utils.data.Dataset):
         labels = labels.loc[mask]
         labels = labels.to_crs(crs) #TODO: CHECK IF REQUIRED
 
-        for index, feature in tqdm(labels.iterrows(), total=len(labels), position=0, leave=True, desc="INFO: Extracting time series into the folder: {}".format(npyfolder)):
-
+        # collect the fields which are not extracted yet, the rasters are only touched by the extraction workers
+        jobs = []
+        for index, feature in labels.iterrows():
             npyfile = os.path.join(npyfolder, "fid_{}.npz".format(feature.fid))
             if not os.path.exists(npyfile):
-
                 left, bottom, right, top = feature.geometry.bounds
                 window = rio.windows.from_bounds(left, bottom, right, top, transform)
+                jobs.append((npyfile, window, feature.geometry, feature.drop("geometry").to_dict()))
+
+        if len(jobs) > 0:
+            os.makedirs(npyfolder, exist_ok=True)
+            num_workers = max(1, min(num_workers, len(jobs)))
+            # a few chunks per worker balances the load while every chunk opens each tif only once
+            num_chunks = 1 if num_workers == 1 else num_workers * 4
+            chunks = [jobs[i::num_chunks] for i in range(num_chunks) if len(jobs[i::num_chunks]) > 0]
+
+            with tqdm(total=len(jobs), position=0, leave=True, desc="INFO: Extracting time series into the folder: {}".format(npyfolder)) as progress:
+                if num_workers == 1:
+                    progress.update(_extract_planet_fields(tifs, chunks[0]))
+                else:
+                    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                        futures = [executor.submit(_extract_planet_fields, tifs, chunk) for chunk in chunks]
+                        for future in as_completed(futures):
+                            progress.update(future.result())
+
+        write_manifest(npyfolder, signature, params, labels)
+        return labels
 
-                # reads each tif in tifs on the bounds of the feature. shape T x D x H x W
-                image_stack = np.stack([rio.open(tif).read(window=window) for tif in tifs])
 
-                with rio.open(tifs[0]) as src:
-                    win_transform = src.window_transform(window)
+def _extract_planet_fields(tifs, jobs):
+    """
+    THIS FUNCTION EXTRACTS THE TIME SERIES OF A GROUP OF FIELDS BY OPENING EACH TIF ONLY ONCE AND READING ALL FIELD WINDOWS FROM IT.
+    :param tifs: sorted list of TIF files, one per time stamp
+    :param jobs: list of (npyfile, window, geometry, feature) tuples describing the fields to be extracted
+    :return: number of extracted fields
+    """
+    with ExitStack() as stack:
+        sources = [stack.enter_context(rio.open(tif)) for tif in tifs]
 
-                out_shape = image_stack[0, 0].shape
-                assert out_shape[0] > 0 and out_shape[1] > 0, "WARNING: fid:{} image stack shape {} is zero in one dimension".format(feature.fid,image_stack.shape)
+        for npyfile, window, geometry, feature in jobs:
 
-                # rasterize polygon to get positions of field within crop
-                mask = features.rasterize(feature.geometry, all_touched=True,transform=win_transform, out_shape=image_stack[0, 0].shape)
+            # reads each tif in tifs on the bounds of the feature. shape T x D x H x W
+            image_stack = np.stack([src.read(window=window) for src in sources])
+            win_transform = sources[0].window_transform(window)
 
-                #mask[mask != feature.fid] = 0
-                #mask[mask == feature.fid] = 1
-                os.makedirs(npyfolder, exist_ok=True)
-                np.savez(npyfile, image_stack=image_stack, mask=mask, feature=feature.drop("geometry").to_dict())
+            out_shape = image_stack[0, 0].shape
+            assert out_shape[0] > 0 and out_shape[1] > 0, "WARNING: fid:{} image stack shape {} is zero in one dimension".format(feature["fid"], image_stack.shape)
 
+            # rasterize polygon to get positions of field within crop
+            mask = features.rasterize(geometry, all_touched=True, transform=win_transform, out_shape=image_stack[0, 0].shape)
 
-        return labels
+            np.savez(npyfile, image_stack=image_stack, mask=mask, feature=feature)
+
+    return len(jobs)
 
 
 if __name__ == '__main__':
@@ -146,5 +156,5 @@ if __name__ == '__main__':
     zippath = "../data/dlr_fusion_competition_germany_train_source_planet_5day"
 
     labelgeojson = "../data/dlr_fusion_competition_germany_train_labels/dlr_fusion_competition_germany_train_labels_33N_18E_242N/labels.geojson"
-    ds = PlanetReader(zippath, labelgeojson, selected_time_points=[2,3,4])
+    ds = PlanetReader(zippath, labelgeojson, selected_time_points=[2,3,4], num_workers=4)
     X,y,m,fid = ds[0]
\ No newline at end of file
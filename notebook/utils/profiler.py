@@ -0,0 +1,180 @@
+"""
+ABOUT SCRIPT:
+It defines an opt-in timing instrumentation of the data reading, transformation, collation and training stages
+"""
+
+import os
+import glob
+import json
+import time
+import atexit
+import threading
+import multiprocessing.util
+from contextlib import contextmanager
+import numpy as np
+import torch
+
+PROFILE_DIR_VARIABLE = "AI4FOOD_PROFILE_DIR"  # inherited by the DataLoader workers, so they record into the same folder
+FLUSH_EVERY = 256
+
+_events = []
+_events_pid = None
+
+
+def enable_profiling(folder):
+    '''
+    THIS FUNCTION ENABLES THE TIMING INSTRUMENTATION IN THIS PROCESS AND IN ALL PROCESSES STARTED AFTERWARDS, E.G. DATALOADER WORKERS.
+    :param folder: folder where each process writes its timings, previous timings in the folder are removed
+    :return: None
+    '''
+    os.makedirs(folder, exist_ok=True)
+    for events_file in glob.glob(os.path.join(folder, "events_*.jsonl")):
+        os.remove(events_file)
+    os.environ[PROFILE_DIR_VARIABLE] = os.path.abspath(folder)
+    print("INFO: Profiling into {}".format(folder))
+
+
+def disable_profiling():
+    '''
+    THIS FUNCTION WRITES THE PENDING TIMINGS OF THIS PROCESS AND DISABLES THE TIMING INSTRUMENTATION.
+    :return: folder of the timings, or None if profiling was not enabled
+    '''
+    flush()
+    return os.environ.pop(PROFILE_DIR_VARIABLE, None)
+
+
+def profiling_enabled():
+    """
+    THIS FUNCTION CHECKS IF THE TIMING INSTRUMENTATION IS ENABLED
+    """
+    return PROFILE_DIR_VARIABLE in os.environ
+
+
+@contextmanager
+def timed(stage, device=None):
+    '''
+    THIS FUNCTION TIMES THE ENCLOSED BLOCK AS A STAGE, IF PROFILING IS ENABLED. OTHERWISE IT ONLY COSTS A DICTIONARY LOOKUP.
+    :param stage: name of the stage, e.g. load, decode, transform, collate, h2d, forward, backward or optimizer
+    :param device: torch device whose asynchronous kernels are awaited before and after the block, so that GPU stages are timed correctly
+    :return: None
+    '''
+    if PROFILE_DIR_VARIABLE not in os.environ:
+        yield
+        return
+    _synchronize(device)
+    start, begin = time.time(), time.perf_counter()
+    try:
+        yield
+    finally:
+        _synchronize(device)
+        record(stage, start, time.perf_counter() - begin)
+
+
+def profiled(stage, function, *args, **kwargs):
+    '''
+    THIS FUNCTION CALLS A FUNCTION AND TIMES IT AS A STAGE. partial(profiled, stage, function) CAN REPLACE THE FUNCTION IN DATALOADER WORKERS,
+    E.G. AS collate_fn.
+    :param stage: name of the stage
+    :param function: function to be called with the remaining arguments
+    :return: result of the function
+    '''
+    with timed(stage):
+        return function(*args, **kwargs)
+
+
+def record(stage, start, duration):
+    '''
+    THIS FUNCTION RECORDS THE TIMING OF A STAGE IN THIS PROCESS.
+    :param stage: name of the stage
+    :param start: start time in seconds since the epoch
+    :param duration: duration in seconds
+    :return: None
+    '''
+    global _events, _events_pid
+    if _events_pid != os.getpid():  # first event of a (forked) process: inherited events belong to the parent
+        _events, _events_pid = [], os.getpid()
+        atexit.register(flush)
+        # DataLoader workers leave through os._exit, which only runs the multiprocessing finalizers
+        multiprocessing.util.Finalize(None, flush, exitpriority=100)
+    _events.append((stage, start, duration, threading.get_ident()))
+    if len(_events) >= FLUSH_EVERY:
+        flush()
+
+
+def flush():
+    '''
+    THIS FUNCTION APPENDS THE PENDING TIMINGS OF THIS PROCESS TO ITS EVENTS FILE.
+    :return: None
+    '''
+    global _events
+    folder = os.environ.get(PROFILE_DIR_VARIABLE)
+    if folder is None or _events_pid != os.getpid() or len(_events) == 0:
+        return
+    with open(os.path.join(folder, "events_{}.jsonl".format(os.getpid())), "a") as f:
+        for stage, start, duration, thread in _events:
+            f.write(json.dumps(dict(stage=stage, start=start, duration=duration, pid=_events_pid, tid=thread)) + "\n")
+    _events = []
+
+
+def load_events(folder):
+    '''
+    THIS FUNCTION LOADS THE TIMINGS OF ALL PROCESSES, E.G. OF THE MAIN PROCESS AND ALL DATALOADER WORKERS.
+    :param folder: folder of the timings given to enable_profiling
+    :return: list of dictionaries with stage, start, duration, pid and tid
+    '''
+    flush()
+    events = []
+    for events_file in sorted(glob.glob(os.path.join(folder, "events_*.jsonl"))):
+        with open(events_file, "r") as f:
+            events.extend(json.loads(line) for line in f if line.strip())
+    return events
+
+
+def profile_summary(folder, print_table=True):
+    '''
+    THIS FUNCTION AGGREGATES THE TIMINGS OF ALL PROCESSES BY STAGE.
+    :param folder: folder of the timings given to enable_profiling
+    :param print_table: If TRUE, the summary is printed as a table
+    :return: dictionary of stage to count, total, mean, p50 and p95 durations in seconds, and the number of processes which recorded the stage
+    '''
+    events = load_events(folder)
+    summary = {}
+    for stage in sorted(set(event["stage"] for event in events)):
+        durations = np.array([event["duration"] for event in events if event["stage"] == stage])
+        summary[stage] = dict(count=len(durations), total=float(durations.sum()), mean=float(durations.mean()),
+                              p50=float(np.percentile(durations, 50)), p95=float(np.percentile(durations, 95)),
+                              processes=len(set(event["pid"] for event in events if event["stage"] == stage)))
+
+    if print_table:
+        total = sum(stats["total"] for stats in summary.values())
+        print("{:<12}{:>10}{:>12}{:>8}{:>12}{:>12}{:>12}{:>11}".format("stage", "count", "total [s]", "share", "mean [ms]", "p50 [ms]", "p95 [ms]", "processes"))
+        for stage, stats in sorted(summary.items(), key=lambda item: -item[1]["total"]):
+            print("{:<12}{:>10}{:>12.2f}{:>7.0f}%{:>12.2f}{:>12.2f}{:>12.2f}{:>11}".format(
+                stage, stats["count"], stats["total"], 100 * stats["total"] / max(total, 1e-9), 1e3 * stats["mean"],
+                1e3 * stats["p50"], 1e3 * stats["p95"], stats["processes"]))
+    return summary
+
+
+def export_chrome_trace(folder, output_file):
+    '''
+    THIS FUNCTION EXPORTS THE TIMINGS OF ALL PROCESSES AS A CHROME TRACE, TO BE OPENED IN chrome://tracing OR https://ui.perfetto.dev
+    :param folder: folder of the timings given to enable_profiling
+    :param output_file: path of the trace JSON file
+    :return: number of exported events
+    '''
+    events = load_events(folder)
+    origin = min((event["start"] for event in events), default=0.0)
+    trace = [dict(name=event["stage"], ph="X", ts=1e6 * (event["start"] - origin), dur=1e6 * event["duration"], pid=event["pid"], tid=event["tid"])
+             for event in events]
+    with open(output_file, "w") as f:
+        json.dump(dict(traceEvents=trace, displayTimeUnit="ms"), f)
+    print("INFO: {} events are exported into {}".format(len(trace), output_file))
+    return len(trace)
+
+
+def _synchronize(device):
+    """
+    THIS FUNCTION WAITS FOR THE KERNELS OF A CUDA DEVICE
+    """
+    if device is not None and torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
@@ -6,8 +6,6 @@ It defines a data reader for Sentinel-1 eath observation data
 """
 
 import os
-from torch.utils.data import Dataset
-import zipfile
 import tarfile
 from sh import gunzip
 from glob import glob
@@ -17,13 +15,17 @@ import numpy as np
 import rasterio as rio
 from rasterio import features
 from tqdm import tqdm
+from .field_reader import FieldReader
+from .time_index import load_timestamps
+from .setup_manifest import source_signature, load_manifest, write_manifest
+from .field_extraction import field_windows, field_dtypes, cast_field, field_folder, extract_fields, spatial_chunks, peak_memory_mb
 
 
-class S1Reader(Dataset):
+class S1Reader(FieldReader):
     """
     THIS CLASS INITIALIZES THE DATA READER FOR SENTINEL-1 DATA
     """
-    def __init__(self, input_dir, label_dir, label_ids=None, transform=None, min_area_to_ignore = 1000, selected_time_points=None):
+    def __init__(self, input_dir, label_dir, label_ids=None, transform=None, min_area_to_ignore = 1000, selected_time_points=None, storage="npz", chunk_rows=None, aggregates=None, field_dtype="float32", cache_bytes=None):
         '''
         THIS FUNCTION INITIALIZES DATA READER.
         :param input_dir: directory of input images in zip format
@@ -31,7 +33,16 @@ class S1Reader(Dataset):
         :param label_ids: an array of crop IDs in order. if the crop labels in GeoJSON data is not started from index 0 it can be used. Otherwise it is not required.
         :param transform: data transformer function for the augmentation or data processing
         :param min_area_to_ignore: threshold m2 to eliminate small agricultural fields less than a certain threshold. By default, threshold is 1000 m2
-        :param selected_time_points: If a sub set of the time series will be exploited, it can determine the index of those times in a given time series dataset
+        :param selected_time_points: If a sub set of the time series will be exploited, it can determine the index of those times in a given time series dataset.
+                                     It can also be a slice, a list of dates or a date range as dict(start=, end=, stride=), see time_index.resolve_time_points.
+                                     The time stamps are selected right after reading, before the transform
+        :param storage: on-disk layout of the fields, "npz" for one file per field or "memmap" for a contiguous memory-mapped field store per tile
+        :param chunk_rows: If given, the setup runs in a memory-bounded mode which extracts the fields in horizontal bands of this many tile rows
+        :param field_dtype: on-disk dtype of the extracted fields from SUPPORTED_FIELD_DTYPES. "native" keeps the bands in the dtype of the source arrays and
+                            the mask as uint8, "float16" halves float32 bands (floating point sources within the float16 range only, see field_dtypes). The fields are cast back to float32 while reading, so the returned values are unchanged
+                            (up to the float16 precision). By default, fields are stored as float32
+        :param aggregates: If given, e.g. ["mean"], per-field aggregates over the field pixels are precomputed once and returned instead of the whole field, for non-spatial models
+        :param cache_bytes: If given, decoded fields are shared by the DataLoader workers in a shared-memory cache of this many bytes with LRU eviction
 
         :return: None
         '''
@@ -42,52 +53,18 @@ class S1Reader(Dataset):
         if label_ids is not None and not isinstance(label_ids, list):
             self.crop_ids = label_ids.tolist()
 
-        self.npyfolder = input_dir.replace(".zip", "/time_series")
-        self.labels = S1Reader._setup(input_dir, label_dir,self.npyfolder,min_area_to_ignore)
-
-    def __len__(self):
-        """
-        THIS FUNCTION RETURNS THE LENGTH OF DATASET
-        """
-        return len(self.labels)
-
-    def __getitem__(self, item):
-        """
-        THIS FUNCTION ITERATE OVER THE DATASET BY GIVEN ITEM NO AND RETURNS FOLLOWINGS:
-        :return: image_stack in size of [Time Stamp, Image Dimension (Channel), Height, Width] , crop_label, field_mask in size of [Height, Width], field_id
-        """
-
-        feature = self.labels.iloc[item]
-
-        npyfile = os.path.join(self.npyfolder, "fid_{}.npz".format(feature.fid))
-        if os.path.exists(npyfile): # use saved numpy array if already created
-            try:
-                object = np.load(npyfile)
-                image_stack = object["image_stack"]
-                mask = object["mask"]
-            except zipfile.BadZipFile:
-                print("ERROR: {} is a bad zipfile...".format(npyfile))
-                raise
-        else:
-            print("ERROR: {} is a missing...".format(npyfile))
-            raise
-
-        if self.data_transform is not None:
-            image_stack, mask = self.data_transform(image_stack, mask)
-
-        if self.selected_time_points is not None:
-            image_stack = image_stack[self.selected_time_points]
-
-        if self.crop_ids is not None:
-            label = self.crop_ids.index(feature.crop_id)
-        else:
-            label = feature.crop_id
-
-        return image_stack, label, mask, feature.fid
-
+        self.npyfolder = field_folder(input_dir.replace(".zip", "/time_series"), field_dtype)
+        self.read_dtype = np.float32 if field_dtype != "float32" else None
+        self.labels = S1Reader._setup(input_dir, label_dir,self.npyfolder,min_area_to_ignore, chunk_rows, field_dtype)
+        self.dates = load_timestamps(input_dir)
+        self._init_label_arrays()
+        self._init_time_selection()
+        self._init_storage(storage)
+        self._init_aggregates(aggregates)
+        self._init_cache(cache_bytes)
 
     @staticmethod
-    def _setup(rootpath, labelgeojson, npyfolder, min_area_to_ignore=1000):
+    def _setup(rootpath, labelgeojson, npyfolder, min_area_to_ignore=1000, chunk_rows=None, field_dtype="float32"):
         """
         THIS FUNCTION PREPARES THE PLANET READER BY SPLITTING AND RASTERIZING EACH CROP FIELD AND SAVING INTO SEPERATE FILES FOR SPEED UP THE FURTHER USE OF DATA.
 
@@ -98,9 +75,18 @@ class S1Reader(Dataset):
         :param labelgeojson: directory of ground-truth polygons in GeoJSON format
         :param npyfolder: folder to save the field data for each field polygon
         :param min_area_to_ignore: threshold m2 to eliminate small agricultural fields less than a certain threshold. By default, threshold is 1000 m2
-        :return: labels of the saved fields
+        :param chunk_rows: If given, vv.npy and vh.npy are memory-mapped and the fields are extracted in horizontal bands of this many rows, so that the peak memory is proportional to a band instead of the tile
+        :return: labels of the saved fields, loaded from the setup manifest without geometries if the fields are up to date
         """
 
+        # skip all raster work if the fields were already extracted from the same sources with the same parameters
+        sources = [os.path.join(rootpath, file) for file in ["bbox.pkl", "vv.npy", "vh.npy"]] + [labelgeojson]
+        signature = source_signature(sources, hashed=[labelgeojson])
+        params = dict(min_area_to_ignore=min_area_to_ignore)
+        labels = load_manifest(npyfolder, signature, params)
+        if labels is not None:
+            return labels
+
         with open(os.path.join(rootpath, "bbox.pkl"), 'rb') as f:
             bbox = pickle.load(f)
             crs = str(bbox.crs)
@@ -113,12 +99,12 @@ class S1Reader(Dataset):
         labels = labels.loc[ignore]
         labels = labels.to_crs(crs) #TODO: CHECK IF NECESSARY
 
-        vv = np.load(os.path.join(rootpath, "vv.npy"))
-        vh = np.load(os.path.join(rootpath, "vh.npy"))
-        bands = np.stack([vv[:,:,:,0],vh[:,:,:,0]], axis=3)
-        _, width, height, _ = bands.shape
-
-        bands=bands.transpose(0, 3, 1, 2)
+        # in the memory-bounded mode, the arrays are only memory-mapped and read band by band below
+        mmap_mode = "r" if chunk_rows is not None else None
+        vv = np.load(os.path.join(rootpath, "vv.npy"), mmap_mode=mmap_mode)
+        vh = np.load(os.path.join(rootpath, "vh.npy"), mmap_mode=mmap_mode)
+        _, width, height, _ = vv.shape
+        image_dtype, mask_dtype = field_dtypes(field_dtype, vv.dtype)
 
         transform = rio.transform.from_bounds(minx, miny, maxx, maxy, width, height)
 
@@ -127,32 +113,27 @@ class S1Reader(Dataset):
         assert len(np.unique(fid_mask)) > 0, f"WARNING: Vectorized fid mask contains no fields. " \
                                              f"Does the label geojson {labelgeojson} cover the region defined by {rootpath}?"
 
-        crop_mask = features.rasterize(zip(labels.geometry, labels.crop_id), all_touched=True,
-                                  transform=transform, out_shape=(width, height))
-        assert len(np.unique(crop_mask)) > 0, f"WARNING: Vectorized fid mask contains no fields. " \
-                                              f"Does the label geojson {labelgeojson} cover the region defined by {rootpath}?"
-
-
-        for index, feature in tqdm(labels.iterrows(), total=len(labels), position=0, leave=True, desc="INFO: Extracting time series into the folder: {}".format(npyfolder)):
-
-            npyfile = os.path.join(npyfolder, "fid_{}.npz".format(feature.fid))
-            if not os.path.exists(npyfile):
+        # all field windows are computed in a single vectorized pass over the label bounds
+        fids = labels.fid.values
+        windows = field_windows(labels.geometry.bounds.values, transform)
+        positions = [position for position, fid in enumerate(fids) if not os.path.exists(os.path.join(npyfolder, "fid_{}.npz".format(fid)))]
+        if len(positions) > 0:
+            os.makedirs(npyfolder, exist_ok=True)
 
-                left, bottom, right, top = feature.geometry.bounds
-                window = rio.windows.from_bounds(left, bottom, right, top, transform)
+        with tqdm(total=len(positions), position=0, leave=True, desc="INFO: Extracting time series into the folder: {}".format(npyfolder)) as progress:
+            for first, last, chunk in spatial_chunks(windows, positions, chunk_rows):
+                band_chunk = np.stack([vv[:, first:last, :, 0], vh[:, first:last, :, 0]], axis=3)
+                band_chunk = band_chunk.transpose(0, 3, 1, 2)
 
-                row_start = round(window.row_off)
-                row_end = round(window.row_off) + round(window.height)
-                col_start = round(window.col_off)
-                col_end = round(window.col_off) + round(window.width)
+                for position, (image_stack,), mask in extract_fields([band_chunk], fid_mask, fids, windows, chunk, row_offset=first):
+                    npyfile = os.path.join(npyfolder, "fid_{}.npz".format(fids[position]))
+                    np.savez(npyfile, image_stack=cast_field(image_stack, image_dtype), mask=mask.astype(mask_dtype), feature=labels.iloc[position].drop("geometry").to_dict())
+                    progress.update()
 
-                image_stack = bands[:, :,row_start:row_end, col_start:col_end]
-                mask = fid_mask[row_start:row_end, col_start:col_end]
-                mask[mask != feature.fid] = 0
-                mask[mask == feature.fid] = 1
-                os.makedirs(npyfolder, exist_ok=True)
-                np.savez(npyfile, image_stack=image_stack.astype(np.float32), mask=mask.astype(np.float32), feature=feature.drop("geometry").to_dict())
+        if len(positions) > 0:
+            print("INFO: Peak resident memory after the extraction: {} MB".format(peak_memory_mb()))
 
+        write_manifest(npyfolder, signature, params, labels)
         return labels
 
 
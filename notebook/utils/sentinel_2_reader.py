@@ -7,8 +7,6 @@ It defines a data reader for Sentinel-2 eath observation data
 
 import os
 import torch
-from torch.utils.data import Dataset
-import zipfile
 import tarfile
 from sh import gunzip
 from glob import glob
@@ -18,13 +16,19 @@ import numpy as np
 import rasterio as rio
 from rasterio import features
 from tqdm import tqdm
+from .field_reader import FieldReader
+from .cloud_index import open_or_build_cloud_index, SUPPORTED_CLOUD_MODES
+from .time_index import load_timestamps
+from .setup_manifest import source_signature, load_manifest, write_manifest
+from .field_extraction import field_windows, field_dtypes, cast_field, field_folder, extract_fields, spatial_chunks, peak_memory_mb
 
 
-class S2Reader(Dataset):
+class S2Reader(FieldReader):
     """
     THIS CLASS INITIALIZES THE DATA READER FOR SENTINEL-2 DATA
     """
-    def __init__(self, input_dir, label_dir, label_ids=None, transform=None, min_area_to_ignore = 1000, selected_time_points=None, include_cloud=False):
+    def __init__(self, input_dir, label_dir, label_ids=None, transform=None, min_area_to_ignore = 1000, selected_time_points=None, include_cloud=False, storage="npz", chunk_rows=None, aggregates=None,
+                 max_cloud_fraction=None, cloud_probability=0.5, cloud_mode="drop", sequence_length=None, field_dtype="float32", cache_bytes=None):
         '''
         THIS FUNCTION INITIALIZES DATA READER.
         :param input_dir: directory of input images in zip format
@@ -32,61 +36,115 @@ class S2Reader(Dataset):
         :param label_ids: an array of crop IDs in order. if the crop labels in GeoJSON data is not started from index 0 it can be used. Otherwise it is not required.
         :param transform: data transformer function for the augmentation or data processing
         :param min_area_to_ignore: threshold m2 to eliminate small agricultural fields less than a certain threshold. By default, threshold is 1000 m2
-        :param selected_time_points: If a sub set of the time series will be exploited, it can determine the index of those times in a given time series dataset
+        :param selected_time_points: If a sub set of the time series will be exploited, it can determine the index of those times in a given time series dataset.
+                                     It can also be a slice, a list of dates or a date range as dict(start=, end=, stride=), see time_index.resolve_time_points.
+                                     The time stamps are selected right after reading, before the transform
+        :param include_cloud: It includes cloud probabilities into image_stack if TRUE, othervise it saves the cloud info as sepeate array.
+                              The fields with cloud probabilities are extracted into their own folder, <npyfolder>_cloud
+        :param storage: on-disk layout of the fields, "npz" for one file per field or "memmap" for a contiguous memory-mapped field store per tile
+        :param chunk_rows: If given, the setup runs in a memory-bounded mode which extracts the fields in horizontal bands of this many tile rows
+        :param field_dtype: on-disk dtype of the extracted fields from SUPPORTED_FIELD_DTYPES. "native" keeps the bands in the dtype of the source arrays and
+                            the mask as uint8, "float16" halves float32 bands (floating point sources within the float16 range only, see field_dtypes). The fields are cast back to float32 while reading, so the returned values are unchanged
+                            (up to the float16 precision). By default, fields are stored as float32
+        :param aggregates: If given, e.g. ["mean"], per-field aggregates over the field pixels are precomputed once and returned instead of the whole field, for non-spatial models
+        :param cache_bytes: If given, decoded fields are shared by the DataLoader workers in a shared-memory cache of this many bytes with LRU eviction
+        :param max_cloud_fraction: If given, time stamps where a larger fraction (between 0.0-1.0) of the field is cloudy are dropped or masked.
+                                   The cloud fraction of each field and date is indexed once from the stored cloud_stack
+        :param cloud_probability: probability (between 0.0-1.0) above which a pixel counts as cloudy
+        :param cloud_mode: "drop" reads and transforms only the clear time stamps, up to sequence_length of them,
+                           "mask" keeps all time stamps and sets the cloudy ones to zero after the transform
+        :param sequence_length: required in "drop" mode, so that the fields can be batched. The first sequence_length clear time stamps are returned,
+                                zero padded at the end if there are fewer. The valid time stamps of a field are given by valid_time_points
 
         :return: None
         '''
+        assert cloud_mode in SUPPORTED_CLOUD_MODES, f"cloud_mode must be one of {SUPPORTED_CLOUD_MODES}"
+        assert max_cloud_fraction is None or cloud_mode != "drop" or sequence_length is not None, \
+            "WARNING: cloud_mode=\"drop\" requires a sequence_length, otherwise the fields have different lengths and cannot be batched"
+        self.max_cloud_fraction = max_cloud_fraction
+        self.cloud_mode = cloud_mode
+        self.sequence_length = sequence_length
         self.data_transform = transform
         self.selected_time_points=selected_time_points
         self.crop_ids = label_ids
         if label_ids is not None and not isinstance(label_ids, list):
             self.crop_ids = label_ids.tolist()
 
-        self.npyfolder = input_dir.replace(".zip", "/time_series")
-        self.labels = S2Reader._setup(input_dir, label_dir,self.npyfolder,min_area_to_ignore, include_cloud)
-
-    def __len__(self):
-        """
-        THIS FUNCTION RETURNS THE LENGTH OF DATASET
-        """
-        return len(self.labels)
+        self.npyfolder = field_folder(input_dir.replace(".zip", "/time_series"), field_dtype) + ("_cloud" if include_cloud else "")
+        self.read_dtype = np.float32 if field_dtype != "float32" else None
+        self.labels = S2Reader._setup(input_dir, label_dir,self.npyfolder,min_area_to_ignore, include_cloud, chunk_rows, field_dtype)
+        self.dates = load_timestamps(input_dir)
+        self._init_label_arrays()
+        self._init_time_selection()
+        self._init_storage(storage)
+        self.cloud_fractions = None
+        if max_cloud_fraction is not None:
+            self.cloud_fractions = open_or_build_cloud_index(self.npyfolder, self.fids, self._load_cloud, cloud_probability)
+        self._init_aggregates(aggregates)
+        self._init_cache(cache_bytes)
 
     def __getitem__(self, item):
         """
-        THIS FUNCTION ITERATE OVER THE DATASET BY GIVEN ITEM NO AND RETURNS FOLLOWINGS:
+        THIS FUNCTION RETURNS THE FIELD WITH ITS CLOUDY TIME STAMPS DROPPED OR MASKED, IF max_cloud_fraction IS GIVEN:
         :return: image_stack in size of [Time Stamp, Image Dimension (Channel), Height, Width] , crop_label, field_mask in size of [Height, Width], field_id
         """
+        image_stack, target, mask, fid = super().__getitem__(item)
+        if self.cloud_fractions is not None:
+            _, valid = self.valid_time_points(item)
+            if not valid.all():
+                # cloudy time stamps ("mask" mode) and padding ("drop" mode with sequence_length) are zero after the transform
+                positions = np.flatnonzero(valid).tolist()
+                shape = (len(valid),) + tuple(image_stack.shape[1:])
+                padded = torch.zeros(shape, dtype=image_stack.dtype) if torch.is_tensor(image_stack) else np.zeros(shape, dtype=image_stack.dtype)
+                padded[positions] = image_stack[positions] if len(image_stack) == len(valid) else image_stack
+                image_stack = padded
+        return image_stack, target, mask, fid
+
+    def valid_time_points(self, item):
+        '''
+        THIS FUNCTION RETURNS WHICH TIME STAMPS OF A FIELD ARE READ AND WHICH OF THE RETURNED TIME STAMPS ARE VALID, I.E. NOT CLOUDY OR PADDED.
+        :param item: position of the field in the labels
+        :return: indices of the read time stamps in the full time series, boolean array of the valid returned time stamps
+        '''
+        time_points = np.arange(self.cloud_fractions.shape[1])
+        if self.time_index is not None:
+            time_points = time_points[self.time_index]
+        clear = self.cloud_fractions[item, time_points] <= self.max_cloud_fraction
+        if self.cloud_mode == "mask":
+            return time_points, clear
+        if not clear.any():  # the least cloudy time stamp is kept, so that no field is empty
+            clear[np.argmin(self.cloud_fractions[item, time_points])] = True
+        time_points = time_points[clear]
+        time_points = time_points[:self.sequence_length]
+        return time_points, np.arange(self.sequence_length) < len(time_points)
+
+    def _time_index(self, item):
+        """
+        THIS FUNCTION RETURNS ONLY THE CLEAR TIME STAMPS OF A FIELD IN "drop" MODE
+        """
+        if self.cloud_fractions is None or self.cloud_mode == "mask":
+            return self.time_index
+        return self.valid_time_points(item)[0]
 
-        feature = self.labels.iloc[item]
-
-        npyfile = os.path.join(self.npyfolder, "fid_{}.npz".format(feature.fid))
-        if os.path.exists(npyfile): # use saved numpy array if already created
-            try:
-                object = np.load(npyfile)
-                image_stack = object["image_stack"]
-                mask = object["mask"]
-            except zipfile.BadZipFile:
-                print("ERROR: {} is a bad zipfile...".format(npyfile))
-                raise
-        else:
-            print("ERROR: {} is a missing...".format(npyfile))
-            raise
-
-        if self.data_transform is not None:
-            image_stack, mask = self.data_transform(image_stack, mask)
-
-        if self.selected_time_points is not None:
-            image_stack = image_stack[self.selected_time_points]
-
-        if self.crop_ids is not None:
-            label = self.crop_ids.index(feature.crop_id)
-        else:
-            label = feature.crop_id
+    def _load_cloud(self, item, fid):
+        """
+        THIS FUNCTION LOADS THE CLOUD PROBABILITIES AND THE MASK OF A FIELD FROM THE STORAGE
+        """
+        if self.store is not None:
+            return self.store.read(item, "cloud_stack"), self.store.read(item, "mask")
+        with np.load(os.path.join(self.npyfolder, "fid_{}.npz".format(fid))) as object:
+            return object["cloud_stack"], object["mask"]
 
-        return image_stack, label, mask, feature.fid
+    def open_storage(self):
+        """
+        THIS FUNCTION (RE-)OPENS THE MEMORY MAPS OF THE READER AND OF ITS CLOUD INDEX IN THE CURRENT PROCESS
+        """
+        super().open_storage()
+        if self.cloud_fractions is not None:
+            self.cloud_fractions = np.load(self.cloud_fractions.filename, mmap_mode="r")
 
     @staticmethod
-    def _setup(rootpath, labelgeojson, npyfolder, min_area_to_ignore=1000,include_cloud=False):
+    def _setup(rootpath, labelgeojson, npyfolder, min_area_to_ignore=1000,include_cloud=False, chunk_rows=None, field_dtype="float32"):
         """
          THIS FUNCTION PREPARES THE PLANET READER BY SPLITTING AND RASTERIZING EACH CROP FIELD AND SAVING INTO SEPERATE FILES FOR SPEED UP THE FURTHER USE OF DATA.
 
@@ -98,10 +156,19 @@ class S2Reader(Dataset):
          :param npyfolder: folder to save the field data for each field polygon
          :param min_area_to_ignore: threshold m2 to eliminate small agricultural fields less than a certain threshold. By default, threshold is 1000 m2
          :param include_cloud: It includes cloud probabilities inti image_stack if TRUE, othervise it saves the cloud info as sepeate array
-         :return: labels of the saved fields
+         :param chunk_rows: If given, bands.npy and clp.npy are memory-mapped and the fields are extracted in horizontal bands of this many rows, so that the peak memory is proportional to a band instead of the tile
+         :return: labels of the saved fields, loaded from the setup manifest without geometries if the fields are up to date
          """
 
 
+        # skip all raster work if the fields were already extracted from the same sources with the same parameters
+        sources = [os.path.join(rootpath, file) for file in ["bbox.pkl", "bands.npy", "clp.npy"]] + [labelgeojson]
+        signature = source_signature(sources, hashed=[labelgeojson])
+        params = dict(min_area_to_ignore=min_area_to_ignore)  # include_cloud and field_dtype select the npyfolder
+        labels = load_manifest(npyfolder, signature, params)
+        if labels is not None:
+            return labels
+
         with open(os.path.join(rootpath, "bbox.pkl"), 'rb') as f:
             bbox = pickle.load(f)
             crs = str(bbox.crs)
@@ -114,14 +181,13 @@ class S2Reader(Dataset):
         labels = labels.loc[ignore]
         labels = labels.to_crs(crs) #TODO: CHECK IF NECESSARY
 
-        bands = np.load(os.path.join(rootpath, "bands.npy"))
-        clp = np.load(os.path.join(rootpath, "clp.npy")) #CLOUD PROBABILITY
-        if include_cloud:
-            bands = np.concatenate([bands, clp], axis=-1) # concat cloud probability
+        # in the memory-bounded mode, the arrays are only memory-mapped and read band by band below
+        mmap_mode = "r" if chunk_rows is not None else None
+        bands = np.load(os.path.join(rootpath, "bands.npy"), mmap_mode=mmap_mode)
+        clp = np.load(os.path.join(rootpath, "clp.npy"), mmap_mode=mmap_mode) #CLOUD PROBABILITY
         _, width, height, _ = bands.shape
-
-        bands = bands.transpose(0, 3, 1, 2)
-        clp = clp.transpose(0, 3, 1, 2)
+        image_dtype, mask_dtype = field_dtypes(field_dtype, np.result_type(bands.dtype, clp.dtype) if include_cloud else bands.dtype)
+        cloud_dtype = np.float32 if field_dtype == "float32" else clp.dtype
 
         transform = rio.transform.from_bounds(minx, miny, maxx, maxy, width, height)
 
@@ -130,31 +196,31 @@ class S2Reader(Dataset):
         assert len(np.unique(fid_mask)) > 0, f"WARNING: Vectorized fid mask contains no fields. " \
                                              f"Does the label geojson {labelgeojson} cover the region defined by {rootpath}?"
 
-        crop_mask = features.rasterize(zip(labels.geometry, labels.crop_id), all_touched=True,
-                                       transform=transform, out_shape=(width, height))
-        assert len(np.unique(crop_mask)) > 0, f"WARNING: Vectorized fid mask contains no fields. " \
-                                              f"Does the label geojson {labelgeojson} cover the region defined by {rootpath}?"
-
-        for index, feature in tqdm(labels.iterrows(), total=len(labels), position=0, leave=True, desc="INFO: Extracting time series into the folder: {}".format(npyfolder)):
-
-            npyfile = os.path.join(npyfolder, "fid_{}.npz".format(feature.fid))
-            if not os.path.exists(npyfile):
-                left, bottom, right, top = feature.geometry.bounds
-                window = rio.windows.from_bounds(left, bottom, right, top, transform)
-
-                row_start = round(window.row_off)
-                row_end = round(window.row_off) + round(window.height)
-                col_start = round(window.col_off)
-                col_end = round(window.col_off) + round(window.width)
-
-                image_stack = bands[:, :, row_start:row_end, col_start:col_end]
-                cloud_stack =clp[:, :, row_start:row_end, col_start:col_end]
-                mask = fid_mask[row_start:row_end, col_start:col_end]
-                mask[mask != feature.fid] = 0
-                mask[mask == feature.fid] = 1
-                os.makedirs(npyfolder, exist_ok=True)
-                np.savez(npyfile, image_stack=image_stack.astype(np.float32), cloud_stack=cloud_stack.astype(np.float32), mask=mask.astype(np.float32), feature=feature.drop("geometry").to_dict())
-
+        # all field windows are computed in a single vectorized pass over the label bounds
+        fids = labels.fid.values
+        windows = field_windows(labels.geometry.bounds.values, transform)
+        positions = [position for position, fid in enumerate(fids) if not os.path.exists(os.path.join(npyfolder, "fid_{}.npz".format(fid)))]
+        if len(positions) > 0:
+            os.makedirs(npyfolder, exist_ok=True)
+
+        with tqdm(total=len(positions), position=0, leave=True, desc="INFO: Extracting time series into the folder: {}".format(npyfolder)) as progress:
+            for first, last, chunk in spatial_chunks(windows, positions, chunk_rows):
+                band_chunk = np.asarray(bands[:, first:last])
+                clp_chunk = np.asarray(clp[:, first:last])
+                if include_cloud:
+                    band_chunk = np.concatenate([band_chunk, clp_chunk], axis=-1) # concat cloud probability
+                band_chunk = band_chunk.transpose(0, 3, 1, 2)
+                clp_chunk = clp_chunk.transpose(0, 3, 1, 2)
+
+                for position, (image_stack, cloud_stack), mask in extract_fields([band_chunk, clp_chunk], fid_mask, fids, windows, chunk, row_offset=first):
+                    npyfile = os.path.join(npyfolder, "fid_{}.npz".format(fids[position]))
+                    np.savez(npyfile, image_stack=cast_field(image_stack, image_dtype), cloud_stack=cloud_stack.astype(cloud_dtype), mask=mask.astype(mask_dtype), feature=labels.iloc[position].drop("geometry").to_dict())
+                    progress.update()
+
+        if len(positions) > 0:
+            print("INFO: Peak resident memory after the extraction: {} MB".format(peak_memory_mb()))
+
+        write_manifest(npyfolder, signature, params, labels)
         return labels
 
 if __name__ == '__main__':
@@ -0,0 +1,105 @@
+"""
+ABOUT SCRIPT:
+It defines a persistent setup manifest which lets the data readers skip their setup when the extracted fields are up to date
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+MANIFEST_VERSION = 2  # version 2 stores the field centroids
+MANIFEST_FILE = "setup_manifest.json"
+LABELS_FILE = "setup_labels.npz"
+
+
+def source_signature(sources, hashed=()):
+    '''
+    THIS FUNCTION DESCRIBES THE SOURCE FILES OF A SETUP BY THEIR SIZE AND MODIFICATION TIME.
+    :param sources: list of source files, e.g. TIF images, numpy arrays and the label GeoJSON
+    :param hashed: subset of the sources which are small enough to be additionally identified by their content hash
+    :return: list of dictionaries
+    '''
+    signature = []
+    for source in sources:
+        stat = os.stat(source)
+        entry = dict(path=os.path.abspath(source), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        if source in hashed:
+            with open(source, "rb") as f:
+                entry["sha1"] = hashlib.sha1(f.read()).hexdigest()
+        signature.append(entry)
+    return signature
+
+
+def load_manifest(npyfolder, signature, params):
+    '''
+    THIS FUNCTION LOADS THE LABELS OF A PREVIOUS SETUP IF ITS MANIFEST MATCHES THE GIVEN SOURCES AND PARAMETERS, AND THE fid_<id>.npz FILE OF EVERY FIELD EXISTS.
+    THE SETUP ONLY EXTRACTS THE MISSING FIELDS, SO PARAMETERS CHANGING THE CONTENT OF THE FIELDS HAVE TO BE PART OF THE npyfolder INSTEAD, E.G. field_dtype
+    :param npyfolder: folder of the extracted field data
+    :param signature: signature of the source files as returned by source_signature
+    :param params: setup parameters selecting the extracted fields, e.g. min_area_to_ignore
+    :return: labels as pandas DataFrame without geometries but with the centroid_x and centroid_y columns, or None if the manifest is missing or outdated
+    '''
+    manifest_file = os.path.join(npyfolder, MANIFEST_FILE)
+    labels_file = os.path.join(npyfolder, LABELS_FILE)
+    if not (os.path.exists(manifest_file) and os.path.exists(labels_file)):
+        return None
+
+    with open(manifest_file, "r") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("params") != params or manifest.get("sources") != signature:
+        print("INFO: Setup manifest {} is outdated, the setup is repeated".format(manifest_file))
+        return None
+
+    with np.load(labels_file) as columns:
+        labels = pd.DataFrame({column: columns[column] for column in manifest["columns"]}, index=columns["__index__"])
+    missing = sum(not os.path.exists(os.path.join(npyfolder, "fid_{}.npz".format(fid))) for fid in labels["fid"].values)
+    if missing > 0:
+        print("INFO: {}/{} extracted fields of the setup manifest {} are missing, the setup is repeated".format(missing, len(labels), manifest_file))
+        return None
+    print("INFO: Loaded {} fields from the setup manifest {}".format(len(labels), manifest_file))
+    return labels
+
+
+def manifest_signature(npyfolder):
+    '''
+    THIS FUNCTION RETURNS WHAT IDENTIFIES THE SETUP OF A FOLDER OF EXTRACTED FIELDS, E.G. TO DETECT OUTDATED DATA DERIVED FROM THEM.
+    THE MANIFEST IS REWRITTEN BY EVERY SETUP WHICH EXTRACTS FIELDS, SO ITS MODIFICATION TIME CHANGES WHEN FIELDS ARE RE-EXTRACTED
+    :param npyfolder: folder of the extracted field data
+    :return: dictionary of the manifest version, parameters, source signature and modification time, or None if the folder has no setup manifest
+    '''
+    manifest_file = os.path.join(npyfolder, MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file, "r") as f:
+        manifest = json.load(f)
+    signature = {key: manifest.get(key) for key in ["version", "params", "sources", "num_fields"]}
+    signature["mtime_ns"] = os.stat(manifest_file).st_mtime_ns
+    return signature
+
+
+def write_manifest(npyfolder, signature, params, labels):
+    '''
+    THIS FUNCTION STORES THE LABELS OF A COMPLETED SETUP AS COLUMNS TOGETHER WITH ITS MANIFEST.
+    :param npyfolder: folder of the extracted field data
+    :param signature: signature of the source files as returned by source_signature
+    :param params: setup parameters affecting the extracted fields
+    :param labels: labels of the extracted fields
+    :return: None
+    '''
+    table = pd.DataFrame(labels.drop(columns="geometry", errors="ignore"))
+    if "geometry" in labels.columns:  # field centroids are kept for spatially grouped splits
+        centroids = labels.geometry.centroid
+        table["centroid_x"], table["centroid_y"] = centroids.x.values, centroids.y.values
+    columns = {}
+    for column in table.columns:
+        values = table[column].values
+        # object columns (e.g. crop names) are stored as unicode arrays, so no pickling is required to load them
+        columns[column] = values.astype(str) if values.dtype == object else values
+
+    os.makedirs(npyfolder, exist_ok=True)
+    np.savez(os.path.join(npyfolder, LABELS_FILE), __index__=table.index.values, **columns)
+    manifest = dict(version=MANIFEST_VERSION, params=params, sources=signature, columns=list(columns.keys()), num_fields=len(table))
+    with open(os.path.join(npyfolder, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
@@ -0,0 +1,216 @@
+"""
+ABOUT SCRIPT:
+It defines a cache of decoded fields in POSIX shared memory, shared by the DataLoader workers and kept over the epochs
+"""
+
+import os
+import uuid
+import atexit
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+if os.name == "posix":
+    import _posixshmem
+
+# columns of the shared field table
+STATE, NBYTES, LAST_USED, IMAGE_DTYPE, T, D, H, W, MASK_DTYPE, MASK_H, MASK_W, GENERATION = range(12)
+NUM_COLUMNS = 12
+# entries of the shared header
+CLOCK, USED_BYTES, HITS, MISSES = range(4)
+
+
+class SharedFieldCache():
+    """
+    THIS CLASS HOLDS DECODED FIELDS (image_stack AND mask BEFORE THE TRANSFORM) IN ONE SHARED MEMORY SEGMENT PER FIELD, WITHIN A BYTE BUDGET.
+    A SHARED TABLE OF ALL FIELDS TRACKS WHICH FIELDS ARE CACHED AND WHEN THEY WERE LAST USED, SO THAT EVERY PROCESS EVICTS THE LEAST RECENTLY USED FIELDS.
+    THE SEGMENTS ARE REMOVED BY close(), OR WHEN THE CREATING PROCESS EXITS
+    """
+    def __init__(self, num_fields, capacity_bytes):
+        '''
+        THIS FUNCTION CREATES THE SHARED FIELD TABLE. IT HAS TO BE CALLED IN THE MAIN PROCESS, BEFORE THE DATALOADER WORKERS ARE STARTED.
+        :param num_fields: number of fields of the reader
+        :param capacity_bytes: byte budget of the cached fields
+        :return: None
+        '''
+        self.num_fields = num_fields
+        self.capacity_bytes = int(capacity_bytes)
+        self.prefix = "fields_{}".format(uuid.uuid4().hex[:12])
+        self.lock = multiprocessing.Lock()
+        self.owner = os.getpid()
+
+        table = _open_segment("{}_table".format(self.prefix), create=True, size=8 * (num_fields * NUM_COLUMNS + 4))
+        np.ndarray(num_fields * NUM_COLUMNS + 4, dtype=np.int64, buffer=table.buf)[:] = 0
+        self._attach(table)
+        atexit.register(self.close)
+        print("INFO: Shared field cache {} of {:.0f} MB initialized".format(self.prefix, self.capacity_bytes / 1e6))
+
+    def __getstate__(self):
+        # every process attaches to the shared table by its name
+        state = self.__dict__.copy()
+        for key in ["_table", "_header", "_segment", "_pid"]:
+            state.pop(key, None)
+        return state
+
+    def _attach(self, table=None):
+        """
+        THIS FUNCTION ATTACHES THE CURRENT PROCESS TO THE SHARED TABLE
+        """
+        self._segment = table if table is not None else _open_segment("{}_table".format(self.prefix))
+        array = np.ndarray(self.num_fields * NUM_COLUMNS + 4, dtype=np.int64, buffer=self._segment.buf)
+        self._header, self._table = array[:4], array[4:].reshape(self.num_fields, NUM_COLUMNS)
+        self._pid = os.getpid()
+
+    def _ensure_attached(self):
+        if getattr(self, "_pid", None) != os.getpid():
+            self._attach()
+
+    def get(self, position):
+        '''
+        THIS FUNCTION COPIES A CACHED FIELD OUT OF SHARED MEMORY. THE COPY RUNS WITHOUT THE LOCK, SO THE GENERATION OF THE FIELD IS CHECKED AGAIN
+        AFTERWARDS, AND A FIELD EVICTED OR RE-INSERTED BY ANOTHER PROCESS IN THE MEANTIME COUNTS AS A MISS.
+        :param position: position of the field in the reader
+        :return: image_stack, mask, or None if the field is not cached
+        '''
+        self._ensure_attached()
+        with self.lock:
+            row = self._table[position]
+            if row[STATE] == 0:
+                self._header[MISSES] += 1
+                return None
+            generation = int(row[GENERATION])
+            image_shape, image_dtype = tuple(row[T:W + 1]), np.dtype(chr(row[IMAGE_DTYPE]))
+            mask_shape, mask_dtype = tuple(row[MASK_H:MASK_W + 1]), np.dtype(chr(row[MASK_DTYPE]))
+
+        field = None
+        try:
+            segment = _open_segment(self._field_name(position))
+        except (FileNotFoundError, ValueError):  # evicted, or re-created and not yet sized, by another process in the meantime
+            segment = None
+        if segment is not None:
+            try:
+                image_bytes = int(np.prod(image_shape)) * image_dtype.itemsize
+                image_stack = np.ndarray(image_shape, dtype=image_dtype, buffer=segment.buf).copy()
+                mask = np.ndarray(mask_shape, dtype=mask_dtype, buffer=segment.buf, offset=image_bytes).copy()
+                field = image_stack, mask
+            except (TypeError, ValueError):  # the segment is smaller than the field
+                pass
+            finally:
+                segment.close()
+
+        with self.lock:
+            row = self._table[position]
+            if field is None or row[STATE] == 0 or row[GENERATION] != generation:
+                self._header[MISSES] += 1
+                return None
+            self._header[CLOCK] += 1
+            self._header[HITS] += 1
+            row[LAST_USED] = self._header[CLOCK]
+        return field
+
+    def put(self, position, image_stack, mask):
+        '''
+        THIS FUNCTION COPIES A FIELD INTO SHARED MEMORY, AFTER EVICTING THE LEAST RECENTLY USED FIELDS IF THE BYTE BUDGET IS EXCEEDED.
+        :param position: position of the field in the reader
+        :param image_stack: decoded field in size [Time Stamp, Image Dimension (Channel), Height, Width]
+        :param mask: spatial mask of the field in size [Height, Width]
+        :return: TRUE if the field is cached
+        '''
+        self._ensure_attached()
+        image_stack, mask = np.ascontiguousarray(image_stack), np.ascontiguousarray(mask)
+        nbytes = image_stack.nbytes + mask.nbytes
+        if image_stack.ndim != 4 or mask.ndim != 2 or nbytes > self.capacity_bytes:
+            return False
+
+        with self.lock:
+            row = self._table[position]
+            if row[STATE] == 1:  # cached by another process in the meantime
+                return True
+            while self._header[USED_BYTES] + nbytes > self.capacity_bytes:
+                self._evict()
+
+            segment = _open_segment(self._field_name(position), create=True, size=max(nbytes, 1))
+            try:
+                np.ndarray(image_stack.shape, dtype=image_stack.dtype, buffer=segment.buf)[:] = image_stack
+                np.ndarray(mask.shape, dtype=mask.dtype, buffer=segment.buf, offset=image_stack.nbytes)[:] = mask
+            finally:
+                segment.close()
+
+            self._header[CLOCK] += 1
+            self._header[USED_BYTES] += nbytes
+            row[STATE], row[NBYTES], row[LAST_USED] = 1, nbytes, self._header[CLOCK]
+            row[GENERATION] += 1
+            row[IMAGE_DTYPE], row[T:W + 1] = ord(image_stack.dtype.char), image_stack.shape
+            row[MASK_DTYPE], row[MASK_H:MASK_W + 1] = ord(mask.dtype.char), mask.shape
+        return True
+
+    def _evict(self):
+        """
+        THIS FUNCTION REMOVES THE LEAST RECENTLY USED FIELD. IT IS CALLED WITH THE LOCK HELD.
+        PROCESSES STILL COPYING THE FIELD KEEP THEIR MAPPING, AS THE SEGMENT IS ONLY UNLINKED
+        """
+        cached = np.flatnonzero(self._table[:, STATE] == 1)
+        position = cached[np.argmin(self._table[cached, LAST_USED])]
+        _unlink_segment(self._field_name(position))
+        self._header[USED_BYTES] -= self._table[position, NBYTES]
+        self._table[position, STATE] = 0
+
+    def _field_name(self, position):
+        return "{}_{}".format(self.prefix, int(position))
+
+    def stats(self):
+        '''
+        THIS FUNCTION RETURNS THE USAGE OF THE CACHE OVER ALL PROCESSES.
+        :return: dictionary of cached fields, used bytes, hits and misses
+        '''
+        self._ensure_attached()
+        return dict(cached_fields=int((self._table[:, STATE] == 1).sum()), used_bytes=int(self._header[USED_BYTES]),
+                    hits=int(self._header[HITS]), misses=int(self._header[MISSES]))
+
+    def close(self):
+        '''
+        THIS FUNCTION REMOVES ALL SEGMENTS OF THE CACHE. ONLY THE CREATING PROCESS REMOVES THEM.
+        :return: None
+        '''
+        if os.getpid() != self.owner or getattr(self, "_segment", None) is None:
+            return
+        for position in np.flatnonzero(self._table[:, STATE] == 1):
+            _unlink_segment(self._field_name(position))
+        self._header = self._table = None
+        self._segment.close()
+        _unlink_segment("{}_table".format(self.prefix))
+        self._segment = None
+
+
+def _open_segment(name, create=False, size=0):
+    """
+    THIS FUNCTION OPENS A SHARED MEMORY SEGMENT WITHOUT REGISTERING IT AT THE RESOURCE TRACKER, WHICH WOULD OTHERWISE REMOVE IT WHEN A WORKER EXITS
+    """
+    segment = shared_memory.SharedMemory(name=name, create=create, size=size)
+    if os.name == "posix":  # the resource tracker only tracks POSIX segments
+        try:
+            resource_tracker.unregister(segment._name, "shared_memory")
+        except Exception:  # the segment was not registered
+            pass
+    return segment
+
+
+def _unlink_segment(name):
+    """
+    THIS FUNCTION REMOVES A SHARED MEMORY SEGMENT, IF IT STILL EXISTS
+    """
+    try:
+        segment = _open_segment(name)
+    except FileNotFoundError:
+        return
+    segment.close()
+    _shm_unlink(segment._name)
+
+
+def _shm_unlink(name):
+    """
+    THIS FUNCTION REMOVES THE NAME OF A POSIX SHARED MEMORY SEGMENT. SharedMemory.unlink CANNOT BE USED, AS IT ALSO UNREGISTERS THE SEGMENT AT THE
+    RESOURCE TRACKER, WHERE _open_segment HAS ALREADY UNREGISTERED IT. WINDOWS SEGMENTS HAVE NO NAME TO REMOVE, THEY ARE FREED WITH THEIR LAST HANDLE
+    """
+    if os.name == "posix":
+        _posixshmem.shm_unlink(name)
@@ -0,0 +1,86 @@
+"""
+ABOUT SCRIPT:
+It defines helper functions for the acquisition dates of the time series
+"""
+
+import os
+import re
+import pickle
+import numpy as np
+
+DATE_PATTERN = re.compile(r"(\d{4})[-_]?(\d{2})[-_]?(\d{2})")
+
+
+def dates_from_paths(paths):
+    '''
+    THIS FUNCTION PARSES THE ACQUISITION DATES FROM FILE PATHS, E.G. THE FOLDERS OR NAMES OF THE PLANET TIF FILES.
+    :param paths: list of file paths, one per time stamp
+    :return: array of numpy datetime64[D], or None if a path has no date in YYYY-MM-DD, YYYY_MM_DD or YYYYMMDD form
+    '''
+    dates = []
+    for path in paths:
+        matches = DATE_PATTERN.findall(os.path.relpath(path, os.path.dirname(os.path.dirname(path))))
+        if len(matches) == 0:
+            return None
+        dates.append("-".join(matches[-1]))
+    try:
+        return np.array(dates, dtype="datetime64[D]")
+    except ValueError:  # digits which are not a valid date
+        return None
+
+
+def load_timestamps(rootpath):
+    '''
+    THIS FUNCTION LOADS THE ACQUISITION DATES OF A SENTINEL TILE FROM THE timestamp.pkl OF ITS EOPATCH FOLDER.
+    :param rootpath: folder of the Sentinel tile
+    :return: array of numpy datetime64[D], or None if timestamp.pkl is not available
+    '''
+    timestamp_file = os.path.join(rootpath, "timestamp.pkl")
+    if not os.path.exists(timestamp_file):
+        return None
+    with open(timestamp_file, "rb") as f:
+        timestamps = pickle.load(f)
+    return np.array([np.datetime64(timestamp, "D") for timestamp in timestamps], dtype="datetime64[D]")
+
+
+def calendar_index(dates, calendar):
+    '''
+    THIS FUNCTION MAPS EACH DATE OF A CALENDAR TO THE NEAREST ACQUISITION DATE.
+    :param dates: sorted acquisition dates as numpy datetime64 array
+    :param calendar: dates of the shared calendar as numpy datetime64 array
+    :return: integer array with the index of the nearest acquisition date for each calendar date
+    '''
+    dates = np.asarray(dates, dtype="datetime64[D]").astype(np.int64)
+    calendar = np.asarray(calendar, dtype="datetime64[D]").astype(np.int64)
+    right = np.clip(np.searchsorted(dates, calendar), 1, len(dates) - 1) if len(dates) > 1 else np.zeros(len(calendar), dtype=np.int64)
+    left = np.maximum(right - 1, 0)
+    return np.where(np.abs(calendar - dates[left]) <= np.abs(dates[right] - calendar), left, right)
+
+
+def resolve_time_points(selection, dates=None):
+    '''
+    THIS FUNCTION RESOLVES A SELECTION OF TIME STAMPS INTO AN INDEX WHICH CAN BE APPLIED DIRECTLY TO THE STORED TIME SERIES.
+    :param selection: None for all time stamps,
+                      list or array of time stamp indices, e.g. [2, 3, 4],
+                      slice of the time stamps, e.g. slice(0, 20, 2),
+                      list or array of dates, e.g. ["2018-04-01", "2018-05-01"], each mapped to the nearest acquisition date,
+                      or dictionary of a date range with the optional keys start, end (both inclusive) and stride, e.g. dict(start="2018-04-01", end="2018-06-30", stride=2)
+    :param dates: sorted acquisition dates of the time stamps as numpy datetime64 array, required if the selection is given by dates
+    :return: None, slice or integer array. Slices keep memory-mapped reads zero-copy
+    '''
+    if selection is None or isinstance(selection, slice):
+        return selection
+    if isinstance(selection, dict):
+        assert dates is not None, "WARNING: acquisition dates are unknown, time stamps can only be selected by index"
+        dates = np.asarray(dates, dtype="datetime64[D]")
+        start = np.datetime64(selection["start"], "D") if selection.get("start") is not None else dates.min()
+        end = np.datetime64(selection["end"], "D") if selection.get("end") is not None else dates.max()
+        indices = np.flatnonzero((dates >= start) & (dates <= end))
+        assert len(indices) > 0, "WARNING: no acquisition date between {} and {}".format(start, end)
+        return slice(int(indices[0]), int(indices[-1]) + 1, int(selection.get("stride", 1)))
+
+    selection = np.asarray(selection)
+    if selection.dtype.kind in "USMO":
+        assert dates is not None, "WARNING: acquisition dates are unknown, time stamps can only be selected by index"
+        return calendar_index(dates, selection.astype("datetime64[D]"))
+    return selection.astype(np.int64)
@@ -5,11 +5,16 @@ ABOUT SCRIPT:
 It defines some utility functions required in training and evaluation of model
 """
 
+import os
+import json
+import time
+import shutil
+import contextlib
 import numpy as np
 from tqdm import tqdm
 import torch
 import matplotlib.pyplot as plt
-import sklearn
+from .profiler import timed
 
 
 def confusion_matrix_figure(conf_matrix, labels):
@@ -49,60 +54,170 @@ def metrics(y_true, y_pred):
 
     :return: dictionary of Accuracy, Kappa, F1, Recall, and Precision
     """
-    accuracy = sklearn.metrics.accuracy_score(y_true, y_pred)
-    kappa = sklearn.metrics.cohen_kappa_score(y_true, y_pred)
-    f1_micro = sklearn.metrics.f1_score(y_true, y_pred, average="micro", zero_division=0)
-    f1_macro = sklearn.metrics.f1_score(y_true, y_pred, average="macro", zero_division=0)
-    f1_weighted = sklearn.metrics.f1_score(y_true, y_pred, average="weighted", zero_division=0)
-    recall_micro = sklearn.metrics.recall_score(y_true, y_pred, average="micro")
-    recall_macro = sklearn.metrics.recall_score(y_true, y_pred, average="macro")
-    recall_weighted = sklearn.metrics.recall_score(y_true, y_pred, average="weighted")
-    precision_micro = sklearn.metrics.precision_score(y_true, y_pred, average="micro", zero_division=0)
-    precision_macro = sklearn.metrics.precision_score(y_true, y_pred, average="macro", zero_division=0)
-    precision_weighted = sklearn.metrics.precision_score(y_true, y_pred, average="weighted")
-
-    return dict(
-        accuracy=accuracy,
-        kappa=kappa,
-        f1_micro=f1_micro,
-        f1_macro=f1_macro,
-        f1_weighted=f1_weighted,
-        recall_micro=recall_micro,
-        recall_macro=recall_macro,
-        recall_weighted=recall_weighted,
-        precision_micro=precision_micro,
-        precision_macro=precision_macro,
-        precision_weighted=precision_weighted,
-    )
-
-
-def train_epoch(model, optimizer, criterion, dataloader, device='cpu'):
+    y_true, y_pred = np.asarray(y_true), np.asarray(y_pred)
+    accumulator = MetricsAccumulator(int(max(y_true.max(initial=0), y_pred.max(initial=0))) + 1)
+    accumulator.update(y_true, y_pred)
+    return accumulator.compute()
+
+
+class MetricsAccumulator():
+    """
+    THIS CLASS ACCUMULATES A SINGLE CONFUSION MATRIX BATCH BY BATCH AND DERIVES THE EVALUATION METRICS FROM IT IN CONSTANT MEMORY.
+    THE METRICS ARE IDENTICAL TO THE sklearn.metrics SCORES OVER THE LABELS PRESENT IN THE GROUND-TRUTH OR THE PREDICTIONS, WITH ZERO FOR UNDEFINED SCORES
+    """
+    def __init__(self, num_classes):
+        """
+        THIS FUNCTION INITIALIZES THE ACCUMULATOR
+
+        :param num_classes: number of classes of the model
+        """
+        self.num_classes = num_classes
+        self.confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+
+    def update(self, y_true, y_pred):
+        """
+        THIS FUNCTION ADDS A BATCH OF LABELS TO THE CONFUSION MATRIX
+
+        :param y_true: ground-truth labels as numpy array or torch tensor
+        :param y_pred: predicted labels as numpy array or torch tensor
+        """
+        y_true = y_true.cpu().numpy() if torch.is_tensor(y_true) else np.asarray(y_true)
+        y_pred = y_pred.cpu().numpy() if torch.is_tensor(y_pred) else np.asarray(y_pred)
+        pairs = self.num_classes * y_true.astype(np.int64).reshape(-1) + y_pred.astype(np.int64).reshape(-1)
+        self.confusion += np.bincount(pairs, minlength=self.num_classes ** 2).reshape(self.num_classes, self.num_classes)
+
+    def reset(self):
+        """
+        THIS FUNCTION CLEARS THE CONFUSION MATRIX, E.G. AT THE BEGINNING OF AN EPOCH
+        """
+        self.confusion[:] = 0
+
+    def compute(self):
+        """
+        THIS FUNCTION DERIVES THE EVALUATION METRICS FROM THE CONFUSION MATRIX
+
+        :return: dictionary of Accuracy, Kappa, F1, Recall, and Precision
+        """
+        support, predicted = self.confusion.sum(1), self.confusion.sum(0)
+        present = (support + predicted) > 0
+        confusion = self.confusion[present][:, present].astype(np.float64)
+        support, predicted, tp = support[present], predicted[present], np.diag(confusion)
+        total = confusion.sum()
+
+        def divide(numerator, denominator):
+            return np.divide(numerator, denominator, out=np.zeros_like(numerator, dtype=np.float64), where=denominator > 0)
+
+        accuracy = float(divide(tp.sum(), total))
+
+        def average(scores):
+            # micro averages of single-label multi-class predictions are equal to the accuracy
+            macro = scores.mean() if len(scores) > 0 else 0.0
+            weighted = divide((scores * support).sum(), support.sum())
+            return accuracy, float(macro), float(weighted)
+
+        precision = divide(tp, predicted)
+        recall = divide(tp, support)
+        f1 = divide(2 * tp, support + predicted)
+        expected = np.outer(support, predicted) / max(total, 1)
+        observed_disagreement = total - tp.sum()
+        expected_disagreement = expected.sum() - np.trace(expected)
+        kappa = 1 - observed_disagreement / expected_disagreement if expected_disagreement > 0 else np.nan
+
+        f1_micro, f1_macro, f1_weighted = average(f1)
+        recall_micro, recall_macro, recall_weighted = average(recall)
+        precision_micro, precision_macro, precision_weighted = average(precision)
+
+        return dict(
+            accuracy=accuracy,
+            kappa=float(kappa),
+            f1_micro=f1_micro,
+            f1_macro=f1_macro,
+            f1_weighted=f1_weighted,
+            recall_micro=recall_micro,
+            recall_macro=recall_macro,
+            recall_weighted=recall_weighted,
+            precision_micro=precision_micro,
+            precision_macro=precision_macro,
+            precision_weighted=precision_weighted,
+        )
+
+
+def train_epoch(model, optimizer, criterion, dataloader, device='cpu', amp=False, accumulation_steps=1, sync_every=50):
     """
     THIS FUNCTION ITERATES A SINGLE EPOCH FOR TRAINING
 
-    :param model: torch model for training
+    :param model: torch model for training, optionally compiled by compile_model
     :param optimizer: torch training optimizer
     :param criterion: torch objective for loss calculation
     :param dataloader: training data loader
     :param device: where to run the epoch
+    :param amp: If TRUE, the forward pass and the loss run in bfloat16 autocast, on CPU as well as on GPU.
+                It requires torch>=1.10 for torch.autocast, so it is not available with the torch==1.9.0 of requirements.txt
+    :param accumulation_steps: number of batches whose gradients are accumulated before each optimizer step
+    :param sync_every: number of batches between the host synchronizations which update the progress bar with the mean loss.
+                       The losses are otherwise accumulated on the device without waiting for it
 
-    :return: loss
+    :return: loss of each batch as a detached tensor
     """
+    if amp and not hasattr(torch, "autocast"):
+        raise RuntimeError("amp requires torch.autocast (torch>=1.10), which is not available in torch {}".format(torch.__version__))
     model.train()
-    losses = list()
-    with tqdm(enumerate(dataloader), total=len(dataloader),position=0, leave=True) as iterator:
-        for idx, batch in iterator:
-            optimizer.zero_grad()
-            x, y_true, _, _ = batch
-            loss = criterion(model.forward(x.to(device)), y_true.to(device))
-            loss.backward()
-            optimizer.step()
-            iterator.set_description(f"train loss={loss:.2f}")
-            losses.append(loss)
-    return torch.stack(losses)
-
-
-def validation_epoch(model, criterion, dataloader, device='cpu'):
+    device_type = torch.device(device).type
+    autocast = (lambda: torch.autocast(device_type, dtype=torch.bfloat16)) if amp else contextlib.nullcontext
+    losses = torch.zeros(len(dataloader), device=device)
+    data_time, num_samples, start = 0.0, 0, time.perf_counter()
+    optimizer.zero_grad(set_to_none=True)
+    with tqdm(total=len(dataloader), position=0, leave=True) as progress:
+        iterator = iter(dataloader)
+        for idx in range(len(dataloader)):
+            fetch = time.perf_counter()
+            with timed("data_wait"):
+                x, y_true, _, _ = next(iterator)
+            data_time += time.perf_counter() - fetch
+
+            with timed("h2d", device):
+                x, y_true = x.to(device, non_blocking=True), y_true.to(device, non_blocking=True)
+            with timed("forward", device), autocast():
+                loss = criterion(model.forward(x), y_true)
+            with timed("backward", device):
+                # the last group of an epoch may hold fewer batches, its gradients are averaged over its actual size
+                group_start = idx // accumulation_steps * accumulation_steps
+                (loss / min(accumulation_steps, len(dataloader) - group_start)).backward()
+            if (idx + 1) % accumulation_steps == 0 or idx + 1 == len(dataloader):
+                with timed("optimizer", device):
+                    optimizer.step()
+                    optimizer.zero_grad(set_to_none=True)
+
+            losses[idx] = loss.detach()
+            num_samples += len(y_true)
+            progress.update()
+            if (idx + 1) % sync_every == 0 or idx + 1 == len(dataloader):
+                progress.set_description(f"train loss={losses[max(0, idx + 1 - sync_every):idx + 1].mean().item():.2f}")
+
+    elapsed = time.perf_counter() - start
+    print("INFO: Trained on {} samples in {:.1f}s ({:.1f} samples/s), data wait {:.1f}s ({:.0f}%), compute {:.1f}s ({:.0f}%)".format(
+        num_samples, elapsed, num_samples / max(elapsed, 1e-9), data_time, 100 * data_time / max(elapsed, 1e-9),
+        elapsed - data_time, 100 * (elapsed - data_time) / max(elapsed, 1e-9)))
+    return losses.cpu()
+
+
+def compile_model(model, **kwargs):
+    """
+    THIS FUNCTION COMPILES A MODEL, E.G. SpatiotemporalModel, WITH torch.compile IF IT IS AVAILABLE.
+    torch.compile requires torch>=2.0, so with the torch==1.9.0 of requirements.txt the model is returned unchanged
+
+    :param model: torch model
+    :param kwargs: arguments of torch.compile, e.g. mode="max-autotune"
+
+    :return: compiled model sharing the parameters of the given model, or the given model if torch.compile is not available
+    """
+    if not hasattr(torch, "compile"):
+        print("INFO: torch.compile is not available in torch {}, the model is not compiled".format(torch.__version__))
+        return model
+    return torch.compile(model, **kwargs)
+
+
+def validation_epoch(model, criterion, dataloader, device='cpu', accumulator=None, keep_predictions=True):
     """
     THIS FUNCTION ITERATES A SINGLE EPOCH FOR VALIDATION
 
@@ -110,6 +225,8 @@ def validation_epoch(model, criterion, dataloader, device='cpu'):
     :param criterion: torch objective for loss calculation
     :param dataloader: validation data loader
     :param device: where to run the epoch
+    :param accumulator: MetricsAccumulator updated with the labels of each batch, e.g. to compute the metrics without keeping the predictions
+    :param keep_predictions: If FALSE, y_true, y_pred, y_score and field_id are not collected and returned as None, so the epoch runs in constant memory
 
     :return: loss, y_true, y_pred, y_score, field_id
     """
@@ -123,12 +240,69 @@ def validation_epoch(model, criterion, dataloader, device='cpu'):
         with tqdm(enumerate(dataloader), total=len(dataloader), position=0, leave=True) as iterator:
             for idx, batch in iterator:
                 x, y_true, _, field_id = batch
-                logprobabilities = model.forward(x.to(device))
-                loss = criterion(logprobabilities, y_true.to(device))
+                with timed("h2d", device):
+                    x = x.to(device)
+                with timed("forward", device):
+                    logprobabilities = model.forward(x)
+                    loss = criterion(logprobabilities, y_true.to(device))
                 iterator.set_description(f"valid loss={loss:.2f}")
                 losses.append(loss)
-                y_true_list.append(y_true)
-                y_pred_list.append(logprobabilities.argmax(-1))
-                y_score_list.append(logprobabilities.exp())
-                field_ids_list.append(field_id)
+                y_pred = logprobabilities.argmax(-1)
+                if accumulator is not None:
+                    accumulator.update(y_true, y_pred)
+                if keep_predictions:
+                    y_true_list.append(y_true)
+                    y_pred_list.append(y_pred)
+                    y_score_list.append(logprobabilities.exp())
+                    field_ids_list.append(field_id)
+        if not keep_predictions:
+            return torch.stack(losses), None, None, None, None
         return torch.stack(losses), torch.cat(y_true_list), torch.cat(y_pred_list), torch.cat(y_score_list), torch.cat(field_ids_list)
+
+
+def predict(model, dataloader, output_file, label_ids=None, label_names=None, device='cpu'):
+    """
+    THIS FUNCTION PREDICTS THE CROP TYPES OF A TEST DATA LOADER AND WRITES THEM IN THE SUBMISSION JSON LAYOUT INCREMENTALLY,
+    SO THAT THE SCORES OF ALL FIELDS ARE NEVER HELD IN MEMORY
+
+    :param model: trained torch model returning log probabilities
+    :param dataloader: test data loader, preferably with num_workers > 0 and pin_memory=True to overlap loading with inference
+    :param output_file: path of the submission JSON file with fid, crop_id, crop_name and crop_probs columns
+    :param label_ids: crop ids in the order of the model classes. By default, the class index is written as crop id
+    :param label_names: crop names in the order of the model classes. By default, the crop id is written as crop name
+    :param device: where to run the inference
+
+    :return: number of predicted fields
+    """
+    model.eval()
+    columns = ["fid", "crop_id", "crop_name", "crop_probs"]
+    parts = {column: open("{}.{}.part".format(output_file, column), "w") for column in columns}
+    count = 0
+    try:
+        with getattr(torch, "inference_mode", torch.no_grad)():
+            for x, _, _, field_id in tqdm(dataloader, total=len(dataloader), position=0, leave=True, desc="INFO: Predicting into {}".format(output_file)):
+                logprobabilities = model.forward(x.to(device, non_blocking=True))
+                probabilities = logprobabilities.exp().cpu().numpy()
+                predictions = probabilities.argmax(-1)
+                for fid, prediction, probability in zip(field_id.tolist(), predictions, probabilities):
+                    crop_id = int(label_ids[prediction]) if label_ids is not None else int(prediction)
+                    crop_name = str(label_names[prediction]) if label_names is not None else str(crop_id)
+                    separator = "," if count > 0 else ""
+                    for column, value in zip(columns, [fid, crop_id, crop_name, [round(float(p), 10) for p in probability]]):
+                        parts[column].write('{}"{}":{}'.format(separator, count, json.dumps(value)))
+                    count += 1
+    finally:
+        for part in parts.values():
+            part.close()
+
+    # the column parts are joined in the pandas "columns" orientation of the submission examples
+    with open(output_file, "w") as f:
+        for index, column in enumerate(columns):
+            f.write('{}"{}":{{'.format("{" if index == 0 else ",", column))
+            with open("{}.{}.part".format(output_file, column), "r") as part:
+                shutil.copyfileobj(part, f)
+            f.write("}")
+            os.remove("{}.{}.part".format(output_file, column))
+        f.write("}")
+    print("INFO: {} field predictions are written into {}".format(count, output_file))
+    return count
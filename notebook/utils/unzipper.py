@@ -1,30 +1,101 @@
 import os
+import io
+import copy
+import time
+import pickle
 import tarfile
+import fnmatch
+import numpy as np
 from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
 
-def unzipper(rootdir):
+def unzipper(rootdir, members=None, num_workers=1):
     '''
             THIS FUNCTION DEFINE AN UNZIPPER FOR TAR.GZ FILES IN A DIRECTORY.
             :param rootdir: where  the compressed files are located
+            :param members: list of glob patterns of the archive members to be extracted, e.g. ["*_33N_18E_242N_2018/*"] to extract a single tile.
+                            By default, all members are extracted
+            :param num_workers: number of archives to be decompressed in parallel processes
             :return: None
             '''
 
     inputs = glob(rootdir + '/*.tar.gz', recursive=True)
+    pending = []
     for input in inputs:
-        datadir = os.path.dirname(input)
-        opener, mode = tarfile.open, 'r:gz'
         rootpath = input.replace(".tar.gz", "")
 
-        if not (os.path.exists(rootpath) and os.path.isdir(rootpath)):
-            print(f"INFO: Unzipping {input} to {datadir}")
-            file = opener(input, mode)
-            try:
-                file.extractall(datadir)
-            finally:
-                file.close()
+        if members is not None or not (os.path.exists(rootpath) and os.path.isdir(rootpath)):
+            pending.append(input)
         else:
             print(f"INFO: Found folder in {rootpath}, no need to unzip")
 
+    if num_workers > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(pending))) as executor:
+            list(executor.map(extract_archive, pending, [members] * len(pending), range(len(pending))))
+    else:
+        for input in pending:
+            extract_archive(input, members)
+
+
+def extract_archive(input, members=None, position=0):
+    '''
+            THIS FUNCTION EXTRACTS A TAR.GZ FILE INTO ITS DIRECTORY IN A SINGLE STREAMING PASS, OPTIONALLY ONLY THE MATCHING MEMBERS.
+            :param input: path of the compressed file
+            :param members: list of glob patterns of the archive members to be extracted. Already extracted files of the expected size are skipped.
+                            Files are written under a temporary name and renamed when complete, so an interrupted extraction leaves no partial files
+            :param position: position of the progress bar, if several archives are extracted in parallel
+            :return: number of extracted bytes
+            '''
+    datadir = os.path.dirname(input)
+    print(f"INFO: Unzipping {input} to {datadir}")
+    extracted, start = 0, time.perf_counter()
+    with tarfile.open(input, 'r|gz') as file, tqdm(unit="B", unit_scale=True, position=position, leave=True, desc=f"INFO: {os.path.basename(input)}") as progress:
+        for member in file:
+            if not _is_selected(member.name, members):
+                continue
+            path = os.path.join(datadir, member.name)
+            if not member.isfile():
+                file.extract(member, datadir)
+                continue
+            if members is not None and os.path.exists(path) and os.path.getsize(path) == member.size:
+                continue
+            # the member is written as <name>.part and renamed when complete
+            partial = copy.copy(member)
+            partial.name = member.name + ".part"
+            file.extract(partial, datadir)
+            os.replace(path + ".part", path)
+            extracted += member.size
+            progress.update(member.size)
+
+    elapsed = time.perf_counter() - start
+    print(f"INFO: Extracted {extracted / 1e6:.1f} MB from {input} in {elapsed:.1f}s ({extracted / 1e6 / max(elapsed, 1e-9):.1f} MB/s)")
+    return extracted
+
+
+def iter_archive(input, members=None):
+    '''
+            THIS FUNCTION STREAMS THE PAYLOADS OF A TAR.GZ FILE WITHOUT WRITING THEM TO DISK.
+            :param input: path of the compressed file
+            :param members: list of glob patterns of the archive members to be read. By default, all files are read
+            :return: generator of (member name, payload) where .npy members are numpy arrays, .pkl members are unpickled objects
+                     (e.g. the sentinelhub BBox of bbox.pkl) and any other member, e.g. .tif images, is returned as bytes
+            '''
+    with tarfile.open(input, 'r|gz') as file:
+        for member in file:
+            if not member.isfile() or not _is_selected(member.name, members):
+                continue
+            payload = file.extractfile(member).read()
+            if member.name.endswith(".npy"):
+                payload = np.load(io.BytesIO(payload))
+            elif member.name.endswith(".pkl"):
+                payload = pickle.loads(payload)
+            yield member.name, payload
+
+
+def _is_selected(name, members):
+    return members is None or any(fnmatch.fnmatch(name, pattern) for pattern in members)
+
 
 if __name__ == '__main__':
     """
@@ -32,4 +103,4 @@ if __name__ == '__main__':
     """
 
     ziproot = "../data/"
-    unzipper(ziproot)
\ No newline at end of file
+    unzipper(ziproot, num_workers=4)